@@ -0,0 +1,149 @@
+"""
+Parquet writer benchmark.
+
+For every table of the star schema, writes synthetic data with each candidate
+combination of codec/level, row-group size and statistics,
+and measures write time, object size and read-back time. The recommended
+setting per table is the one with the lowest estimated end-to-end cost:
+
+    cost = write seconds + read seconds + 2 * size / S3 throughput
+
+(the object is uploaded by transform and downloaded by load).
+
+Usage:
+    python -m benchmarks.parquet_writer --fact-rows 500000 --repeat 3
+"""
+
+import argparse
+import itertools
+import json
+import time
+import polars as pl
+from io import BytesIO
+from benchmarks.synthetic_data import make_star_schema
+from src.utils.parquet_config import write_table_parquet
+
+
+CODECS = [
+    ("uncompressed", None),
+    ("snappy", None),
+    ("lz4", None),
+    ("zstd", 1),
+    ("zstd", 3),
+    ("zstd", 9),
+    ("gzip", 6),
+]
+ROW_GROUP_SIZES = [None, 10_000, 100_000]
+STATISTICS = [False, True, "full"]
+
+
+def candidate_settings(table_name):
+    """
+    Yields every writer setting combination for a table.
+    """
+    for (codec, level), row_group_size, statistics in itertools.product(
+        CODECS, ROW_GROUP_SIZES, STATISTICS
+    ):
+        yield {
+            "compression": codec,
+            "compression_level": level,
+            "row_group_size": row_group_size,
+            "statistics": statistics,
+        }
+
+
+def measure(df, table_name, settings, repeat):
+    """
+    Returns the best write time, read time and size over `repeat` runs.
+    """
+    write_seconds, read_seconds = [], []
+    for _ in range(repeat):
+        buffer = BytesIO()
+        start = time.perf_counter()
+        write_table_parquet(df, table_name, buffer, settings=settings)
+        write_seconds.append(time.perf_counter() - start)
+
+        data = buffer.getvalue()
+        start = time.perf_counter()
+        pl.read_parquet(BytesIO(data))
+        read_seconds.append(time.perf_counter() - start)
+    return min(write_seconds), min(read_seconds), len(data)
+
+
+def run_benchmark(fact_rows, repeat, s3_megabytes_per_second):
+    """
+    Runs every candidate setting against every table.
+
+    Returns:
+        results (dict): table name -> list of result dicts sorted by cost
+    """
+    tables = make_star_schema(fact_rows)
+    bytes_per_second = s3_megabytes_per_second * 1_000_000
+    results = {}
+    for table_name, df in tables.items():
+        seen = set()
+        table_results = []
+        for settings in candidate_settings(table_name):
+            # row-group sizes larger than the table are the same as no limit
+            if settings["row_group_size"] is not None and settings["row_group_size"] >= df.height:
+                settings["row_group_size"] = None
+            key = json.dumps(settings, sort_keys=True)
+            if key in seen:
+                continue
+            seen.add(key)
+
+            write_s, read_s, size = measure(df, table_name, settings, repeat)
+            table_results.append(
+                {
+                    "settings": settings,
+                    "write_ms": write_s * 1000,
+                    "read_ms": read_s * 1000,
+                    "size_bytes": size,
+                    "cost_ms": (write_s + read_s + 2 * size / bytes_per_second) * 1000,
+                }
+            )
+        results[table_name] = sorted(table_results, key=lambda r: r["cost_ms"])
+    return results
+
+
+def format_settings(settings):
+    codec = settings["compression"]
+    if settings["compression_level"] is not None:
+        codec += f"({settings['compression_level']})"
+    return (
+        f"{codec:<14}rg={str(settings['row_group_size']):<7} "
+        f"stats={str(settings['statistics']):<5}"
+    )
+
+
+def print_report(results, top):
+    for table_name, table_results in results.items():
+        print(f"\n{table_name}")
+        print(f"  {'setting':<44}{'write ms':>10}{'read ms':>10}{'bytes':>12}{'cost ms':>10}")
+        for result in table_results[:top]:
+            print(
+                f"  {format_settings(result['settings']):<44}"
+                f"{result['write_ms']:>10.2f}{result['read_ms']:>10.2f}"
+                f"{result['size_bytes']:>12}{result['cost_ms']:>10.2f}"
+            )
+
+    print("\nRecommended PARQUET_WRITER_SETTINGS:")
+    recommended = {
+        table_name: table_results[0]["settings"]
+        for table_name, table_results in results.items()
+    }
+    print(json.dumps(recommended, indent=4))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Parquet writer benchmark")
+    parser.add_argument("--fact-rows", type=int, default=200_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--s3-mbps", type=float, default=50.0,
+        help="assumed S3 throughput from lambda in MB/s",
+    )
+    parser.add_argument("--top", type=int, default=5)
+    args = parser.parse_args()
+
+    print_report(run_benchmark(args.fact_rows, args.repeat, args.s3_mbps), args.top)
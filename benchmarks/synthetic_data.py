@@ -0,0 +1,177 @@
+"""
+Synthetic star schema tables with the same columns and types as the parquet
+files written by the transform lambda. Sizes of the dimensions roughly follow
+the totesys database; the fact table size is configurable.
+"""
+
+import datetime as dt
+import numpy as np
+import polars as pl
+from src.utils.transform_utils import create_calendar_dim_date
+
+
+DIMENSION_ROWS = {
+    "dim_staff": 20,
+    "dim_location": 30,
+    "dim_counterparty": 20,
+    "dim_design": 500,
+}
+CURRENCIES = [
+    ("GBP", "Great British Pound"),
+    ("USD", "US Dollars"),
+    ("EUR", "Euros"),
+]
+DEPARTMENTS = [
+    ("Sales", "Manchester"), ("Purchasing", "Manchester"),
+    ("Production", "Leeds"), ("Dispatch", "Leds"), ("Finance", "Manchester"),
+    ("Facilities", "Manchester"), ("Communications", "Leeds"), ("HR", "Leeds"),
+]
+COUNTRIES = [
+    "United Kingdom", "Turkey", "San Marino", "Samoa", "Australia",
+    "Republic of Korea", "Zimbabwe", "Faroe Islands",
+]
+MATERIALS = [
+    "Wooden", "Bronze", "Soft", "Plastic", "Concrete", "Cotton", "Granite",
+    "Frozen", "Steel", "Rubber",
+]
+FIRST_DAY = dt.date(2022, 11, 3)
+
+
+def _words(rng, prefix, n):
+    return [f"{prefix} {i} {w}" for i, w in enumerate(rng.choice(MATERIALS, n))]
+
+
+def make_fact_sales_order(rows, seed=0):
+    """
+    Builds a fact_sales_order table with `rows` rows spread over two years.
+    """
+    rng = np.random.default_rng(seed)
+    first_day = (FIRST_DAY - dt.date(1970, 1, 1)).days
+    created_days = first_day + np.sort(rng.integers(0, 730, rows))
+    created_nanoseconds = rng.integers(0, 86_400, rows) * 1_000_000_000
+
+    return pl.DataFrame(
+        {
+            "sales_order_id": np.arange(1, rows + 1),
+            "design_id": rng.integers(1, DIMENSION_ROWS["dim_design"] + 1, rows),
+            "staff_id": rng.integers(1, DIMENSION_ROWS["dim_staff"] + 1, rows),
+            "counterparty_id": rng.integers(
+                1, DIMENSION_ROWS["dim_counterparty"] + 1, rows
+            ),
+            "units_sold": rng.integers(1_000, 100_000, rows),
+            "unit_price": rng.uniform(2.0, 4.0, rows).round(2),
+            "currency_id": rng.integers(1, len(CURRENCIES) + 1, rows),
+            "agreed_delivery_date": created_days + rng.integers(1, 10, rows),
+            "agreed_payment_date": created_days + rng.integers(1, 15, rows),
+            "agreed_delivery_location_id": rng.integers(
+                1, DIMENSION_ROWS["dim_location"] + 1, rows
+            ),
+            "created_date": created_days,
+            "created_time": created_nanoseconds,
+            "last_updated_date": created_days,
+            "last_updated_time": created_nanoseconds,
+        }
+    ).with_columns(
+        pl.col(
+            "agreed_delivery_date", "agreed_payment_date",
+            "created_date", "last_updated_date"
+        ).cast(pl.Int32).cast(pl.Date),
+        pl.col("created_time", "last_updated_time").cast(pl.Time),
+    )
+
+
+def make_dimensions(seed=0):
+    """
+    Builds the six dimension tables.
+    """
+    rng = np.random.default_rng(seed)
+    n_staff = DIMENSION_ROWS["dim_staff"]
+    n_location = DIMENSION_ROWS["dim_location"]
+    n_counterparty = DIMENSION_ROWS["dim_counterparty"]
+    n_design = DIMENSION_ROWS["dim_design"]
+    departments = [DEPARTMENTS[i] for i in rng.integers(0, len(DEPARTMENTS), n_staff)]
+    countries = rng.choice(COUNTRIES, n_location)
+    counterparty_countries = rng.choice(COUNTRIES, n_counterparty)
+    materials = rng.choice(MATERIALS, n_design)
+
+    return {
+        "dim_staff": pl.DataFrame(
+            {
+                "staff_id": np.arange(1, n_staff + 1),
+                "first_name": [f"first_{i}" for i in range(n_staff)],
+                "last_name": [f"last_{i}" for i in range(n_staff)],
+                "email_address": [
+                    f"staff_{i}@terrifictotes.com" for i in range(n_staff)
+                ],
+                "department_name": [d[0] for d in departments],
+                "location": [d[1] for d in departments],
+            }
+        ),
+        "dim_location": pl.DataFrame(
+            {
+                "location_id": pl.Series(np.arange(1, n_location + 1), dtype=pl.UInt32),
+                "address_line_1": _words(rng, "Street", n_location),
+                "address_line_2": [None] * n_location,
+                "district": [None] * n_location,
+                "city": [f"city_{i}" for i in range(n_location)],
+                "postal_code": [f"{i:05d}" for i in range(n_location)],
+                "country": countries,
+                "phone": [f"0{i:03d} 123456" for i in range(n_location)],
+            },
+            schema_overrides={"address_line_2": pl.String, "district": pl.String},
+        ),
+        "dim_counterparty": pl.DataFrame(
+            {
+                "counterparty_id": np.arange(1, n_counterparty + 1),
+                "counterparty_legal_name": [
+                    f"Company {i}" for i in range(n_counterparty)
+                ],
+                "counterparty_legal_address_line_1": _words(
+                    rng, "Road", n_counterparty
+                ),
+                "counterparty_legal_address_line_2": [None] * n_counterparty,
+                "counterparty_legal_district": [None] * n_counterparty,
+                "counterparty_legal_city": [
+                    f"city_{i}" for i in range(n_counterparty)
+                ],
+                "counterparty_legal_postal_code": [
+                    f"{i:05d}" for i in range(n_counterparty)
+                ],
+                "counterparty_legal_country": counterparty_countries,
+                "counterparty_legal_phone_number": [
+                    f"0{i:03d} 654321" for i in range(n_counterparty)
+                ],
+            },
+            schema_overrides={
+                "counterparty_legal_address_line_2": pl.String,
+                "counterparty_legal_district": pl.String,
+            },
+        ),
+        "dim_currency": pl.DataFrame(
+            {
+                "currency_id": np.arange(1, len(CURRENCIES) + 1),
+                "currency_code": [c[0] for c in CURRENCIES],
+                "currency_name": [c[1] for c in CURRENCIES],
+            }
+        ),
+        "dim_design": pl.DataFrame(
+            {
+                "design_id": np.arange(1, n_design + 1),
+                "design_name": materials,
+                "file_location": [f"/usr/share/{i % 40}" for i in range(n_design)],
+                "file_name": [
+                    f"{m.lower()}-2022{i:04d}.json" for i, m in enumerate(materials)
+                ],
+            }
+        ),
+        "dim_date": create_calendar_dim_date(dt.date(2020, 1, 1), dt.date(2030, 12, 31)),
+    }
+
+
+def make_star_schema(fact_rows, seed=0):
+    """
+    Returns a dict of table name -> DataFrame for the whole star schema.
+    """
+    tables = make_dimensions(seed)
+    tables["fact_sales_order"] = make_fact_sales_order(fact_rows, seed)
+    return tables
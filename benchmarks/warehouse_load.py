@@ -0,0 +1,345 @@
+"""
+Warehouse load benchmark.
+
+Stands up the warehouse schema from database/test_datawarehouse.sql on a
+local PostgreSQL server, writes synthetic parquet inputs of every size and
+times each load strategy:
+
+    row_insert        one INSERT per fact row (the original loader)
+    batched_insert    multi-row INSERT ... VALUES of --batch-rows rows
+    copy              COPY FROM STDIN into the monthly partitions (current loader)
+    scd2_merge        hash diff + staging table + one versioning statement into dim_staff
+    scd2_unchanged    the same merge into a dim_staff seeded with the same rows
+    upsert            staging table + INSERT ... ON CONFLICT DO UPDATE into
+                      dim_location (the loader of dim_location, dim_currency,
+                      dim_design and dim_date)
+    upsert_unchanged  the same upsert into a dim_location seeded with the same rows
+
+The *_unchanged strategies load their rows once, untimed, before the timed
+run, so they measure a load in which nothing changed.
+
+For every run it reports rows/s, database round trips and, when the
+pg_stat_statements extension is installed, the time spent executing on the
+server (the rest of the wall time is the client, encoding and network).
+
+The server is reached with the PG_* variables used by the tests, e.g. for a
+throwaway server:
+
+    docker run -d -p 5432:5432 -e POSTGRES_PASSWORD=postgres postgres \
+        -c shared_preload_libraries=pg_stat_statements
+    PG_USER=postgres PG_PASSWORD=postgres PG_HOST=localhost PG_PORT=5432 \
+    PG_DATABASE=postgres PG_DATAWAREHOUSE=test_totesys_datawarehouse \
+        python -m benchmarks.warehouse_load --setup
+"""
+
+import argparse
+import datetime as dt
+import json
+import os
+import subprocess
+import tempfile
+import time
+import polars as pl
+from pg8000.native import Connection
+from benchmarks.synthetic_data import make_fact_sales_order, DEPARTMENTS
+from src.utils.load_utils import (
+    copy_fact_partitions,
+    ensure_fact_partitions,
+    merge_scd2_dimension,
+    transaction,
+    upsert_dataframe,
+)
+
+
+SIZES = [10_000, 100_000, 1_000_000]
+FACT_COLUMNS = [
+    "sales_order_id", "created_date", "created_time",
+    "last_updated_date", "last_updated_time", "staff_id",
+    "counterparty_id", "units_sold", "unit_price",
+    "currency_id", "design_id", "agreed_payment_date",
+    "agreed_delivery_date", "agreed_delivery_location_id"
+]
+WAREHOUSE_FACT_COLUMNS = [
+    "sales_order_id", "created_date", "created_time",
+    "last_updated_date", "last_updated_time", "sales_staff_id",
+    "counterparty_id", "units_sold", "unit_price",
+    "currency_id", "design_id", "agreed_payment_date",
+    "agreed_delivery_date", "agreed_delivery_location_id", "load_time_prefix"
+]
+STAFF_COLUMNS = [
+    "staff_id", "first_name", "last_name", "department_name",
+    "location", "email_address"
+]
+LOCATION_COLUMNS = [
+    "location_id", "address_line_1", "address_line_2", "district",
+    "city", "postal_code", "country", "phone"
+]
+
+
+class CountingConnection:
+    """
+    Wraps a pg8000 connection and counts the statements sent to the server.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.round_trips = 0
+
+    def run(self, sql, stream=None, **params):
+        self.round_trips += 1
+        return self.db.run(sql, stream=stream, **params)
+
+
+def connect(database):
+    return Connection(
+        user=os.environ["PG_USER"],
+        password=os.environ["PG_PASSWORD"],
+        host=os.environ["PG_HOST"],
+        port=int(os.environ["PG_PORT"]),
+        database=database,
+    )
+
+
+def setup_warehouse():
+    """
+    Recreates the warehouse database from database/test_datawarehouse.sql.
+    """
+    subprocess.run(
+        [
+            "psql", "-q", "-v", "ON_ERROR_STOP=1",
+            "-h", os.environ["PG_HOST"], "-p", os.environ["PG_PORT"],
+            "-U", os.environ["PG_USER"], "-d", os.environ["PG_DATABASE"],
+            "-f", "database/test_datawarehouse.sql",
+        ],
+        env={**os.environ, "PGPASSWORD": os.environ["PG_PASSWORD"]},
+        check=True,
+    )
+
+
+def make_dim_staff(rows):
+    """
+    Builds a dim_staff table with `rows` rows, to upsert at fact sizes.
+    """
+    return pl.DataFrame(
+        {
+            "staff_id": range(1, rows + 1),
+            "first_name": [f"first_{i}" for i in range(rows)],
+            "last_name": [f"last_{i}" for i in range(rows)],
+            "department_name": [DEPARTMENTS[i % len(DEPARTMENTS)][0] for i in range(rows)],
+            "location": [DEPARTMENTS[i % len(DEPARTMENTS)][1] for i in range(rows)],
+            "email_address": [f"staff_{i}@terrifictotes.com" for i in range(rows)],
+        }
+    )
+
+
+def make_dim_location(rows):
+    """
+    Builds a dim_location table with `rows` rows, to upsert at fact sizes.
+    """
+    return pl.DataFrame(
+        {
+            "location_id": range(1, rows + 1),
+            "address_line_1": [f"{i} Alexie Cliffs" for i in range(rows)],
+            "address_line_2": [None if i % 3 else f"Flat {i}" for i in range(rows)],
+            "district": [None if i % 2 else f"District {i % 50}" for i in range(rows)],
+            "city": [f"City {i % 500}" for i in range(rows)],
+            "postal_code": [f"{i:05d}-7380" for i in range(rows)],
+            "country": [f"Country {i % 100}" for i in range(rows)],
+            "phone": [f"9621 {i:06d}" for i in range(rows)],
+        },
+        schema_overrides={"address_line_2": pl.String, "district": pl.String},
+    )
+
+
+def write_inputs(rows, work_dir):
+    """
+    Writes the synthetic parquet inputs of one size.
+
+    Returns:
+        paths (dict): table name -> parquet path
+    """
+    paths = {
+        "fact_sales_order": os.path.join(work_dir, f"fact_sales_order_{rows}.parquet"),
+        "dim_staff": os.path.join(work_dir, f"dim_staff_{rows}.parquet"),
+        "dim_location": os.path.join(work_dir, f"dim_location_{rows}.parquet"),
+    }
+    make_fact_sales_order(rows).select(FACT_COLUMNS).with_columns(
+        pl.lit("benchmark").alias("load_time_prefix")
+    ).write_parquet(paths["fact_sales_order"])
+    make_dim_staff(rows).write_parquet(paths["dim_staff"])
+    make_dim_location(rows).write_parquet(paths["dim_location"])
+    return paths
+
+
+def row_insert(db, df, batch_rows):
+    column_list = ", ".join(f'"{column}"' for column in WAREHOUSE_FACT_COLUMNS)
+    placeholders = ", ".join(f":c{i}" for i in range(len(WAREHOUSE_FACT_COLUMNS)))
+    sql = f'INSERT INTO "fact_sales_order" ({column_list}) VALUES ({placeholders})'
+    for row in df.iter_rows():
+        db.run(sql, **{f"c{i}": value for i, value in enumerate(row)})
+
+
+def batched_insert(db, df, batch_rows):
+    column_list = ", ".join(f'"{column}"' for column in WAREHOUSE_FACT_COLUMNS)
+    width = len(WAREHOUSE_FACT_COLUMNS)
+    for batch in df.iter_slices(batch_rows):
+        values, params = [], {}
+        for r, row in enumerate(batch.iter_rows()):
+            values.append("(" + ", ".join(f":r{r}c{i}" for i in range(width)) + ")")
+            params.update({f"r{r}c{i}": value for i, value in enumerate(row)})
+        db.run(
+            f'INSERT INTO "fact_sales_order" ({column_list}) VALUES {", ".join(values)}',
+            **params
+        )
+
+
+def copy(db, df, batch_rows):
+    copy_fact_partitions(db, df, WAREHOUSE_FACT_COLUMNS)
+
+
+def scd2_merge(db, df, batch_rows):
+    merge_scd2_dimension(
+        db, "dim_staff", df, STAFF_COLUMNS, "staff_id", dt.datetime.now(), own_transaction=False
+    )
+
+
+def upsert(db, df, batch_rows):
+    upsert_dataframe(
+        db, "dim_location", df, LOCATION_COLUMNS, ["location_id"], own_transaction=False
+    )
+
+
+STRATEGIES = {
+    "row_insert": ("fact_sales_order", row_insert),
+    "batched_insert": ("fact_sales_order", batched_insert),
+    "copy": ("fact_sales_order", copy),
+    "scd2_merge": ("dim_staff", scd2_merge),
+    "scd2_unchanged": ("dim_staff", scd2_merge),
+    "upsert": ("dim_location", upsert),
+    "upsert_unchanged": ("dim_location", upsert),
+}
+# strategies timed against a table already holding the rows they load
+SEEDED_STRATEGIES = {"scd2_unchanged", "upsert_unchanged"}
+
+
+def server_seconds(monitor):
+    """
+    Returns the execution time recorded by pg_stat_statements for the
+    warehouse database, or None if the extension is not installed.
+    """
+    try:
+        rows = monitor.run(
+            "SELECT coalesce(sum(total_exec_time), 0) FROM pg_stat_statements "
+            "WHERE dbid = (SELECT oid FROM pg_database WHERE datname = current_database())"
+        )
+    except Exception:
+        return None
+    return float(rows[0][0]) / 1000
+
+
+def reset_server_stats(monitor):
+    try:
+        monitor.run("SELECT pg_stat_statements_reset()")
+    except Exception:
+        pass
+
+
+def run_strategy(name, df, batch_rows, monitor):
+    """
+    Runs one load strategy in one transaction and measures it. The table is
+    emptied first, then seeded with the same rows for SEEDED_STRATEGIES.
+    """
+    table_name, load = STRATEGIES[name]
+    db = connect(os.environ["PG_DATAWAREHOUSE"])
+    try:
+        db.run(f'TRUNCATE "{table_name}"')
+        if name in SEEDED_STRATEGIES:
+            with transaction(db):
+                load(db, df, batch_rows)
+        if table_name == "fact_sales_order":
+            # partitions are created before the clock starts, for every strategy
+            months = df["created_date"].dt.truncate("1mo").unique().sort().to_list()
+            ensure_fact_partitions(db, months)
+
+        counting = CountingConnection(db)
+        reset_server_stats(monitor)
+        start = time.perf_counter()
+        with transaction(counting):
+            load(counting, df, batch_rows)
+        seconds = time.perf_counter() - start
+        server = server_seconds(monitor)
+    finally:
+        db.close()
+    return {
+        "strategy": name,
+        "rows": df.height,
+        "seconds": seconds,
+        "rows_per_second": df.height / seconds,
+        "round_trips": counting.round_trips,
+        "server_seconds": server,
+    }
+
+
+def run_benchmark(sizes, strategies, batch_rows, row_insert_limit):
+    """
+    Runs every strategy at every size.
+
+    Returns:
+        results (list): one result dict per strategy and size
+    """
+    monitor = connect(os.environ["PG_DATAWAREHOUSE"])
+    try:
+        monitor.run("CREATE EXTENSION IF NOT EXISTS pg_stat_statements")
+    except Exception:
+        pass
+
+    results = []
+    try:
+        with tempfile.TemporaryDirectory() as work_dir:
+            for rows in sizes:
+                paths = write_inputs(rows, work_dir)
+                for name in strategies:
+                    if name == "row_insert" and rows > row_insert_limit:
+                        continue
+                    table_name, _ = STRATEGIES[name]
+                    df = pl.read_parquet(paths[table_name])
+                    results.append(run_strategy(name, df, batch_rows, monitor))
+    finally:
+        monitor.close()
+    return results
+
+
+def print_report(results):
+    print(
+        f"{'strategy':<18}{'rows':>10}{'seconds':>10}{'rows/s':>12}"
+        f"{'round trips':>13}{'server s':>10}"
+    )
+    for result in results:
+        server = result["server_seconds"]
+        print(
+            f"{result['strategy']:<18}{result['rows']:>10}{result['seconds']:>10.2f}"
+            f"{result['rows_per_second']:>12.0f}{result['round_trips']:>13}"
+            f"{'n/a' if server is None else f'{server:.2f}':>10}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Warehouse load benchmark")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES)
+    parser.add_argument("--strategies", nargs="+", choices=list(STRATEGIES), default=list(STRATEGIES))
+    parser.add_argument("--batch-rows", type=int, default=1_000)
+    parser.add_argument(
+        "--row-insert-limit", type=int, default=100_000,
+        help="largest size to run row_insert at, it takes hours at 1M rows",
+    )
+    parser.add_argument("--setup", action="store_true", help="recreate the warehouse database first")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    if args.setup:
+        setup_warehouse()
+    results = run_benchmark(args.sizes, args.strategies, args.batch_rows, args.row_insert_limit)
+    if args.json:
+        print(json.dumps(results, indent=4))
+    else:
+        print_report(results)
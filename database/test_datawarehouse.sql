@@ -4,8 +4,11 @@ CREATE DATABASE test_totesys_datawarehouse;
 
 \c test_totesys_datawarehouse
 
+-- monthly partitions (fact_sales_order_yYYYYmMM) and their secondary indexes
+-- are created by the loader; load_time_prefix is the time prefix a row was
+-- loaded from, so a prefix can be reloaded
 CREATE TABLE "fact_sales_order" (
-  "sales_record_id" SERIAL PRIMARY KEY,
+  "sales_record_id" SERIAL,
   "sales_order_id" int NOT NULL,
   "created_date" date NOT NULL,
   "created_time" time NOT NULL,
@@ -19,8 +22,10 @@ CREATE TABLE "fact_sales_order" (
   "design_id" int NOT NULL,
   "agreed_payment_date" date NOT NULL,
   "agreed_delivery_date" date NOT NULL,
-  "agreed_delivery_location_id" int NOT NULL
-);
+  "agreed_delivery_location_id" int NOT NULL,
+  "load_time_prefix" varchar NOT NULL,
+  PRIMARY KEY ("sales_record_id", "created_date")
+) PARTITION BY RANGE ("created_date");
 
 CREATE TABLE "dim_date" (
   "date_id" date PRIMARY KEY NOT NULL,
@@ -33,15 +38,26 @@ CREATE TABLE "dim_date" (
   "quarter" int NOT NULL
 );
 
+-- dim_staff and dim_counterparty are slowly changing dimensions of type 2:
+-- one row per version, facts reference the natural key, the version of a sale
+-- is the one valid at its created_date, the first version of a row is valid
+-- from -infinity
 CREATE TABLE "dim_staff" (
-  "staff_id" int PRIMARY KEY NOT NULL,
+  "staff_record_id" SERIAL PRIMARY KEY,
+  "staff_id" int NOT NULL,
   "first_name" varchar NOT NULL,
   "last_name" varchar NOT NULL,
   "department_name" varchar NOT NULL,
   "location" varchar NOT NULL,
-  "email_address" varchar NOT NULL
+  "email_address" varchar NOT NULL,
+  "row_hash" bigint NOT NULL,
+  "valid_from" timestamp NOT NULL,
+  "valid_to" timestamp,
+  "is_current" boolean NOT NULL DEFAULT true
 );
 
+CREATE UNIQUE INDEX "dim_staff_current" ON "dim_staff" ("staff_id") WHERE "is_current";
+
 CREATE TABLE "dim_location" (
   "location_id" int PRIMARY KEY NOT NULL,
   "address_line_1" varchar NOT NULL,
@@ -67,7 +83,8 @@ CREATE TABLE "dim_design" (
 );
 
 CREATE TABLE "dim_counterparty" (
-  "counterparty_id" int PRIMARY KEY NOT NULL,
+  "counterparty_record_id" SERIAL PRIMARY KEY,
+  "counterparty_id" int NOT NULL,
   "counterparty_legal_name" varchar NOT NULL,
   "counterparty_legal_address_line_1" varchar NOT NULL,
   "counterparty_legal_address_line_2" varchar,
@@ -75,7 +92,59 @@ CREATE TABLE "dim_counterparty" (
   "counterparty_legal_city" varchar NOT NULL,
   "counterparty_legal_postal_code" varchar NOT NULL,
   "counterparty_legal_country" varchar NOT NULL,
-  "counterparty_legal_phone_number" varchar NOT NULL
+  "counterparty_legal_phone_number" varchar NOT NULL,
+  "row_hash" bigint NOT NULL,
+  "valid_from" timestamp NOT NULL,
+  "valid_to" timestamp,
+  "is_current" boolean NOT NULL DEFAULT true
+);
+
+CREATE UNIQUE INDEX "dim_counterparty_current" ON "dim_counterparty" ("counterparty_id") WHERE "is_current";
+
+-- daily sales summaries, maintained incrementally by the loader
+CREATE TABLE "agg_daily_sales_by_currency" (
+  "sales_date" date NOT NULL,
+  "currency_id" int NOT NULL,
+  "order_count" int NOT NULL,
+  "units_sold" bigint NOT NULL,
+  "sales_value" numeric(14, 2) NOT NULL,
+  PRIMARY KEY ("sales_date", "currency_id")
+);
+
+CREATE TABLE "agg_daily_sales_by_design" (
+  "sales_date" date NOT NULL,
+  "design_id" int NOT NULL,
+  "order_count" int NOT NULL,
+  "units_sold" bigint NOT NULL,
+  "sales_value" numeric(14, 2) NOT NULL,
+  PRIMARY KEY ("sales_date", "design_id")
+);
+
+CREATE TABLE "agg_daily_sales_by_counterparty" (
+  "sales_date" date NOT NULL,
+  "counterparty_id" int NOT NULL,
+  "order_count" int NOT NULL,
+  "units_sold" bigint NOT NULL,
+  "sales_value" numeric(14, 2) NOT NULL,
+  PRIMARY KEY ("sales_date", "counterparty_id")
+);
+
+CREATE TABLE "agg_daily_sales_by_location" (
+  "sales_date" date NOT NULL,
+  "location_id" int NOT NULL,
+  "order_count" int NOT NULL,
+  "units_sold" bigint NOT NULL,
+  "sales_value" numeric(14, 2) NOT NULL,
+  PRIMARY KEY ("sales_date", "location_id")
+);
+
+CREATE TABLE "load_ledger" (
+  "time_prefix" varchar NOT NULL,
+  "table_name" varchar NOT NULL,
+  "etag" varchar NOT NULL,
+  "row_count" int NOT NULL,
+  "completed_at" timestamp NOT NULL,
+  PRIMARY KEY ("time_prefix", "table_name")
 );
 
 -- INSERT INTO "dim_date" 
@@ -0,0 +1,325 @@
+"""
+Backfill: reprocesses every history prefix in a time range.
+
+1. the raw data bucket is listed once; differences files with the same ETag
+   (unchanged dimensions) are downloaded and parsed only once, on a process pool
+2. the calendar, dim_location key map and location state are threaded
+   through the prefixes in order, which only needs the key, date and location
+   specs, so every prefix knows the calendar and locations it starts from
+3. every prefix is transformed and uploaded on the process pool
+4. results are committed in prefix order: optionally loaded into the warehouse,
+   stopping at the first prefix that fails to load, then the calendar and
+   location state are saved
+
+The calendar is threaded from the current one, which already covers the dates
+of the prefixes being reprocessed, so a prefix that already has a dim_date
+output keeps it instead of having it rewritten empty. Loading dim_date only
+inserts missing dates, so prefixes without one get the dates the threaded
+calendar emits for them.
+
+Inputs are read fully into memory, the streaming mode of the transform lambda
+is not used by the backfill.
+
+Usage:
+    python -m src.backfill --start 2024-11-01T00:00:00 --end 2024-11-30T23:59:59 --load
+"""
+
+import argparse
+import boto3
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import datetime as dt
+import polars as pl
+from concurrent.futures import ProcessPoolExecutor
+from src.utils.transform_engine import run_table_specs, specs_for_tables
+from src.utils.key_maps import get_key_map, put_key_map
+from src.utils.transform_cache import get_object_etag
+from src.utils.transform_utils import (
+    finds_data_buckets,
+    build_and_upload_star_schema,
+    get_cached_dim_date,
+    put_cached_dim_date,
+    get_location_state,
+    put_location_state,
+    SOURCE_TABLES,
+    STAR_SCHEMA_SPECS,
+)
+
+
+BACKFILL_WORK_DIR = os.getenv("BACKFILL_WORK_DIR", "/tmp/backfill")
+BACKFILL_PROCESSES = int(os.getenv("BACKFILL_PROCESSES", str(os.cpu_count() or 1)))
+STATE_TABLES = ["location_keys", "calendar", "locations"]
+
+
+def parse_time_prefix(prefix):
+    """
+    Returns the datetime of a YYYY/MM/DD/HH:MM:SS/ time prefix, or None if the
+    string is not a time prefix.
+    """
+    try:
+        return dt.datetime.strptime(prefix, "%Y/%m/%d/%H:%M:%S/")
+    except ValueError:
+        return None
+
+
+def list_history_prefixes(s3_client, raw_data_bucket, start, end):
+    """
+    Lists the history prefixes of the raw data bucket between two datetimes
+    (inclusive) with the ETag of every differences file.
+
+    Args:
+        s3_client (boto3 client): S3 client used to list the bucket
+        raw_data_bucket (string): name of the raw data bucket
+        start (datetime): first time prefix to include
+        end (datetime): last time prefix to include
+
+    Returns:
+        prefixes (dict): time prefix -> {table: (key, etag)}, in prefix order
+    """
+    prefixes = {}
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=raw_data_bucket, Prefix="/history/"):
+        for obj in page.get("Contents", []):
+            path, _, file = obj["Key"].rpartition("/")
+            prefix = path[len("/history/"):] + "/"
+            prefix_time = parse_time_prefix(prefix)
+            if prefix_time is None or not start <= prefix_time <= end:
+                continue
+            table = file.removesuffix("_differences.csv")
+            if table in SOURCE_TABLES:
+                prefixes.setdefault(prefix, {})[table] = (obj["Key"], obj["ETag"])
+
+    incomplete = [p for p, tables in prefixes.items() if len(tables) < len(SOURCE_TABLES)]
+    if incomplete:
+        logging.error(f"Prefixes with missing differences files: {incomplete}")
+        raise Exception("Failed to download file")
+    return dict(sorted(prefixes.items(), key=lambda item: parse_time_prefix(item[0])))
+
+
+def input_path(work_dir, etag):
+    return os.path.join(work_dir, "inputs", etag.strip('"') + ".arrow")
+
+
+def fetch_input(raw_data_bucket, key, etag, work_dir):
+    """
+    Downloads and parses one differences file and caches it as an Arrow IPC
+    file named after its ETag. Files already cached are not downloaded again.
+
+    Returns:
+        path (string): path of the cached IPC file
+    """
+    path = input_path(work_dir, etag)
+    if os.path.exists(path):
+        return path
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=work_dir) as download_dir:
+        csv_path = os.path.join(download_dir, "input.csv")
+        boto3.client("s3").download_file(
+            Bucket=raw_data_bucket, Key=key, Filename=csv_path
+        )
+        ipc_path = os.path.join(download_dir, "input.arrow")
+        pl.read_csv(csv_path).write_ipc(ipc_path, compression="uncompressed")
+        os.replace(ipc_path, path)
+    return path
+
+
+def read_sources(inputs, work_dir):
+    """
+    Returns the source tables of a prefix from the cached IPC files.
+    """
+    return {
+        table: pl.read_ipc(input_path(work_dir, etag), memory_map=True)
+        for table, (_, etag) in inputs.items()
+    }
+
+
+def plan_state(prefixes, work_dir, cached_dim_date, key_map, location_state):
+    """
+    Threads the calendar, key map and location state through the prefixes in
+    order.
+
+    Surrogate keys never change once given, so the final key map can be used
+    to transform every prefix. The calendar decides which dates each prefix
+    emits and the location state which address each counterparty is joined
+    to, so the calendar and locations each prefix starts from are returned.
+
+    Args:
+        prefixes (dict): time prefix -> inputs, in prefix order
+        work_dir (string): backfill work directory
+        cached_dim_date (DataFrame): calendar before the first prefix, or None
+        key_map (DataFrame): dim_location key map before the first prefix
+        location_state (DataFrame): locations before the first prefix, or None
+
+    Returns:
+        starts (dict): time prefix -> cached_dim_date and location_state
+            before that prefix
+        state (dict): cached_dim_date, location_key_map and location_state
+            after the last prefix
+    """
+    specs = specs_for_tables(STAR_SCHEMA_SPECS, STATE_TABLES)
+    starts = {}
+    for prefix, inputs in prefixes.items():
+        starts[prefix] = {
+            "cached_dim_date": cached_dim_date, "location_state": location_state
+        }
+        sources = read_sources(inputs, work_dir)
+        sources.update(starts[prefix], location_key_map=key_map)
+        tables = run_table_specs(specs, sources)
+        cached_dim_date, key_map = tables["calendar"], tables["location_keys"]
+        location_state = tables["locations"]
+    return starts, {
+        "cached_dim_date": cached_dim_date,
+        "location_key_map": key_map,
+        "location_state": location_state,
+    }
+
+
+def has_dim_date_output(s3_client, processed_data_bucket, prefix):
+    """
+    Returns True if a prefix already has a dim_date output.
+    """
+    return get_object_etag(
+        s3_client, processed_data_bucket, f"/history/{prefix}/dim_date.parquet"
+    ) is not None
+
+
+def transform_prefix(
+    prefix, inputs, start, key_map, processed_data_bucket, work_dir, keep_dim_date=False
+):
+    """
+    Builds and uploads the star schema of one prefix from the calendar and
+    locations it starts from (see plan_state). With keep_dim_date the
+    prefix's existing dim_date output is left as it is.
+
+    Returns:
+        prefix (string): the time prefix
+        output_keys (list): S3 keys of the uploaded outputs
+    """
+    sources = read_sources(inputs, work_dir)
+    sources.update(start, location_key_map=key_map)
+    with tempfile.TemporaryDirectory(dir=work_dir) as prefix_dir:
+        _, output_keys = build_and_upload_star_schema(
+            sources,
+            boto3.client("s3"),
+            processed_data_bucket,
+            prefix,
+            work_dir=prefix_dir,
+            skip_outputs=("dim_date",) if keep_dim_date else (),
+        )
+    return prefix, output_keys
+
+
+def _map_ordered(processes, fn, arguments):
+    """
+    Yields fn(*args) for every args in order. With more than one process the
+    calls run concurrently on a process pool, and each result is yielded as
+    soon as it and every earlier result are ready.
+    """
+    if processes <= 1:
+        for args in arguments:
+            yield fn(*args)
+        return
+    # polars is not fork safe, so workers are spawned
+    with ProcessPoolExecutor(
+        max_workers=processes, mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        futures = [executor.submit(fn, *args) for args in arguments]
+        try:
+            for future in futures:
+                yield future.result()
+        finally:
+            # the consumer stopped early, e.g. a prefix failed to load
+            for future in futures:
+                future.cancel()
+
+
+def run_backfill(start, end, load=False, processes=BACKFILL_PROCESSES, work_dir=BACKFILL_WORK_DIR):
+    """
+    Reprocesses every history prefix between two datetimes.
+
+    Args:
+        start (datetime): first time prefix to reprocess
+        end (datetime): last time prefix to reprocess
+        load (bool): also load every prefix into the warehouse, in prefix
+            order, raising at the first prefix that fails to load
+        processes (int): size of the process pool, 1 runs everything inline
+        work_dir (string): local directory for downloaded inputs
+
+    Returns:
+        prefixes (list): the reprocessed time prefixes, in order
+    """
+    s3_client = boto3.client("s3")
+    raw_data_bucket, processed_data_bucket = finds_data_buckets()
+    prefixes = list_history_prefixes(s3_client, raw_data_bucket, start, end)
+    if not prefixes:
+        logging.info("No prefixes to backfill")
+        return []
+
+    os.makedirs(work_dir, exist_ok=True)
+    try:
+        unique_inputs = {
+            etag: key for inputs in prefixes.values() for key, etag in inputs.values()
+        }
+        logging.info(
+            f"Backfilling {len(prefixes)} prefixes from {len(unique_inputs)} unique files"
+        )
+        for _ in _map_ordered(
+            processes,
+            fetch_input,
+            [(raw_data_bucket, key, etag, work_dir) for etag, key in unique_inputs.items()],
+        ):
+            pass
+
+        starts, state = plan_state(
+            prefixes,
+            work_dir,
+            get_cached_dim_date(s3_client, processed_data_bucket),
+            get_key_map(s3_client, processed_data_bucket, "dim_location"),
+            get_location_state(s3_client, processed_data_bucket),
+        )
+        key_map = state["location_key_map"]
+        # the key map only grows, so it is safe to save before the outputs using it
+        put_key_map(s3_client, processed_data_bucket, "dim_location", key_map)
+
+        if load:
+            from src.utils.load_utils import load_time_prefix
+
+        for prefix, output_keys in _map_ordered(
+            processes,
+            transform_prefix,
+            [
+                (
+                    prefix, inputs, starts[prefix], key_map, processed_data_bucket, work_dir,
+                    has_dim_date_output(s3_client, processed_data_bucket, prefix),
+                )
+                for prefix, inputs in prefixes.items()
+            ],
+        ):
+            logging.info(f"Transformed {prefix} into {len(output_keys)} files")
+            if load:
+                # raises, so later prefixes are never loaded on top of a failed one
+                load_time_prefix(prefix)
+
+        # every prefix has emitted its dates and locations, the next run
+        # starts after them
+        put_cached_dim_date(s3_client, processed_data_bucket, state["cached_dim_date"])
+        put_location_state(s3_client, processed_data_bucket, state["location_state"])
+    finally:
+        shutil.rmtree(os.path.join(work_dir, "inputs"), ignore_errors=True)
+    return list(prefixes)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reprocess a range of history prefixes")
+    parser.add_argument("--start", type=dt.datetime.fromisoformat, required=True)
+    parser.add_argument("--end", type=dt.datetime.fromisoformat, required=True)
+    parser.add_argument("--load", action="store_true", help="also load into the warehouse")
+    parser.add_argument("--processes", type=int, default=BACKFILL_PROCESSES)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    for prefix in run_backfill(args.start, args.end, args.load, args.processes):
+        print(prefix)
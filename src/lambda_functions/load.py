@@ -1,12 +1,4 @@
-from src.utils.load_utils import (
-    populate_fact_sales,
-    populate_dim_counterparty,
-    populate_dim_currency,
-    populate_dim_date,
-    populate_dim_design,
-    populate_dim_location,
-    populate_dim_staff
-)
+from src.utils.load_utils import load_time_prefix
 import logging
 
 logger = logging.getLogger(__name__)
@@ -16,15 +8,12 @@ logger.setLevel(logging.INFO)
 def lambda_handler(event, context):
     time_prefix = event['time_prefix']
     try:
-        populate_dim_location(time_prefix)
-        populate_dim_staff(time_prefix)
-        populate_dim_counterparty(time_prefix)
-        populate_dim_currency(time_prefix)
-        populate_dim_date(time_prefix)
-        populate_dim_design(time_prefix)
-        populate_fact_sales(time_prefix)
+        # dimensions then the fact table, in one transaction unless
+        # LOAD_PARALLELISM loads the dimensions concurrently
+        load_time_prefix(time_prefix)
 
-        logging.info('All tables successfully loaded')
-    except Exception as e:
-        print(e)
-        logging.error('Issue with loading data into warehouse')
+        logger.info('All tables successfully loaded')
+    except Exception:
+        # the run was rolled back, fail the invocation so it is retried
+        logger.exception('Issue with loading data into warehouse')
+        raise
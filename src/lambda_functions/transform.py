@@ -1,3 +1,4 @@
+import argparse
 from src.utils.transform_utils import create_star_schema_from_sales_order_csv_file
 
 def lambda_handler(event, context):
@@ -5,16 +6,30 @@ def lambda_handler(event, context):
     This function finds data buckets, converts the csvs to parquet in a star schema format, then uploads this
     to the processed data bucket.
 
+    The timings of every stage are logged in CloudWatch embedded metric format
+    and returned with the time prefix.
+
     Args:
         event (dict): time prefix provided by extract function
         context (dict): AWS provided context
 
     Returns:
-        dict: dictionary with time prefix to be used in the load function
+        dict: dictionary with time prefix to be used in the load function and
+            the metrics of every transform stage
     """
 
     prefix = event["time_prefix"]
 
-    create_star_schema_from_sales_order_csv_file(prefix)
+    metrics = create_star_schema_from_sales_order_csv_file(prefix)
+    metrics.emit_emf()
+
+    return {"time_prefix": prefix, "metrics": metrics.as_list()}
+
+
+if __name__ == "__main__":
+    # local run: python -m src.lambda_functions.transform <time prefix>
+    parser = argparse.ArgumentParser(description="Run the transform locally")
+    parser.add_argument("time_prefix")
+    args = parser.parse_args()
 
-    return {"time_prefix": prefix}
\ No newline at end of file
+    print(create_star_schema_from_sales_order_csv_file(args.time_prefix).format_table())
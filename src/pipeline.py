@@ -0,0 +1,334 @@
+"""
+Local pipeline: runs extract, transform and load in one process.
+
+1. every source table is queried from the totesys database straight into a
+   polars frame, typed as the transform lambda reads the extract csv files;
+   the differences are the rows that are not in the previous snapshot
+2. the star schema is built from those frames with the transform engine
+3. the built tables are loaded into the warehouse from memory, through a
+   FrameLoadSession
+
+Tables are handed from stage to stage as polars frames, nothing goes through
+S3 or /tmp. When a processed data bucket is given, the transform outputs, the
+calendar and the dim_location key map are also written there, as the
+transform lambda does, and quarantined rows are written to the bucket.
+
+Between runs the state is returned to the caller: the source snapshot the
+next differences are taken against, the calendar, the key map and every
+location emitted so far. Without a
+state the first run extracts every row of every table, as the extract lambda
+does on its first call. The command line saves the state to a local state
+directory after every successful run and reads it back on the next one, so
+each run only loads what changed since the last.
+
+STATE DIRECTORY STRUCTURE:
+.pipeline_state/
+├─ snapshot/
+│  ├─ sales_order.parquet
+│  ├─ ...
+├─ cached_dim_date.parquet
+├─ location_state.parquet
+├─ location_key_map.parquet
+
+Usage, against local PostgreSQL servers (PG_* for the warehouse as in the
+tests, TOTESYS_* for the source database, defaulting to the PG_* values):
+    python -m src.pipeline --parallelism 1 --state-dir .pipeline_state
+"""
+
+import argparse
+import logging
+import os
+import shutil
+import tempfile
+import polars as pl
+from src.utils.extract_utils import (
+    connect_to_db as connect_to_source,
+    create_time_based_path,
+    query_db,
+)
+from src.utils.key_maps import get_key_map, put_key_map, KEY_MAP_SCHEMA
+from src.utils.transform_engine import run_table_specs
+from src.utils.transform_metrics import TransformMetrics
+from src.utils.transform_utils import (
+    build_and_upload_star_schema,
+    extends_calendar,
+    get_cached_dim_date,
+    put_cached_dim_date,
+    get_location_state,
+    put_location_state,
+    SOURCE_TABLES,
+    STAR_SCHEMA_SPECS,
+)
+from src.utils.load_utils import FrameLoadSession, load_time_prefix, LOAD_PARALLELISM
+
+PIPELINE_STATE_DIR = os.getenv("PIPELINE_STATE_DIR", ".pipeline_state")
+
+
+def source_frame(rows):
+    """
+    Builds a polars frame from the result of query_db (header row, then data
+    rows), typed as the transform lambda reads the csv files written by
+    extract: timestamps and dates as strings, numerics as floats and the
+    columns of an empty table as strings.
+    """
+    header, data = rows[0], rows[1:]
+    df = pl.DataFrame(data, schema=header, orient="row", infer_schema_length=None)
+    return df.with_columns(
+        pl.col(pl.Datetime, pl.Date, pl.Time, pl.Null).cast(pl.String),
+        pl.col(pl.Decimal).cast(pl.Float64),
+    )
+
+
+def extract_tables(conn, previous=None):
+    """
+    Queries every source table used by the star schema.
+
+    The differences of a table are its rows that are not in the previous
+    snapshot, i.e. new and changed rows, like the _differences files of the
+    extract lambda.
+
+    Args:
+        conn (Connection): totesys database connection
+        previous (dict): snapshot of the previous run, None extracts every row
+
+    Returns:
+        snapshot (dict): source table name -> every row of the table
+        differences (dict): source table name -> new and changed rows
+    """
+    snapshot = {table: source_frame(query_db(table, conn)) for table in SOURCE_TABLES}
+    if previous is None:
+        return snapshot, snapshot
+    differences = {
+        table: df.join(
+            previous[table].cast(df.schema), on=df.columns, how="anti", join_nulls=True
+        )
+        for table, df in snapshot.items()
+    }
+    return snapshot, differences
+
+
+def transform_tables(
+    sources, cached_dim_date, key_map, location_state,
+    s3_client=None, processed_data_bucket=None, time_prefix=None
+):
+    """
+    Builds every star schema table from the source frames, uploading each
+    output to the processed data bucket as it is built when one is given.
+
+    Args:
+        sources (dict): source table name -> differences frame
+        cached_dim_date (DataFrame): calendar of the previous run, or None
+        key_map (DataFrame): dim_location key map of the previous run
+        location_state (DataFrame): locations of the previous runs, or None
+        s3_client (boto3 client): S3 client used to upload the outputs
+        processed_data_bucket (string): bucket to upload to, None to skip S3
+        time_prefix (string): time prefix of the run
+
+    Returns:
+        tables (dict): every source and built table, name -> DataFrame
+    """
+    sources = dict(
+        sources,
+        cached_dim_date=cached_dim_date,
+        location_key_map=key_map,
+        location_state=location_state,
+    )
+    if processed_data_bucket is None:
+        return run_table_specs(STAR_SCHEMA_SPECS, sources)
+    with tempfile.TemporaryDirectory() as work_dir:
+        tables, _ = build_and_upload_star_schema(
+            sources, s3_client, processed_data_bucket, time_prefix, work_dir=work_dir
+        )
+    return tables
+
+
+def read_state(state_dir):
+    """
+    Reads the state saved by save_state.
+
+    Args:
+        state_dir (string): local directory the state was saved to
+
+    Returns:
+        state (dict): snapshot, cached_dim_date, location_key_map and
+            location_state, or None if no state has been saved yet
+    """
+    if not os.path.exists(os.path.join(state_dir, "location_key_map.parquet")):
+        return None
+    return {
+        "snapshot": {
+            table: pl.read_parquet(os.path.join(state_dir, "snapshot", f"{table}.parquet"))
+            for table in SOURCE_TABLES
+        },
+        "cached_dim_date": pl.read_parquet(os.path.join(state_dir, "cached_dim_date.parquet")),
+        "location_key_map": pl.read_parquet(os.path.join(state_dir, "location_key_map.parquet")),
+        "location_state": pl.read_parquet(os.path.join(state_dir, "location_state.parquet")),
+    }
+
+
+def save_state(state_dir, state):
+    """
+    Saves the state returned by run_pipeline to a local directory. The files
+    are written next to the directory and swapped in once complete, so an
+    interrupted save leaves the previous state in place.
+
+    Args:
+        state_dir (string): local directory to save the state to
+        state (dict): snapshot, cached_dim_date, location_key_map and
+            location_state
+    """
+    staging_dir = f"{state_dir.rstrip(os.sep)}.tmp"
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    os.makedirs(os.path.join(staging_dir, "snapshot"))
+    for table, df in state["snapshot"].items():
+        df.write_parquet(os.path.join(staging_dir, "snapshot", f"{table}.parquet"))
+    state["cached_dim_date"].write_parquet(os.path.join(staging_dir, "cached_dim_date.parquet"))
+    state["location_state"].write_parquet(os.path.join(staging_dir, "location_state.parquet"))
+    # written last, read_state takes its presence to mean the state is complete
+    state["location_key_map"].write_parquet(
+        os.path.join(staging_dir, "location_key_map.parquet")
+    )
+    shutil.rmtree(state_dir, ignore_errors=True)
+    os.rename(staging_dir, state_dir)
+
+
+def run_pipeline(
+    source_credentials,
+    warehouse_credentials,
+    state=None,
+    time_prefix=None,
+    parallelism=LOAD_PARALLELISM,
+    s3_client=None,
+    processed_data_bucket=None,
+    metrics=None,
+):
+    """
+    Runs extract, transform and load for one time prefix in this process.
+
+    Args:
+        source_credentials (dict): totesys database credentials, as the
+            extract lambda's secret (user, password, host, database, port)
+        warehouse_credentials (dict): warehouse credentials, as the load
+            lambda's secret (user, password, host, name, port)
+        state (dict): state returned by the previous run, None for a first run
+        time_prefix (string): time prefix of the run, the current time if None
+        parallelism (int): number of warehouse connections to load with
+        s3_client (boto3 client): S3 client used with processed_data_bucket
+        processed_data_bucket (string): bucket to also write outputs and state
+            to, None keeps the whole run in memory
+        metrics (TransformMetrics): collects the timings of every stage
+
+    Returns:
+        results (list): message returned by every populate_* function
+        state (dict): snapshot, cached_dim_date, location_key_map and
+            location_state to give the next run
+    """
+    metrics = metrics or TransformMetrics()
+    time_prefix = time_prefix or create_time_based_path()
+    if state is None:
+        state = {
+            "snapshot": None,
+            "cached_dim_date": None,
+            "location_key_map": None,
+            "location_state": None,
+        }
+        if processed_data_bucket is not None:
+            with metrics.stage("read_state"):
+                state["cached_dim_date"] = get_cached_dim_date(s3_client, processed_data_bucket)
+                state["location_key_map"] = get_key_map(
+                    s3_client, processed_data_bucket, "dim_location"
+                )
+                state["location_state"] = get_location_state(
+                    s3_client, processed_data_bucket
+                )
+    key_map = state["location_key_map"]
+    if key_map is None:
+        key_map = pl.DataFrame(schema=KEY_MAP_SCHEMA)
+
+    with metrics.stage("extract") as record:
+        conn = connect_to_source(source_credentials)
+        try:
+            snapshot, differences = extract_tables(conn, state["snapshot"])
+        finally:
+            conn.close()
+        extracted_rows = sum(df.height for df in differences.values())
+        record["rows_out"] = extracted_rows
+
+    with metrics.stage("transform") as record:
+        tables = transform_tables(
+            differences, state["cached_dim_date"], key_map, state["location_state"],
+            s3_client, processed_data_bucket, time_prefix
+        )
+        record["rows_in"] = extracted_rows
+        record["rows_out"] = sum(
+            tables[spec["name"]].height
+            for spec in STAR_SCHEMA_SPECS if spec.get("output", True)
+        )
+
+    with metrics.stage("load"):
+        session = FrameLoadSession(
+            tables, warehouse_credentials, s3_client, processed_data_bucket
+        )
+        results = load_time_prefix(time_prefix, parallelism, session)
+
+    if processed_data_bucket is not None:
+        with metrics.stage("save_state"):
+            # as the transform lambda, never replace a calendar covering more dates
+            if tables["dim_date"].height and extends_calendar(
+                get_cached_dim_date(s3_client, processed_data_bucket), tables["calendar"]
+            ):
+                put_cached_dim_date(s3_client, processed_data_bucket, tables["calendar"])
+            if tables["location_keys"].height != key_map.height:
+                put_key_map(
+                    s3_client, processed_data_bucket, "dim_location", tables["location_keys"]
+                )
+            if tables["dim_location"].height:
+                put_location_state(s3_client, processed_data_bucket, tables["locations"])
+
+    logging.info(f"Pipeline run {time_prefix} loaded: {results}")
+    return results, {
+        "snapshot": snapshot,
+        "cached_dim_date": tables["calendar"],
+        "location_key_map": tables["location_keys"],
+        "location_state": tables["locations"],
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run extract, transform and load in one process")
+    parser.add_argument("--parallelism", type=int, default=LOAD_PARALLELISM)
+    parser.add_argument("--time-prefix", help="defaults to the current time")
+    parser.add_argument(
+        "--state-dir", default=PIPELINE_STATE_DIR,
+        help="directory the state is kept in between runs"
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    source_credentials = {
+        "user": os.getenv("TOTESYS_USER", os.getenv("PG_USER")),
+        "password": os.getenv("TOTESYS_PASSWORD", os.getenv("PG_PASSWORD")),
+        "host": os.getenv("TOTESYS_HOST", os.getenv("PG_HOST")),
+        "port": int(os.getenv("TOTESYS_PORT", os.getenv("PG_PORT", "5432"))),
+        "database": os.getenv("TOTESYS_DATABASE", os.getenv("PG_DATABASE")),
+    }
+    warehouse_credentials = {
+        "user": os.environ["PG_USER"],
+        "password": os.environ["PG_PASSWORD"],
+        "host": os.environ["PG_HOST"],
+        "port": int(os.environ["PG_PORT"]),
+        "name": os.environ["PG_DATAWAREHOUSE"],
+    }
+    metrics = TransformMetrics()
+    results, state = run_pipeline(
+        source_credentials,
+        warehouse_credentials,
+        state=read_state(args.state_dir),
+        time_prefix=args.time_prefix,
+        parallelism=args.parallelism,
+        metrics=metrics,
+    )
+    save_state(args.state_dir, state)
+    for result in results:
+        print(result)
+    print(metrics.format_table())
@@ -0,0 +1,122 @@
+"""
+Persistent natural key -> surrogate key maps for warehouse dimensions.
+
+A key map is stored in the processed data bucket as a two column parquet file
+(natural_key, surrogate_key) sorted by natural_key, so lookups are a vectorized
+binary search over the sorted natural keys. New natural keys are given the next
+surrogate keys and appended, so each run only does work for its delta.
+
+PROCESSED DATA BUCKET STRUCTURE:
+key_maps/
+├─ dim_location.parquet
+"""
+
+import logging
+import polars as pl
+from io import BytesIO
+from botocore.exceptions import ClientError
+
+
+KEY_MAP_PATH = "/key_maps/"
+KEY_MAP_SCHEMA = {"natural_key": pl.Int64, "surrogate_key": pl.UInt32}
+
+
+def get_key_map(s3_client, processed_data_bucket, dimension):
+    """
+    Reads the key map of a dimension from the processed data bucket.
+
+    Args:
+        s3_client (boto3 client): S3 client used to get the key map
+        processed_data_bucket (string): name of the processed data bucket
+        dimension (string): name of the dimension, e.g. dim_location
+
+    Returns:
+        key_map (DataFrame): the key map, empty if it does not exist yet
+    """
+    try:
+        res = s3_client.get_object(
+            Bucket=processed_data_bucket, Key=f"{KEY_MAP_PATH}{dimension}.parquet"
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+            return pl.DataFrame(schema=KEY_MAP_SCHEMA)
+        logging.error(e)
+        raise Exception(f"Failed to get key map for {dimension}")
+    return pl.read_parquet(BytesIO(res["Body"].read()))
+
+
+def put_key_map(s3_client, processed_data_bucket, dimension, key_map):
+    """
+    Writes the key map of a dimension to the processed data bucket.
+    """
+    buffer = BytesIO()
+    key_map.write_parquet(buffer, compression="zstd", statistics=False)
+    s3_client.put_object(
+        Body=buffer.getvalue(),
+        Bucket=processed_data_bucket,
+        Key=f"{KEY_MAP_PATH}{dimension}.parquet",
+    )
+
+
+def extend_key_map(key_map, natural_keys):
+    """
+    Gives every natural key missing from the key map the next surrogate key.
+    New keys are numbered in natural key order after the current maximum.
+
+    Args:
+        key_map (DataFrame): current key map
+        natural_keys (Series): natural keys seen in this run
+
+    Returns:
+        key_map (DataFrame): key map containing every natural key, sorted
+    """
+    natural_keys = natural_keys.cast(pl.Int64).drop_nulls().unique().sort()
+    known = lookup_surrogate_keys(key_map, natural_keys).is_not_null()
+    new_keys = natural_keys.filter(~known)
+    if new_keys.is_empty():
+        return key_map
+
+    next_key = (key_map["surrogate_key"].max() or 0) + 1
+    appended = pl.DataFrame(
+        {
+            "natural_key": new_keys,
+            "surrogate_key": pl.int_range(
+                next_key, next_key + new_keys.len(), dtype=pl.UInt32, eager=True
+            ),
+        }
+    )
+    return pl.concat([key_map, appended]).sort("natural_key")
+
+
+def lookup_surrogate_keys(key_map, natural_keys):
+    """
+    Looks up the surrogate key of every natural key with a binary search over
+    the sorted key map.
+
+    Args:
+        key_map (DataFrame): key map sorted by natural_key
+        natural_keys (Series): natural keys to look up
+
+    Returns:
+        surrogate_keys (Series): surrogate keys, null where the key is unknown
+    """
+    natural_keys = natural_keys.cast(pl.Int64)
+    if key_map.is_empty():
+        return pl.Series(
+            natural_keys.name, [None] * natural_keys.len(), dtype=pl.UInt32
+        )
+
+    sorted_keys = pl.lit(key_map["natural_key"])
+    positions = sorted_keys.search_sorted(pl.col("natural_key")).clip(
+        upper_bound=key_map.height - 1
+    )
+    return (
+        pl.DataFrame({"natural_key": natural_keys})
+        .select(
+            pl.when(sorted_keys.gather(positions) == pl.col("natural_key"))
+            .then(pl.lit(key_map["surrogate_key"]).gather(positions))
+            .otherwise(None)
+        )
+        .to_series()
+        .rename(natural_keys.name)
+    )
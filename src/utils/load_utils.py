@@ -1,11 +1,59 @@
 import boto3
+import functools
+import hashlib
 import logging
 import polars as pl
-import datetime as dt
 from botocore.exceptions import ClientError
+from contextlib import contextmanager, nullcontext, ExitStack
 from io import BytesIO
 from pg8000.native import Connection
+import datetime as dt
 import json
+import os
+import queue
+import shutil
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# local directory where Arrow IPC files are cached and memory mapped from, and
+# streamed tables are downloaded to whole (see scan_processed_table for sizing)
+LOAD_CACHE_DIR = os.getenv("LOAD_CACHE_DIR", "/tmp/processed_cache")
+# 1 loads the whole run sequentially in one transaction. More loads the
+# dimensions concurrently on that many warehouse connections, each committing
+# on its own, so a failed run can leave some dimensions loaded (opt-in)
+LOAD_PARALLELISM = int(os.getenv("LOAD_PARALLELISM", "1"))
+# tables fetched and decoded ahead of the table being loaded
+LOAD_PREFETCH_DEPTH = int(os.getenv("LOAD_PREFETCH_DEPTH", "2"))
+# tables read from a local copy a batch of rows at a time instead of whole
+STREAMED_TABLES = ["fact_sales_order"]
+LOAD_BATCH_ROWS = int(os.getenv("LOAD_BATCH_ROWS", "100000"))
+# fact_sales_order column -> (dimension, key column) it references
+FACT_REFERENCES = {
+    "staff_id": ("dim_staff", "staff_id"),
+    "counterparty_id": ("dim_counterparty", "counterparty_id"),
+    "currency_id": ("dim_currency", "currency_id"),
+    "design_id": ("dim_design", "design_id"),
+    "agreed_delivery_location_id": ("dim_location", "location_id"),
+}
+QUARANTINE_PATH = "/quarantine/"
+# daily sales summary -> (fact_sales_order column, summary key column)
+SALES_SUMMARIES = {
+    "agg_daily_sales_by_currency": ("currency_id", "currency_id"),
+    "agg_daily_sales_by_design": ("design_id", "design_id"),
+    "agg_daily_sales_by_counterparty": ("counterparty_id", "counterparty_id"),
+    "agg_daily_sales_by_location": ("agreed_delivery_location_id", "location_id"),
+}
+SALES_MEASURES = ["order_count", "units_sold", "sales_value"]
+# seeds of the attribute hash of type 2 dimensions, changing them versions every row
+ROW_HASH_SEEDS = (0x746F7465, 0x73797320, 0x64696D73, 0x63643220)
+# a load runs in bulk mode (secondary indexes rebuilt after the copy) when it
+# adds at least this fraction of the rows already in the table
+LOAD_BULK_RATIO = float(os.getenv("LOAD_BULK_RATIO", "0.2"))
+# secondary indexes of every fact_sales_order partition: the time prefix rows
+# are deleted by on a reload and the natural keys of the type 2 dimensions.
+# They are created per partition, not on the partitioned table, so a bulk load
+# into one partition can drop and rebuild them
+FACT_PARTITION_INDEXES = ["load_time_prefix", "sales_staff_id", "counterparty_id"]
 
 
 def find_processed_data_bucket():
@@ -76,25 +124,1089 @@ def connect_to_db(credentials):
     )
 
 
-def populate_fact_sales(time_prefix):
+def _copy_csv(db, table_name, df, columns):
+    buffer = BytesIO()
+    df.write_csv(
+        buffer,
+        include_header=False,
+        date_format="%Y-%m-%d",
+        time_format="%H:%M:%S%.6f",
+        null_value="",
+    )
+    buffer.seek(0)
+    column_list = ", ".join(f'"{column}"' for column in columns)
+    db.run(
+        f'COPY "{table_name}" ({column_list}) FROM STDIN WITH (FORMAT csv)',
+        stream=buffer
+    )
+
+
+@contextmanager
+def transaction(db):
     '''
+    Runs the statements of the with block in one transaction, committed when
+    the block ends and rolled back if it raises.
     '''
-    # read fact_sales_order.parquet from bucket
-    s3_client = boto3.client("s3")
+    db.run("START TRANSACTION")
+    try:
+        yield db
+        db.run("COMMIT")
+    except Exception:
+        db.run("ROLLBACK")
+        raise
+
+
+def get_table_row_estimate(db, table_name):
+    '''
+    Returns the planner estimate of the rows in a table (0 if the table has
+    never been analysed), which costs no scan of the table.
+    '''
+    rows = db.run(
+        "SELECT reltuples FROM pg_class WHERE oid = CAST(:table_name AS regclass)",
+        table_name=table_name
+    )
+    return max(int(rows[0][0]), 0) if rows else 0
+
+
+def get_secondary_indexes(db, table_name):
+    '''
+    Returns the name and definition of every index of a table that does not
+    back a primary key or unique constraint and is not inherited from a
+    partitioned parent table, so can be dropped and rebuilt around a load.
+    '''
+    return [
+        (name, definition) for name, definition in db.run(
+            "SELECT i.relname, pg_get_indexdef(x.indexrelid) "
+            "FROM pg_index x JOIN pg_class i ON i.oid = x.indexrelid "
+            "WHERE x.indrelid = CAST(:table_name AS regclass) "
+            "AND NOT x.indisprimary AND NOT x.indisunique "
+            "AND NOT EXISTS (SELECT 1 FROM pg_inherits WHERE inhrelid = x.indexrelid)",
+            table_name=table_name
+        )
+    ]
+
+
+def use_bulk_mode(incoming_rows, table_rows, ratio=LOAD_BULK_RATIO):
+    '''
+    Returns True when a load is large enough, relative to the rows already
+    in the table, for rebuilding indexes afterwards to beat updating them.
+    '''
+    return incoming_rows > 0 and incoming_rows >= ratio * table_rows
+
+
+@contextmanager
+def bulk_load_mode(db, table_name, incoming_rows):
+    '''
+    Wraps a load into a table. In bulk mode the secondary indexes of the table
+    are dropped before the load, created again after it and the table is
+    analysed. Otherwise (incremental mode) the load runs as is.
+
+    Run inside the load transaction: if the load fails, the rollback restores
+    the dropped indexes. Indexes are therefore not created CONCURRENTLY,
+    which cannot run inside a transaction.
+
+    Args:
+        db (Connection): warehouse connection
+        table_name (string): table being loaded
+        incoming_rows (int): number of rows the load adds
+
+    Yields:
+        bulk (bool): whether the load runs in bulk mode
+    '''
+    if not use_bulk_mode(incoming_rows, get_table_row_estimate(db, table_name)):
+        yield False
+        return
+
+    indexes = get_secondary_indexes(db, table_name)
+    for name, _ in indexes:
+        db.run(f'DROP INDEX "{name}"')
+    yield True
+    for _, definition in indexes:
+        db.run(definition)
+    db.run(f'ANALYZE "{table_name}"')
+
+
+def copy_dataframe(db, table_name, df, columns, own_transaction=True):
+    '''
+    Bulk loads a dataframe into a warehouse table with COPY ... FROM STDIN,
+    inside one transaction. The dataframe is encoded as CSV by polars, so
+    nulls are sent as NULL and quotes/commas are escaped by the encoder.
+
+    Args:
+        db (Connection): warehouse connection
+        table_name (string): table to load
+        df (DataFrame): rows to load, columns in the same order as columns
+        columns (list): warehouse column names
+        own_transaction (bool): False when the caller owns the transaction
+    '''
+    with transaction(db) if own_transaction else nullcontext():
+        _copy_csv(db, table_name, df, columns)
+
+
+def upsert_dataframe(
+    db, table_name, df, columns, key_columns, update=True, own_transaction=True
+):
+    '''
+    Upserts a dataframe into a warehouse dimension in one transaction: the rows
+    are copied into a temporary staging table, then merged with one
+    INSERT ... ON CONFLICT DO UPDATE. Existing rows are only updated when their
+    content changed, so re-loading the same rows is a no-op.
+
+    Args:
+        db (Connection): warehouse connection
+        table_name (string): dimension to load
+        df (DataFrame): rows to load, columns in the same order as columns
+        columns (list): warehouse column names
+        key_columns (list): primary key columns of the dimension
+        update (bool): False only inserts new keys (ON CONFLICT DO NOTHING)
+        own_transaction (bool): False when the caller owns the transaction,
+            the staging table is then dropped as soon as it is merged
+    '''
+    # a key may only be upserted once per statement, the last row wins
+    df = df.unique(subset=key_columns, keep="last", maintain_order=True)
+    staging_table = f"staging_{table_name}"
+    column_list = ", ".join(f'"{column}"' for column in columns)
+    key_list = ", ".join(f'"{column}"' for column in key_columns)
+    value_columns = [column for column in columns if column not in key_columns]
+
+    with transaction(db) if own_transaction else nullcontext():
+        db.run(
+            f'CREATE TEMPORARY TABLE "{staging_table}" '
+            f'(LIKE "{table_name}" INCLUDING DEFAULTS) ON COMMIT DROP'
+        )
+        _copy_csv(db, staging_table, df, columns)
+        if update and value_columns:
+            updates = ", ".join(
+                f'"{column}" = EXCLUDED."{column}"' for column in value_columns
+            )
+            current = ", ".join(f'"{table_name}"."{column}"' for column in value_columns)
+            excluded = ", ".join(f'EXCLUDED."{column}"' for column in value_columns)
+            conflict = (
+                f"DO UPDATE SET {updates} "
+                f"WHERE ROW({current}) IS DISTINCT FROM ROW({excluded})"
+            )
+        else:
+            conflict = "DO NOTHING"
+        db.run(
+            f'INSERT INTO "{table_name}" ({column_list}) '
+            f'SELECT {column_list} FROM "{staging_table}" '
+            f"ON CONFLICT ({key_list}) {conflict}"
+        )
+        if not own_transaction:
+            db.run(f'DROP TABLE "{staging_table}"')
+
+
+def time_prefix_datetime(time_prefix):
+    '''
+    Returns the datetime of a YYYY/MM/DD/HH:MM:SS time prefix, the time its
+    data was extracted.
+    '''
+    return dt.datetime.strptime(time_prefix.strip("/"), "%Y/%m/%d/%H:%M:%S")
+
+
+def add_row_hash(df, key_column):
+    '''
+    Adds a row_hash column to the rows of a dimension: a 64 bit hash of every
+    column but the key, computed for the whole frame at once. Categorical
+    columns are hashed as strings, a Categorical hashes by its category index,
+    which depends on the order the categories were met in.
+    '''
+    attributes = [column for column in df.columns if column != key_column]
+    values = df.select(attributes).with_columns(pl.col(pl.Categorical).cast(pl.String))
+    return df.with_columns(
+        values.select(
+            pl.struct(attributes).hash(*ROW_HASH_SEEDS).reinterpret(signed=True)
+        ).to_series().alias("row_hash")
+    )
+
+
+def get_current_hashes(db, table_name, key_column):
+    '''
+    Returns the key and row_hash of the current version of every row of a
+    type 2 dimension.
+    '''
+    rows = db.run(
+        f'SELECT "{key_column}", "row_hash" FROM "{table_name}" WHERE "is_current"'
+    )
+    return pl.DataFrame(
+        rows, schema={key_column: pl.Int64, "row_hash": pl.Int64}, orient="row"
+    )
+
+
+def merge_scd2_dimension(
+    db, table_name, df, columns, key_column, valid_from, own_transaction=True
+):
+    '''
+    Loads rows into a slowly changing dimension of type 2. The incoming rows
+    are hashed and compared with the hashes of the current warehouse rows, so
+    only new and changed rows are staged. One statement then expires the
+    current version of every changed row and inserts the new versions, valid
+    from valid_from. The first version of a row is valid from -infinity, so
+    facts created before the row was first loaded still find a version.
+
+    The hash only filters the rows to send: the statement compares the
+    columns themselves, and a current row whose columns are unchanged but
+    whose hash differs (a new polars version) only gets its hash refreshed.
+
+    Args:
+        db (Connection): warehouse connection
+        table_name (string): dimension to load
+        df (DataFrame): rows to load
+        columns (list): warehouse column names, the natural key included
+        key_column (string): natural key of the dimension
+        valid_from (datetime): time the incoming versions start being valid
+        own_transaction (bool): False when the caller owns the transaction,
+            the staging table is then dropped as soon as it is merged
+
+    Returns:
+        staged (int): number of new and changed rows
+    '''
+    df = df.select(columns).unique(subset=[key_column], keep="last", maintain_order=True)
+    df = add_row_hash(df, key_column)
+    current = get_current_hashes(db, table_name, key_column).with_columns(
+        pl.col(key_column).cast(df.schema[key_column])
+    )
+    df = df.join(current, on=[key_column, "row_hash"], how="anti")
+    if df.is_empty():
+        return 0
+
+    staging_table = f"staging_{table_name}"
+    staged_columns = columns + ["row_hash"]
+    column_list = ", ".join(f'"{column}"' for column in staged_columns)
+    staged_list = ", ".join(f's."{column}"' for column in staged_columns)
+    attributes = [column for column in columns if column != key_column]
+    current_row = ", ".join(f'd."{column}"' for column in attributes)
+    staged_row = ", ".join(f's."{column}"' for column in attributes)
+    same_key = f'd."{key_column}" = s."{key_column}" AND d."is_current"'
+
+    with transaction(db) if own_transaction else nullcontext():
+        db.run(
+            f'CREATE TEMPORARY TABLE "{staging_table}" ON COMMIT DROP AS '
+            f'SELECT {column_list} FROM "{table_name}" WITH NO DATA'
+        )
+        _copy_csv(db, staging_table, df.select(staged_columns), staged_columns)
+        db.run(
+            f'WITH "expired" AS ('
+            f'UPDATE "{table_name}" AS d SET "valid_to" = :valid_from, "is_current" = false '
+            f'FROM "{staging_table}" AS s WHERE {same_key} '
+            f"AND ROW({current_row}) IS DISTINCT FROM ROW({staged_row}) "
+            f'RETURNING d."{key_column}"'
+            f'), "rehashed" AS ('
+            f'UPDATE "{table_name}" AS d SET "row_hash" = s."row_hash" '
+            f'FROM "{staging_table}" AS s WHERE {same_key} '
+            f"AND ROW({current_row}) IS NOT DISTINCT FROM ROW({staged_row})"
+            f') '
+            f'INSERT INTO "{table_name}" ({column_list}, "valid_from", "is_current") '
+            f'SELECT {staged_list}, '
+            f'CASE WHEN s."{key_column}" IN (SELECT "{key_column}" FROM "expired") '
+            f"THEN CAST(:valid_from AS timestamp) ELSE '-infinity' END, true "
+            f'FROM "{staging_table}" AS s '
+            f'WHERE s."{key_column}" IN (SELECT "{key_column}" FROM "expired") '
+            f'OR NOT EXISTS (SELECT 1 FROM "{table_name}" AS d WHERE {same_key})',
+            valid_from=valid_from
+        )
+        if not own_transaction:
+            db.run(f'DROP TABLE "{staging_table}"')
+    return df.height
+
+
+def merge_aggregates(
+    db, table_name, df, key_columns, measure_columns, own_transaction=True
+):
+    '''
+    Adds aggregated rows to a summary table: the rows are copied into a
+    temporary staging table, then merged with one INSERT ... ON CONFLICT DO
+    UPDATE that adds every measure to the existing row of the same key.
+
+    Args:
+        db (Connection): warehouse connection
+        table_name (string): summary table to merge into
+        df (DataFrame): one row per key, key columns then measure columns
+        key_columns (list): primary key columns of the summary
+        measure_columns (list): additive columns of the summary
+        own_transaction (bool): False when the caller owns the transaction,
+            the staging table is then dropped as soon as it is merged
+    '''
+    staging_table = f"staging_{table_name}"
+    columns = key_columns + measure_columns
+    column_list = ", ".join(f'"{column}"' for column in columns)
+    key_list = ", ".join(f'"{column}"' for column in key_columns)
+    additions = ", ".join(
+        f'"{column}" = "{table_name}"."{column}" + EXCLUDED."{column}"'
+        for column in measure_columns
+    )
+
+    with transaction(db) if own_transaction else nullcontext():
+        db.run(
+            f'CREATE TEMPORARY TABLE "{staging_table}" '
+            f'(LIKE "{table_name}" INCLUDING DEFAULTS) ON COMMIT DROP'
+        )
+        _copy_csv(db, staging_table, df.select(columns), columns)
+        db.run(
+            f'INSERT INTO "{table_name}" ({column_list}) '
+            f'SELECT {column_list} FROM "{staging_table}" '
+            f"ON CONFLICT ({key_list}) DO UPDATE SET {additions}"
+        )
+        if not own_transaction:
+            db.run(f'DROP TABLE "{staging_table}"')
+
+
+def unload_fact_prefix(db, time_prefix):
+    '''
+    Removes the fact rows loaded from a time prefix and subtracts their sums
+    from the daily sales summaries, so a prefix whose file changed can be
+    loaded again without being counted twice. The caller owns the
+    transaction.
+
+    Args:
+        db (Connection): warehouse connection
+        time_prefix (string): time prefix the rows were loaded from
+    '''
+    for summary, (fact_column, key_column) in SALES_SUMMARIES.items():
+        column_list = ", ".join(
+            f'"{column}"' for column in ["sales_date", key_column] + SALES_MEASURES
+        )
+        additions = ", ".join(
+            f'"{column}" = "{summary}"."{column}" + EXCLUDED."{column}"'
+            for column in SALES_MEASURES
+        )
+        db.run(
+            f'INSERT INTO "{summary}" ({column_list}) '
+            f'SELECT "created_date", "{fact_column}", -count(*), -sum("units_sold"), '
+            f'-sum("units_sold" * "unit_price") FROM "fact_sales_order" '
+            f'WHERE "load_time_prefix" = :time_prefix GROUP BY 1, 2 '
+            f'ON CONFLICT ("sales_date", "{key_column}") DO UPDATE SET {additions}',
+            time_prefix=time_prefix
+        )
+    db.run(
+        'DELETE FROM "fact_sales_order" WHERE "load_time_prefix" = :time_prefix',
+        time_prefix=time_prefix
+    )
+
+
+def aggregate_daily_sales(df, fact_column, key_column):
+    '''
+    Returns the daily sales of fact rows by one of their references: the
+    number of rows, units sold and sales value (units sold * unit price) per
+    created_date and key. Partial aggregates can be combined with
+    combine_daily_sales.
+
+    The sales value is summed as a decimal of the warehouse's numeric(10, 2)
+    unit price, so it matches the sums unload_fact_prefix subtracts in SQL
+    exactly and loading then unloading a prefix leaves no residue.
+    '''
+    return df.group_by(
+        pl.col("created_date").cast(pl.Date).alias("sales_date"),
+        pl.col(fact_column).alias(key_column),
+    ).agg(
+        pl.len().cast(pl.Int64).alias("order_count"),
+        pl.col("units_sold").cast(pl.Int64).sum(),
+        (
+            pl.col("units_sold").cast(pl.Decimal(scale=0))
+            * pl.col("unit_price").round(2).cast(pl.Decimal(scale=2))
+        ).sum().alias("sales_value"),
+    )
+
+
+def combine_daily_sales(partials, key_column):
+    '''
+    Combines partial daily sales of the same summary into one row per key.
+    '''
+    return pl.concat(partials).group_by("sales_date", key_column).agg(
+        pl.col(SALES_MEASURES).sum()
+    ).sort("sales_date", key_column)
+
 
-    processed_data_bucket = find_processed_data_bucket()
+def read_fact_sales_order(s3_client, processed_data_bucket, time_prefix):
+    '''
+    Reads fact_sales_order for a time prefix from the processed data bucket.
+    Handles both the single-file layout and the hive-partitioned layout
+    (fact_sales_order/year=YYYY/month=MM/*.parquet) written by transform.
+    '''
     try:
         res = s3_client.get_object(
             Bucket=processed_data_bucket,
             Key=f'/history/{time_prefix}/fact_sales_order.parquet'
         )
-        parquet_data = res["Body"].read()
+        return pl.read_parquet(BytesIO(res["Body"].read()))
     except ClientError as e:
-        logging.error(f"Failed to get parquet file: {e}")
-        return f"Failed to get parquet file: {e}"
+        if e.response["Error"]["Code"] not in ("NoSuchKey", "404"):
+            raise
 
-    parquet_data_buffer = BytesIO(parquet_data)
-    df = pl.read_parquet(parquet_data_buffer)
+    paginator = s3_client.get_paginator("list_objects_v2")
+    partition_prefix = f'/history/{time_prefix}/fact_sales_order/'
+    partitions = []
+    for page in paginator.paginate(
+        Bucket=processed_data_bucket, Prefix=partition_prefix
+    ):
+        for obj in page.get("Contents", []):
+            if obj["Key"].endswith(".parquet"):
+                res = s3_client.get_object(
+                    Bucket=processed_data_bucket, Key=obj["Key"]
+                )
+                partitions.append(pl.read_parquet(BytesIO(res["Body"].read())))
+    if not partitions:
+        raise ClientError(
+            {"Error": {"Code": "NoSuchKey", "Message": partition_prefix}},
+            "GetObject"
+        )
+    return pl.concat(partitions)
+
+
+def read_processed_table(s3_client, processed_data_bucket, time_prefix, table_name):
+    '''
+    Reads a table written by transform for a time prefix.
+
+    If transform wrote an uncompressed Arrow IPC copy of the table
+    (/history/{time_prefix}/{table_name}.arrow), it is downloaded once to
+    ipc_cache_dir(time_prefix) and read through a memory map, so there is no
+    decode and no copy of the data. The local copy is named after the ETag of
+    the object, so a table rewritten under the same prefix is downloaded
+    again. Otherwise the parquet file is read from the bucket.
+    '''
+    key = f'/history/{time_prefix}/{table_name}.arrow'
+    try:
+        etag = s3_client.head_object(Bucket=processed_data_bucket, Key=key)["ETag"]
+    except ClientError as e:
+        if e.response["Error"]["Code"] not in ("NoSuchKey", "404"):
+            raise
+        etag = None
+    if etag is not None:
+        version = etag.strip('"')
+        local_path = os.path.join(
+            ipc_cache_dir(time_prefix), f"{table_name}.{version}.arrow"
+        )
+        if not os.path.exists(local_path):
+            os.makedirs(os.path.dirname(local_path), exist_ok=True)
+            s3_client.download_file(
+                Bucket=processed_data_bucket, Key=key, Filename=local_path
+            )
+        return pl.read_ipc(local_path, memory_map=True)
+
+    if table_name == "fact_sales_order":
+        return read_fact_sales_order(s3_client, processed_data_bucket, time_prefix)
+    res = s3_client.get_object(
+        Bucket=processed_data_bucket,
+        Key=f'/history/{time_prefix}/{table_name}.parquet'
+    )
+    return pl.read_parquet(BytesIO(res["Body"].read()))
+
+
+def ipc_cache_dir(time_prefix):
+    '''
+    Returns the local directory the Arrow IPC tables of a time prefix are
+    cached in.
+    '''
+    return os.path.join(LOAD_CACHE_DIR, "ipc", time_prefix)
+
+
+def stream_dir(time_prefix):
+    '''
+    Returns the local directory streamed tables of a time prefix are
+    downloaded to.
+    '''
+    return os.path.join(LOAD_CACHE_DIR, "stream", time_prefix)
+
+
+def _ensure_disk_space(directory, size):
+    free = shutil.disk_usage(directory).free
+    if size > free:
+        logging.error(
+            f"{size} bytes do not fit in the {free} bytes free in {directory}"
+        )
+        raise Exception("Not enough local disk for processed table")
+
+
+def _download_if_exists(s3_client, processed_data_bucket, key, local_path):
+    os.makedirs(os.path.dirname(local_path), exist_ok=True)
+    try:
+        size = s3_client.head_object(
+            Bucket=processed_data_bucket, Key=key
+        )["ContentLength"]
+        _ensure_disk_space(os.path.dirname(local_path), size)
+        s3_client.download_file(
+            Bucket=processed_data_bucket, Key=key, Filename=local_path
+        )
+        return True
+    except ClientError as e:
+        if e.response["Error"]["Code"] not in ("NoSuchKey", "404"):
+            raise
+        return False
+
+
+def scan_processed_table(s3_client, processed_data_bucket, time_prefix, table_name):
+    '''
+    Downloads a table written by transform to stream_dir(time_prefix) and
+    returns a LazyFrame over the local copy, so it can be read LOAD_BATCH_ROWS
+    rows at a time. download_file streams the object to disk in chunks, so the
+    table is never held in memory whole.
+
+    The whole table is downloaded before the first batch is read: its Arrow
+    IPC copy when transform writes one (uncompressed, several times the parquet
+    size), otherwise its parquet files. Before downloading, the size of the
+    objects is checked against the free space of LOAD_CACHE_DIR, so a table too
+    large for it fails the load up front instead of part way through a copy.
+    On Lambda LOAD_CACHE_DIR is under /tmp, sized by load_ephemeral_storage_mb
+    in terraform. The copy is removed when load_time_prefix finishes.
+
+    Reads the Arrow IPC copy if there is one (memory mapped), otherwise the
+    parquet file or, for fact_sales_order, its hive partitions.
+    '''
+    local_dir = os.path.join(stream_dir(time_prefix), table_name)
+    for suffix, scan in ((".arrow", pl.scan_ipc), (".parquet", pl.scan_parquet)):
+        local_path = local_dir + suffix
+        if _download_if_exists(
+            s3_client, processed_data_bucket,
+            f'/history/{time_prefix}/{table_name}{suffix}', local_path
+        ):
+            return scan(local_path)
+
+    paginator = s3_client.get_paginator("list_objects_v2")
+    partition_prefix = f'/history/{time_prefix}/{table_name}/'
+    partitions = [
+        obj
+        for page in paginator.paginate(
+            Bucket=processed_data_bucket, Prefix=partition_prefix
+        )
+        for obj in page.get("Contents", [])
+        if obj["Key"].endswith(".parquet")
+    ]
+    if not partitions:
+        raise ClientError(
+            {"Error": {"Code": "NoSuchKey", "Message": partition_prefix}},
+            "GetObject"
+        )
+    os.makedirs(local_dir, exist_ok=True)
+    _ensure_disk_space(local_dir, sum(obj["Size"] for obj in partitions))
+    local_paths = []
+    for obj in partitions:
+        local_path = os.path.join(local_dir, obj["Key"][len(partition_prefix):])
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        s3_client.download_file(
+            Bucket=processed_data_bucket, Key=obj["Key"], Filename=local_path
+        )
+        local_paths.append(local_path)
+    return pl.scan_parquet(sorted(local_paths), hive_partitioning=False)
+
+
+def iter_batches(source, batch_rows=LOAD_BATCH_ROWS):
+    '''
+    Yields a LazyFrame as DataFrames of at most batch_rows rows. Slices are
+    pushed down into the scan, so each batch only decodes the row groups it
+    overlaps.
+    '''
+    total_rows = source.select(pl.len()).collect().item()
+    for offset in range(0, total_rows, batch_rows):
+        yield source.slice(offset, batch_rows).collect()
+
+
+def get_warehouse_keys(db, table_name, key_column):
+    '''
+    Returns every key of a warehouse dimension, fetched in one query.
+    '''
+    rows = db.run(f'SELECT "{key_column}" FROM "{table_name}"')
+    return pl.Series(key_column, [row[0] for row in rows])
+
+
+def split_fact_references(df, key_sets):
+    '''
+    This function splits fact rows into rows whose references all exist in
+    the warehouse and rows to quarantine, checking every reference column of
+    the whole dataframe at once.
+
+    Args:
+        df (DataFrame): fact rows
+        key_sets (dict): reference column -> Series of existing keys
+
+    Returns:
+        loadable (DataFrame): rows with every reference present
+        quarantined (DataFrame): the other rows, with a missing_references
+            column listing the reference columns that were not found
+    '''
+    missing = [
+        pl.when(~pl.col(column).is_in(keys.cast(df.schema[column])))
+        .then(pl.lit(column))
+        for column, keys in key_sets.items()
+    ]
+    flagged = df.with_columns(
+        pl.concat_list(missing).list.drop_nulls().alias("missing_references")
+    )
+    has_missing = pl.col("missing_references").list.len() > 0
+    loadable = flagged.filter(~has_missing).drop("missing_references")
+    return loadable, flagged.filter(has_missing)
+
+
+def get_fact_key_sets(db):
+    '''
+    Returns the key set of every dimension fact_sales_order references, by
+    reference column.
+    '''
+    return {
+        column: get_warehouse_keys(db, table_name, key_column)
+        for column, (table_name, key_column) in FACT_REFERENCES.items()
+    }
+
+
+def check_fact_references(db, df):
+    '''
+    Fetches the key set of every dimension fact_sales_order references once
+    and splits the fact rows with split_fact_references.
+    '''
+    return split_fact_references(df, get_fact_key_sets(db))
+
+
+def put_quarantined_rows(s3_client, processed_data_bucket, time_prefix, table_name, df):
+    '''
+    Writes rows that could not be loaded to
+    /quarantine/{time_prefix}/{table_name}.parquet in the processed data bucket.
+    '''
+    buffer = BytesIO()
+    df.write_parquet(buffer)
+    s3_client.put_object(
+        Body=buffer.getvalue(),
+        Bucket=processed_data_bucket,
+        Key=f"{QUARANTINE_PATH}{time_prefix}/{table_name}.parquet"
+    )
+
+
+def get_processed_table_etag(s3_client, processed_data_bucket, time_prefix, table_name):
+    '''
+    Returns the ETag of the file read_processed_table reads for a table. For
+    a partitioned fact_sales_order it is a checksum of the partition ETags.
+    '''
+    for suffix in (".arrow", ".parquet"):
+        try:
+            return s3_client.head_object(
+                Bucket=processed_data_bucket,
+                Key=f'/history/{time_prefix}/{table_name}{suffix}'
+            )["ETag"]
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in ("NoSuchKey", "404"):
+                raise
+
+    paginator = s3_client.get_paginator("list_objects_v2")
+    partition_prefix = f'/history/{time_prefix}/{table_name}/'
+    etags = sorted(
+        f'{obj["Key"]}:{obj["ETag"]}'
+        for page in paginator.paginate(
+            Bucket=processed_data_bucket, Prefix=partition_prefix
+        )
+        for obj in page.get("Contents", [])
+    )
+    if not etags:
+        raise ClientError(
+            {"Error": {"Code": "NoSuchKey", "Message": partition_prefix}},
+            "HeadObject"
+        )
+    return hashlib.sha256("\n".join(etags).encode()).hexdigest()
+
+
+def get_loaded_etag(db, time_prefix, table_name):
+    '''
+    Returns the ETag of the file last loaded into a table for a time prefix,
+    or None if the table has not been loaded for it.
+    '''
+    rows = db.run(
+        'SELECT "etag" FROM "load_ledger" '
+        'WHERE "time_prefix" = :time_prefix AND "table_name" = :table_name',
+        time_prefix=time_prefix, table_name=table_name
+    )
+    return rows[0][0] if rows else None
+
+
+def record_load(db, time_prefix, table_name, etag, row_count):
+    '''
+    Records in load_ledger that a table has been loaded for a time prefix.
+    Run in the transaction that loaded the table, so the entry is committed
+    with the data or not at all.
+    '''
+    db.run(
+        'INSERT INTO "load_ledger" '
+        '("time_prefix", "table_name", "etag", "row_count", "completed_at") '
+        'VALUES (:time_prefix, :table_name, :etag, :row_count, now()) '
+        'ON CONFLICT ("time_prefix", "table_name") DO UPDATE SET '
+        '"etag" = EXCLUDED."etag", "row_count" = EXCLUDED."row_count", '
+        '"completed_at" = EXCLUDED."completed_at"',
+        time_prefix=time_prefix, table_name=table_name,
+        etag=etag, row_count=row_count
+    )
+
+
+def fact_partition_name(month):
+    '''
+    Returns the name of the fact_sales_order partition of a month.
+    '''
+    return f"fact_sales_order_y{month.year}m{month.month:02d}"
+
+
+def ensure_fact_partitions(db, months):
+    '''
+    Creates the monthly fact_sales_order partitions that do not exist yet,
+    with their FACT_PARTITION_INDEXES.
+
+    Args:
+        db (Connection): warehouse connection
+        months (list): first day of every month to create a partition for
+    '''
+    for month in months:
+        partition = fact_partition_name(month)
+        next_month = (month.replace(day=28) + dt.timedelta(days=4)).replace(day=1)
+        db.run(
+            f'CREATE TABLE IF NOT EXISTS "{partition}" '
+            f'PARTITION OF "fact_sales_order" '
+            f"FOR VALUES FROM ('{month.isoformat()}') TO ('{next_month.isoformat()}')"
+        )
+        for column in FACT_PARTITION_INDEXES:
+            db.run(
+                f'CREATE INDEX IF NOT EXISTS "{partition}_{column}" '
+                f'ON "{partition}" ("{column}")'
+            )
+
+
+def _created_month():
+    return pl.col("created_date").cast(pl.Date).dt.truncate("1mo").alias("_month")
+
+
+def count_fact_rows_by_month(source):
+    '''
+    Returns month -> number of fact rows created in it, for a DataFrame or a
+    LazyFrame (only created_date is read).
+    '''
+    counts = source.lazy().group_by(_created_month()).len().collect()
+    return dict(zip(counts["_month"].to_list(), counts["len"].to_list()))
+
+
+@contextmanager
+def loading_fact_partitions(db, month_rows):
+    '''
+    Creates the missing monthly partitions of fact_sales_order and holds each
+    partition in the load mode (see bulk_load_mode) for the rows it receives
+    while the with block copies batches into them with copy_fact_batch.
+
+    Args:
+        db (Connection): warehouse connection, the caller owns the transaction
+        month_rows (dict): month -> number of rows the load adds to it
+    '''
+    ensure_fact_partitions(db, sorted(month_rows))
+    with ExitStack() as stack:
+        for month, rows in sorted(month_rows.items()):
+            stack.enter_context(bulk_load_mode(db, fact_partition_name(month), rows))
+        yield
+
+
+def copy_fact_batch(db, df, columns):
+    '''
+    Copies fact rows straight into their monthly partitions, one COPY per
+    month, so a load touches no other month.
+    '''
+    months = df.with_columns(_created_month()).partition_by(
+        "_month", as_dict=True, include_key=False, maintain_order=True
+    )
+    for (month,), rows in sorted(months.items()):
+        _copy_csv(db, fact_partition_name(month), rows, columns)
+
+
+def copy_fact_partitions(db, df, columns):
+    '''
+    This function copies fact rows into their monthly partitions of
+    fact_sales_order, creating missing partitions first. A month receiving
+    many rows is loaded in bulk mode.
+
+    Args:
+        db (Connection): warehouse connection, the caller owns the transaction
+        df (DataFrame): fact rows, columns in the same order as columns
+        columns (list): warehouse column names, including created_date
+    '''
+    with loading_fact_partitions(db, count_fact_rows_by_month(df)):
+        copy_fact_batch(db, df, columns)
+
+
+class TablePrefetcher:
+    '''
+    Fetches and decodes the tables of a time prefix on a background thread,
+    in the order they will be loaded, so the next tables are read from S3
+    while the current one is written to the warehouse. At most `depth`
+    tables are held fetched but not yet taken, which caps memory. Streamed
+    tables are only downloaded, and taken as a LazyFrame.
+
+    Every table must be taken or discarded, or the fetches behind it wait
+    for a free slot forever; stop ends the pipeline early.
+    '''
+
+    def __init__(
+        self, s3_client, processed_data_bucket, time_prefix, table_names,
+        depth=LOAD_PREFETCH_DEPTH
+    ):
+        self.time_prefix = time_prefix
+        self.futures = {table_name: Future() for table_name in table_names}
+        self._slots = threading.Semaphore(depth)
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._produce,
+            args=(s3_client, processed_data_bucket, list(self.futures.items())),
+            daemon=True,
+        )
+        self._thread.start()
+
+    def _produce(self, s3_client, processed_data_bucket, futures):
+        for table_name, future in futures:
+            while not self._slots.acquire(timeout=0.1):
+                if self._stopped.is_set():
+                    return
+            if not future.set_running_or_notify_cancel():
+                # discarded before it was fetched
+                self._slots.release()
+                continue
+            fetch = (
+                scan_processed_table if table_name in STREAMED_TABLES
+                else read_processed_table
+            )
+            try:
+                future.set_result(fetch(
+                    s3_client, processed_data_bucket, self.time_prefix, table_name
+                ))
+            except Exception as e:
+                future.set_exception(e)
+
+    def has(self, time_prefix, table_name):
+        return time_prefix == self.time_prefix and table_name in self.futures
+
+    def take(self, table_name):
+        '''
+        Waits for a table to be fetched and returns it.
+        '''
+        future = self.futures.pop(table_name)
+        try:
+            return future.result()
+        finally:
+            self._slots.release()
+
+    def discard(self, table_name):
+        '''
+        Frees the slot of a table that will not be taken.
+        '''
+        future = self.futures.pop(table_name, None)
+        if future is None or future.cancel():
+            return
+        future.exception()
+        self._slots.release()
+
+    def stop(self):
+        '''
+        Cancels the fetches not started yet and ends the background thread.
+        '''
+        self._stopped.set()
+        for future in list(self.futures.values()):
+            future.cancel()
+        self._thread.join()
+
+
+class LoadSession:
+    '''
+    One warehouse load run. The processed data bucket and the warehouse
+    credentials are looked up once, and every populate_* function given the
+    session loads through its one connection and one transaction: the run is
+    committed when the with block ends and rolled back as a unit if any load
+    raises.
+
+    Tables can be fetched from the bucket in the background by a
+    TablePrefetcher, and the session can be forked onto other connections
+    (see load_time_prefix).
+
+    Usage:
+        with LoadSession() as session:
+            populate_dim_staff(time_prefix, session)
+            populate_fact_sales(time_prefix, session)
+    '''
+
+    def __init__(self, s3_client=None, processed_data_bucket=None, credentials=None):
+        self.s3_client = s3_client or boto3.client("s3")
+        self.processed_data_bucket = (
+            processed_data_bucket or find_processed_data_bucket()
+        )
+        self.credentials = credentials or get_secret(
+            "totesys-data-warehouse-credentials-"
+        )
+        self.db = None
+        self.prefetcher = None
+
+    def fork(self, db):
+        '''
+        Returns a session sharing the bucket, credentials and prefetcher of
+        this one, loading through the given connection. The caller owns the
+        connection and its transaction.
+        '''
+        session = LoadSession(
+            self.s3_client, self.processed_data_bucket, self.credentials
+        )
+        session.prefetcher = self.prefetcher
+        session.db = db
+        return session
+
+    def prefetch(self, time_prefix, table_names):
+        '''
+        Starts fetching tables in the background, read_table then takes them
+        from the prefetcher instead of reading them again.
+        '''
+        self.prefetcher = TablePrefetcher(
+            self.s3_client, self.processed_data_bucket, time_prefix, table_names
+        )
+        return self.prefetcher
+
+    def __enter__(self):
+        self.db = connect_to_db(self.credentials)
+        self.db.run("START TRANSACTION")
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self.db.run("COMMIT" if exc_type is None else "ROLLBACK")
+        finally:
+            self.db.close()
+            self.db = None
+        return False
+
+    def table_etag(self, time_prefix, table_name):
+        '''
+        Returns the ETag of a table written by transform for a time prefix.
+        '''
+        return get_processed_table_etag(
+            self.s3_client, self.processed_data_bucket, time_prefix, table_name
+        )
+
+    def read_table(self, time_prefix, table_name):
+        '''
+        Reads a table written by transform for a time prefix.
+        '''
+        if self.prefetcher is not None and self.prefetcher.has(time_prefix, table_name):
+            return self.prefetcher.take(table_name)
+        return read_processed_table(
+            self.s3_client, self.processed_data_bucket, time_prefix, table_name
+        )
+
+    def scan_table(self, time_prefix, table_name):
+        '''
+        Returns a LazyFrame over a local copy of a table written by transform.
+        '''
+        if self.prefetcher is not None and self.prefetcher.has(time_prefix, table_name):
+            return self.prefetcher.take(table_name)
+        return scan_processed_table(
+            self.s3_client, self.processed_data_bucket, time_prefix, table_name
+        )
+
+    def done_with_table(self, time_prefix, table_name):
+        '''
+        Discards a prefetched table that was not read, e.g. already loaded.
+        '''
+        if self.prefetcher is not None and self.prefetcher.has(time_prefix, table_name):
+            self.prefetcher.discard(table_name)
+
+    def quarantine(self, time_prefix, table_name, df):
+        '''
+        Sets aside rows of a table that could not be loaded.
+        '''
+        put_quarantined_rows(
+            self.s3_client, self.processed_data_bucket, time_prefix, table_name, df
+        )
+
+
+class FrameLoadSession(LoadSession):
+    '''
+    A LoadSession reading the tables of the run from memory instead of the
+    processed data bucket, e.g. the tables built by transform in the same
+    process (see src/pipeline.py). Quarantined rows are kept in
+    self.quarantined, and also written to the bucket when one is given.
+
+    Usage:
+        load_time_prefix(time_prefix, session=FrameLoadSession(tables, credentials))
+    '''
+
+    def __init__(self, tables, credentials, s3_client=None, processed_data_bucket=None):
+        self.tables = tables
+        self.s3_client = s3_client
+        self.processed_data_bucket = processed_data_bucket
+        self.credentials = credentials
+        self.quarantined = {}
+        self.db = None
+        self.prefetcher = None
+
+    def fork(self, db):
+        session = FrameLoadSession(
+            self.tables, self.credentials, self.s3_client, self.processed_data_bucket
+        )
+        session.quarantined = self.quarantined
+        session.db = db
+        return session
+
+    def prefetch(self, time_prefix, table_names):
+        '''
+        The tables are already in memory, there is nothing to fetch.
+        '''
+        return None
+
+    def _table(self, table_name):
+        if table_name not in self.tables:
+            raise ClientError(
+                {"Error": {"Code": "NoSuchKey", "Message": table_name}}, "GetObject"
+            )
+        return self.tables[table_name]
+
+    def table_etag(self, time_prefix, table_name):
+        '''
+        Returns a fingerprint of the content of a table, in place of an ETag.
+        '''
+        df = self._table(table_name)
+        digest = hashlib.sha256(",".join(df.columns).encode())
+        digest.update(df.hash_rows(*ROW_HASH_SEEDS).to_numpy().tobytes())
+        return digest.hexdigest()
+
+    def read_table(self, time_prefix, table_name):
+        return self._table(table_name)
+
+    def scan_table(self, time_prefix, table_name):
+        return self._table(table_name).lazy()
+
+    def quarantine(self, time_prefix, table_name, df):
+        self.quarantined[table_name] = df
+        if self.s3_client is not None:
+            super().quarantine(time_prefix, table_name, df)
+
+
+def uses_load_session(table_name):
+    '''
+    Lets the populate_* function of a table be called without a session, in
+    which case it opens a session of its own and commits on return. When the
+    function returns or raises, the table is released from the session's
+    prefetcher whether it was read or not.
+    '''
+    def decorator(populate):
+        @functools.wraps(populate)
+        def wrapper(time_prefix, session=None):
+            if session is None:
+                with LoadSession() as session:
+                    return populate(time_prefix, session)
+            try:
+                return populate(time_prefix, session)
+            finally:
+                session.done_with_table(time_prefix, table_name)
+        return wrapper
+    return decorator
+
+
+@uses_load_session("fact_sales_order")
+def populate_fact_sales(time_prefix, session=None):
+    '''
+    '''
+    # download fact_sales_order from bucket, unless this file has already been loaded
+    try:
+        etag = session.table_etag(time_prefix, "fact_sales_order")
+        loaded_etag = get_loaded_etag(session.db, time_prefix, "fact_sales_order")
+        if loaded_etag == etag:
+            return 'SQL table fact_sales_order already populated'
+        source = session.scan_table(time_prefix, "fact_sales_order")
+    except ClientError as e:
+        logging.error(f"Failed to get parquet file: {e}")
+        raise Exception(f"Failed to get parquet file: {e}")
 
     # reorder columns
     new_order = [
@@ -104,64 +1216,78 @@ def populate_fact_sales(time_prefix):
         "currency_id", "design_id", "agreed_payment_date",
         "agreed_delivery_date", "agreed_delivery_location_id"
     ]
-    df = df.select(new_order)
-    # convert the datetime column to string format
-    df = df.with_columns([
-        pl.col("created_date").cast(pl.String),
-        pl.col("created_time").cast(pl.String),
-        pl.col("last_updated_date").cast(pl.String),
-        pl.col("last_updated_time").cast(pl.String),
-        pl.col("agreed_payment_date").cast(pl.String),
-        pl.col("agreed_delivery_date").cast(pl.String)
-        ])
-    
-    
-    # insert into fact_sales_order table in data warehouse
+    source = source.select(new_order)
+
+    # the file changed since it was loaded: replace the rows loaded from it
+    if loaded_etag is not None:
+        unload_fact_prefix(session.db, time_prefix)
+
+    # copy batch by batch into the monthly partitions of fact_sales_order,
+    # setting aside rows referencing dimension keys missing from the warehouse
     try:
-        credentials = get_secret("totesys-data-warehouse-credentials-")
-        db = connect_to_db(credentials)
-        for row in df.iter_rows():
-            query = f'''INSERT INTO "fact_sales_order"
-                ("sales_order_id", "created_date",
-                "created_time", "last_updated_date", "last_updated_time",
-                "sales_staff_id", "counterparty_id", "units_sold",
-                "unit_price", "currency_id", "design_id",
-                "agreed_payment_date", "agreed_delivery_date",
-                "agreed_delivery_location_id"
+        key_sets = get_fact_key_sets(session.db)
+        loaded_rows = 0
+        quarantined = []
+        daily_sales = {summary: [] for summary in SALES_SUMMARIES}
+        with loading_fact_partitions(session.db, count_fact_rows_by_month(source)):
+            for df in iter_batches(source):
+                df, rejected = split_fact_references(df, key_sets)
+                if not rejected.is_empty():
+                    quarantined.append(rejected)
+                copy_fact_batch(
+                    session.db,
+                    df.with_columns(pl.lit(time_prefix).alias("load_time_prefix")),
+                    [
+                        "sales_order_id", "created_date",
+                        "created_time", "last_updated_date", "last_updated_time",
+                        "sales_staff_id", "counterparty_id", "units_sold",
+                        "unit_price", "currency_id", "design_id",
+                        "agreed_payment_date", "agreed_delivery_date",
+                        "agreed_delivery_location_id", "load_time_prefix"
+                    ]
                 )
-                VALUES
-                {row}
-                '''
-            db.run(query)
-        return 'SQL table fact_sales_order successfully populated'
-    except ClientError as e:
-        (e)
-        raise Exception('Could not update data warehouse')
+                loaded_rows += df.height
+                for summary, (fact_column, key_column) in SALES_SUMMARIES.items():
+                    daily_sales[summary].append(
+                        aggregate_daily_sales(df, fact_column, key_column)
+                    )
     finally:
-        if "db" in locals():
-            db.close()
+        shutil.rmtree(stream_dir(time_prefix), ignore_errors=True)
+
+    if quarantined:
+        quarantined = pl.concat(quarantined)
+        logging.warning(
+            f"Quarantined {quarantined.height} fact_sales_order rows with missing references"
+        )
+        session.quarantine(time_prefix, "fact_sales_order", quarantined)
 
+    # add the loaded rows to the daily sales summaries, in the same transaction
+    for summary, (_, key_column) in SALES_SUMMARIES.items():
+        if loaded_rows:
+            merge_aggregates(
+                session.db, summary,
+                combine_daily_sales(daily_sales[summary], key_column),
+                ["sales_date", key_column], SALES_MEASURES,
+                own_transaction=False
+            )
+    record_load(session.db, time_prefix, "fact_sales_order", etag, loaded_rows)
+    return 'SQL table fact_sales_order successfully populated'
 
-def populate_dim_staff(time_prefix):
+
+@uses_load_session("dim_staff")
+def populate_dim_staff(time_prefix, session=None):
     '''
     '''
-    # read dim_staff.parquet from bucket
-    s3_client = boto3.client("s3")
-
-    processed_data_bucket = find_processed_data_bucket()
+    # read dim_staff from bucket, unless this file has already been loaded
     try:
-        res = s3_client.get_object(
-            Bucket=processed_data_bucket,
-            Key=f'/history/{time_prefix}/dim_staff.parquet'
-        )
-        parquet_data = res["Body"].read()
+        etag = session.table_etag(time_prefix, "dim_staff")
+        if get_loaded_etag(session.db, time_prefix, "dim_staff") == etag:
+            return 'SQL table dim_staff already populated'
+        df = session.read_table(time_prefix, "dim_staff")
     except ClientError as e:
         logging.error(f"Failed to get parquet file: {e}")
-        return f"Failed to get parquet file: {e}"
+        raise Exception(f"Failed to get parquet file: {e}")
 
-    parquet_data_buffer = BytesIO(parquet_data)
-    df = pl.read_parquet(parquet_data_buffer)
-    
     # reorder columns
     new_order = [
         "staff_id", "first_name", "last_name", "department_name",
@@ -169,107 +1295,59 @@ def populate_dim_staff(time_prefix):
     ]
     df = df.select(new_order)
 
-    # insert into dim_staff table in data warehouse
-    try:
-        credentials = get_secret("totesys-data-warehouse-credentials-")
-        db = connect_to_db(credentials)
-        for row in df.iter_rows():
-            
-            row = [value.replace("'", "") if isinstance(value,str) else value for value in row]
-            row = tuple(row)
-            query = f'''INSERT INTO "dim_staff"
-                ("staff_id", "first_name", "last_name", "department_name",
-                "location", "email_address"
-                )
-                VALUES
-                {row}
-                '''
-            db.run(query)
-        return 'SQL table dim_staff successfully populated'
-    except ClientError as e:
-        (e)
-        raise Exception('Could not update data warehouse')
-    finally:
-        if "db" in locals():
-            db.close()
+    # version the new and changed staff, valid from the extraction time
+    merge_scd2_dimension(
+        session.db, "dim_staff", df, new_order, "staff_id",
+        time_prefix_datetime(time_prefix), own_transaction=False
+    )
+    record_load(session.db, time_prefix, "dim_staff", etag, df.height)
+    return 'SQL table dim_staff successfully populated'
 
 
-def populate_dim_date(time_prefix):
+@uses_load_session("dim_date")
+def populate_dim_date(time_prefix, session=None):
     '''
     '''
-    # read dim_date.parquet from bucket
-    s3_client = boto3.client("s3")
-
-    processed_data_bucket = find_processed_data_bucket()
+    # read dim_date from bucket, unless this file has already been loaded
     try:
-        res = s3_client.get_object(
-            Bucket=processed_data_bucket,
-            Key=f'/history/{time_prefix}/dim_date.parquet'
-        )
-        parquet_data = res["Body"].read()
+        etag = session.table_etag(time_prefix, "dim_date")
+        if get_loaded_etag(session.db, time_prefix, "dim_date") == etag:
+            return 'SQL table dim_date already populated'
+        df = session.read_table(time_prefix, "dim_date")
     except ClientError as e:
         logging.error(f"Failed to get parquet file: {e}")
-        return f"Failed to get parquet file: {e}"
+        raise Exception(f"Failed to get parquet file: {e}")
 
-    parquet_data_buffer = BytesIO(parquet_data)
-    df = pl.read_parquet(parquet_data_buffer)
-    
     # reorder columns
     new_order = [
         "date_id", "year", "month", "day", "day_of_week",
         "day_name", "month_name", "quarter"
     ]
-    df = df.select(new_order)
-    
-    df = df.with_columns(pl.col("date_id").cast(pl.String))
-    
-    # insert into dim_date table in data warehouse
-    try:
-        credentials = get_secret("totesys-data-warehouse-credentials-")
-        db = connect_to_db(credentials)
-        query_select = """SELECT * FROM dim_date"""
-        for row in df.iter_rows():
-            row_comparison = list(row)
-            row_comparison[0] = dt.date(*map(int, row_comparison[0].split('-')))
-            if row_comparison not in db.run(query_select):
-                query_insert = f'''INSERT INTO "dim_date"
-                    ("date_id", "year", "month", "day",
-                    "day_of_week", "day_name", "month_name", "quarter"
-                    )
-                    VALUES
-                    {row}
-                    '''
-                db.run(query_insert)
-        return 'SQL table dim_date successfully populated'
-    except ClientError as e:
-        (e)
-        raise Exception('Could not update data warehouse')
-    finally:
-        if "db" in locals():
-            db.close()
+    df = df.select(new_order).with_columns(pl.col("date_id").cast(pl.Date))
+
+    # insert the dates that are not in the dim_date table yet, in one statement
+    upsert_dataframe(
+        session.db, "dim_date", df, new_order, ["date_id"],
+        update=False, own_transaction=False
+    )
+    record_load(session.db, time_prefix, "dim_date", etag, df.height)
+    return 'SQL table dim_date successfully populated'
 
 
-def populate_dim_location(time_prefix):
+@uses_load_session("dim_location")
+def populate_dim_location(time_prefix, session=None):
     '''
     '''
-    # read dim_location.parquet from bucket
-    s3_client = boto3.client("s3")
-
-    processed_data_bucket = find_processed_data_bucket()
+    # read dim_location from bucket, unless this file has already been loaded
     try:
-        res = s3_client.get_object(
-            Bucket=processed_data_bucket,
-            Key=f'/history/{time_prefix}/dim_location.parquet'
-        )
-        parquet_data = res["Body"].read()
+        etag = session.table_etag(time_prefix, "dim_location")
+        if get_loaded_etag(session.db, time_prefix, "dim_location") == etag:
+            return 'SQL table dim_location already populated'
+        df = session.read_table(time_prefix, "dim_location")
     except ClientError as e:
         logging.error(f"Failed to get parquet file: {e}")
-        return f"Failed to get parquet file: {e}"
+        raise Exception(f"Failed to get parquet file: {e}")
 
-    parquet_data_buffer = BytesIO(parquet_data)
-    df = pl.read_parquet(parquet_data_buffer)
-    
-    
     # reorder columns
     new_order = [
         "location_id", "address_line_1", "address_line_2", "district", "city",
@@ -277,98 +1355,55 @@ def populate_dim_location(time_prefix):
     ]
     df = df.select(new_order)
 
-    # insert into dim_location table in data warehouse
-    try:
-        credentials = get_secret("totesys-data-warehouse-credentials-")
-        db = connect_to_db(credentials)
-        for row in df.iter_rows():
-            row = ["" if value is None else value for value in row]
-            row = [value.replace("'", "") if isinstance(value,str) else value for value in row]
-            row = tuple(row)
-            
-            query = f'''INSERT INTO "dim_location"
-                ("location_id","address_line_1", "address_line_2", "district", "city",
-                "postal_code", "country", "phone"
-                )
-                VALUES
-                {row}
-                '''
-            db.run(query)
-        return 'SQL table dim_location successfully populated'
-    except ClientError as e:
-        (e)
-        raise Exception('Could not update data warehouse')
-    finally:
-        if "db" in locals():
-            db.close()
+    # upsert into dim_location table in data warehouse
+    upsert_dataframe(
+        session.db, "dim_location", df, new_order, ["location_id"], own_transaction=False
+    )
+    record_load(session.db, time_prefix, "dim_location", etag, df.height)
+    return 'SQL table dim_location successfully populated'
 
 
-def populate_dim_currency(time_prefix):
+@uses_load_session("dim_currency")
+def populate_dim_currency(time_prefix, session=None):
     '''
     '''
-    # read dim_currency.parquet from bucket
-    s3_client = boto3.client("s3")
-
-    processed_data_bucket = find_processed_data_bucket()
+    # read dim_currency from bucket, unless this file has already been loaded
     try:
-        res = s3_client.get_object(
-            Bucket=processed_data_bucket,
-            Key=f'/history/{time_prefix}/dim_currency.parquet'
-        )
-        parquet_data = res["Body"].read()
+        etag = session.table_etag(time_prefix, "dim_currency")
+        if get_loaded_etag(session.db, time_prefix, "dim_currency") == etag:
+            return 'SQL table dim_currency already populated'
+        df = session.read_table(time_prefix, "dim_currency")
     except ClientError as e:
         logging.error(f"Failed to get parquet file: {e}")
-        return f"Failed to get parquet file: {e}"
+        raise Exception(f"Failed to get parquet file: {e}")
 
-    parquet_data_buffer = BytesIO(parquet_data)
-    df = pl.read_parquet(parquet_data_buffer)
-    
     # reorder columns
     new_order = [
         "currency_id", "currency_code", "currency_name"
     ]
     df = df.select(new_order)
 
-    # insert into dim_currency table in data warehouse
-    try:
-        credentials = get_secret("totesys-data-warehouse-credentials-")
-        db = connect_to_db(credentials)
-        for row in df.iter_rows():
-            query = f'''INSERT INTO "dim_currency"
-                ("currency_id", "currency_code", "currency_name"
-                )
-                VALUES
-                {row}
-                '''
-            db.run(query)
-        return 'SQL table dim_currency successfully populated'
-    except ClientError as e:
-        (e)
-        raise Exception('Could not update data warehouse')
-    finally:
-        if "db" in locals():
-            db.close()
+    # upsert into dim_currency table in data warehouse
+    upsert_dataframe(
+        session.db, "dim_currency", df, new_order, ["currency_id"], own_transaction=False
+    )
+    record_load(session.db, time_prefix, "dim_currency", etag, df.height)
+    return 'SQL table dim_currency successfully populated'
 
 
-def populate_dim_design(time_prefix):
+@uses_load_session("dim_design")
+def populate_dim_design(time_prefix, session=None):
     '''
     '''
-    # read dim_design.parquet from bucket
-    s3_client = boto3.client("s3")
-
-    processed_data_bucket = find_processed_data_bucket()
+    # read dim_design from bucket, unless this file has already been loaded
     try:
-        res = s3_client.get_object(
-            Bucket=processed_data_bucket,
-            Key=f'/history/{time_prefix}/dim_design.parquet'
-        )
-        parquet_data = res["Body"].read()
+        etag = session.table_etag(time_prefix, "dim_design")
+        if get_loaded_etag(session.db, time_prefix, "dim_design") == etag:
+            return 'SQL table dim_design already populated'
+        df = session.read_table(time_prefix, "dim_design")
     except ClientError as e:
         logging.error(f"Failed to get parquet file: {e}")
-        return f"Failed to get parquet file: {e}"
-
-    parquet_data_buffer = BytesIO(parquet_data)
-    df = pl.read_parquet(parquet_data_buffer)
+        raise Exception(f"Failed to get parquet file: {e}")
 
     # reorder columns
     new_order = [
@@ -376,46 +1411,27 @@ def populate_dim_design(time_prefix):
     ]
     df = df.select(new_order)
 
-    # insert into dim_design table in data warehouse
-    try:
-        credentials = get_secret("totesys-data-warehouse-credentials-")
-        db = connect_to_db(credentials)
-        for row in df.iter_rows():
-            query = f'''INSERT INTO "dim_design"
-                ("design_id","design_name", "file_location", "file_name"
-                )
-                VALUES
-                {row}
-                '''
-            db.run(query)
-        return 'SQL table dim_design successfully populated'
-    except ClientError as e:
-        (e)
-        raise Exception('Could not update data warehouse')
-    finally:
-        if "db" in locals():
-            db.close()
+    # upsert into dim_design table in data warehouse
+    upsert_dataframe(
+        session.db, "dim_design", df, new_order, ["design_id"], own_transaction=False
+    )
+    record_load(session.db, time_prefix, "dim_design", etag, df.height)
+    return 'SQL table dim_design successfully populated'
 
 
-def populate_dim_counterparty(time_prefix):
+@uses_load_session("dim_counterparty")
+def populate_dim_counterparty(time_prefix, session=None):
     '''
     '''
-    # read dim_counterparty.parquet from bucket
-    s3_client = boto3.client("s3")
-
-    processed_data_bucket = find_processed_data_bucket()
+    # read dim_counterparty from bucket, unless this file has already been loaded
     try:
-        res = s3_client.get_object(
-            Bucket=processed_data_bucket,
-            Key=f'/history/{time_prefix}/dim_counterparty.parquet'
-        )
-        parquet_data = res["Body"].read()
+        etag = session.table_etag(time_prefix, "dim_counterparty")
+        if get_loaded_etag(session.db, time_prefix, "dim_counterparty") == etag:
+            return 'SQL table dim_counterparty already populated'
+        df = session.read_table(time_prefix, "dim_counterparty")
     except ClientError as e:
         logging.error(f"Failed to get parquet file: {e}")
-        return f"Failed to get parquet file: {e}"
-
-    parquet_data_buffer = BytesIO(parquet_data)
-    df = pl.read_parquet(parquet_data_buffer)
+        raise Exception(f"Failed to get parquet file: {e}")
 
     # reorder columns
     new_order = [
@@ -425,32 +1441,91 @@ def populate_dim_counterparty(time_prefix):
         "counterparty_legal_country", "counterparty_legal_phone_number"
     ]
     df = df.select(new_order)
-    
-    ("dim_counterparty")
-    
-    # insert into dim_counterparty table in data warehouse
+
+    # version the new and changed counterparties, valid from the extraction time
+    merge_scd2_dimension(
+        session.db, "dim_counterparty", df, new_order, "counterparty_id",
+        time_prefix_datetime(time_prefix), own_transaction=False
+    )
+    record_load(session.db, time_prefix, "dim_counterparty", etag, df.height)
+    return 'SQL table dim_counterparty successfully populated'
+
+
+DIMENSION_LOADERS = [
+    populate_dim_location,
+    populate_dim_staff,
+    populate_dim_counterparty,
+    populate_dim_currency,
+    populate_dim_date,
+    populate_dim_design,
+]
+LOAD_TABLES = [
+    "dim_location", "dim_staff", "dim_counterparty", "dim_currency",
+    "dim_date", "dim_design", "fact_sales_order",
+]
+
+
+def _load_on_pool(connections, session, populate, time_prefix):
+    db = connections.get()
     try:
-        credentials = get_secret("totesys-data-warehouse-credentials-")
-        db = connect_to_db(credentials)
-        for row in df.iter_rows():
-            row = ["" if value is None else value for value in row]
-            row = [value.replace("'", "") if isinstance(value,str)  else value for value in row]
-            row = tuple(row)
-            
-            query = f'''INSERT INTO "dim_counterparty"
-                ("counterparty_id", "counterparty_legal_name", "counterparty_legal_address_line_1",
-                "counterparty_legal_address_line_2", "counterparty_legal_district",
-                "counterparty_legal_city", "counterparty_legal_postal_code",
-                "counterparty_legal_country", "counterparty_legal_phone_number"
-                )
-                VALUES
-                {row}
-                '''
-            db.run(query)
-        return 'SQL table dim_counterparty successfully populated'
-    except ClientError as e:
-        (e)
-        raise Exception('Could not update data warehouse')
+        with transaction(db):
+            return populate(time_prefix, session.fork(db))
+    finally:
+        connections.put(db)
+
+
+def load_time_prefix(time_prefix, parallelism=LOAD_PARALLELISM, session=None):
+    '''
+    This function loads every table of a time prefix into the data warehouse.
+
+    Tables are fetched from the processed data bucket and decoded in the
+    background, LOAD_PREFETCH_DEPTH tables ahead of the one being loaded. With
+    a parallelism of 1 the run is loaded through one connection in one
+    transaction. Otherwise the dimensions are loaded concurrently on a pool
+    of that many connections, each in a transaction of its own, and the fact
+    table is loaded once every dimension has committed. The dimension loads
+    are upserts, so a run that fails part way can simply be retried.
+
+    Args:
+        time_prefix (string): time prefix to load
+        parallelism (int): number of warehouse connections to load with
+        session (LoadSession): session to load with, one is created if None
+
+    Returns:
+        results (list): message returned by every populate_* function
+    '''
+    session = session or LoadSession()
+    # tables are fetched in the order they are loaded in, None if in memory
+    prefetcher = session.prefetch(time_prefix, LOAD_TABLES)
+    try:
+        if parallelism <= 1:
+            with session:
+                return [
+                    populate(time_prefix, session)
+                    for populate in DIMENSION_LOADERS + [populate_fact_sales]
+                ]
+
+        connections = queue.Queue()
+        try:
+            for _ in range(min(parallelism, len(DIMENSION_LOADERS))):
+                connections.put(connect_to_db(session.credentials))
+            with ThreadPoolExecutor(max_workers=connections.qsize()) as loaders:
+                futures = [
+                    loaders.submit(
+                        _load_on_pool, connections, session, populate, time_prefix
+                    )
+                    for populate in DIMENSION_LOADERS
+                ]
+                results = [future.result() for future in futures]
+            results.append(
+                _load_on_pool(connections, session, populate_fact_sales, time_prefix)
+            )
+            return results
+        finally:
+            while not connections.empty():
+                connections.get().close()
     finally:
-        if "db" in locals():
-            db.close()
+        if prefetcher is not None:
+            prefetcher.stop()
+        shutil.rmtree(stream_dir(time_prefix), ignore_errors=True)
+        shutil.rmtree(ipc_cache_dir(time_prefix), ignore_errors=True)
@@ -0,0 +1,105 @@
+"""
+Parquet writer settings for every table written by the transform lambda.
+
+Each entry can set:
+compression         - parquet codec (uncompressed, snappy, lz4, zstd, gzip, brotli)
+compression_level   - codec level, None uses the codec default
+row_group_size      - maximum rows per row group, None uses the polars default
+statistics          - False, True (min/max/null count) or "full"
+
+String columns need no setting for dictionary encoding: the polars writer
+already stores low cardinality string columns as dictionary pages, and readers
+get them back as String. Casting them to Categorical first gives the same file
+size but hands every reader a Categorical column.
+
+Tables not listed use DEFAULT_PARQUET_WRITER_SETTINGS. The values below follow
+the recommendations of `python -m benchmarks.parquet_writer`, except that
+fact_sales_order keeps full statistics so readers can prune row groups.
+"""
+
+import os
+
+
+DEFAULT_PARQUET_WRITER_SETTINGS = {
+    "compression": "zstd",
+    "compression_level": None,
+    "row_group_size": None,
+    "statistics": True,
+}
+
+PARQUET_WRITER_SETTINGS = {
+    "fact_sales_order": {
+        "compression": "zstd",
+        "compression_level": 3,
+        "row_group_size": int(os.getenv("FACT_SALES_ORDER_ROW_GROUP_SIZE", "100000")),
+        "statistics": "full",
+    },
+    "dim_date": {
+        "compression": "zstd",
+        "compression_level": 3,
+        "row_group_size": None,
+        "statistics": True,
+    },
+    "dim_staff": {
+        "compression": "snappy",
+        "compression_level": None,
+        "row_group_size": None,
+        "statistics": False,
+    },
+    "dim_location": {
+        "compression": "snappy",
+        "compression_level": None,
+        "row_group_size": None,
+        "statistics": False,
+    },
+    "dim_counterparty": {
+        "compression": "snappy",
+        "compression_level": None,
+        "row_group_size": None,
+        "statistics": False,
+    },
+    "dim_design": {
+        "compression": "snappy",
+        "compression_level": None,
+        "row_group_size": None,
+        "statistics": False,
+    },
+    "dim_currency": {
+        "compression": "uncompressed",
+        "compression_level": None,
+        "row_group_size": None,
+        "statistics": False,
+    },
+}
+
+
+def get_parquet_writer_settings(table_name):
+    """
+    Returns the parquet writer settings for a table, falling back to the
+    default settings for keys (or tables) that are not configured.
+    """
+    settings = dict(DEFAULT_PARQUET_WRITER_SETTINGS)
+    settings.update(PARQUET_WRITER_SETTINGS.get(table_name, {}))
+    return settings
+
+
+def write_table_parquet(df, table_name, file, settings=None):
+    """
+    Writes a dataframe to parquet using the settings configured for its table.
+
+    Args:
+        df (DataFrame): table to write
+        table_name (string): name of the table, used to look up its settings
+        file (string or BytesIO): destination path or buffer
+        settings (dict): overrides the configured settings (used by the benchmark)
+    """
+    if settings is None:
+        settings = get_parquet_writer_settings(table_name)
+
+    df.write_parquet(
+        file,
+        compression=settings["compression"],
+        compression_level=settings["compression_level"],
+        row_group_size=settings["row_group_size"],
+        statistics=settings["statistics"],
+    )
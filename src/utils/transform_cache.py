@@ -0,0 +1,126 @@
+"""
+Content-hash result cache for the transform lambda.
+
+A run is fingerprinted from the ETags of its input objects (the differences
+csv files plus the snapshot of the calendar the time prefix started from) and
+the star schema spec version. The processed data bucket keeps a small index of fingerprint ->
+output keys of the run that produced them, so a retry or a run with identical
+inputs can copy the previous outputs server side instead of recomputing them.
+
+PROCESSED DATA BUCKET STRUCTURE:
+cache/
+├─ transform_index.json
+"""
+
+import hashlib
+import json
+import logging
+from botocore.exceptions import ClientError
+
+
+TRANSFORM_CACHE_INDEX_KEY = "/cache/transform_index.json"
+TRANSFORM_CACHE_MAX_ENTRIES = 100
+
+
+def get_object_etag(s3_client, bucket, key):
+    """
+    Returns the ETag of an object, or None if the object does not exist.
+    """
+    try:
+        return s3_client.head_object(Bucket=bucket, Key=key)["ETag"]
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+            return None
+        raise
+
+
+def fingerprint_inputs(etags, version):
+    """
+    Hashes the ETags of every input and the spec version into one fingerprint.
+
+    Args:
+        etags (dict): input name -> ETag (None for inputs that do not exist)
+        version (string): version of the code/specs producing the outputs
+
+    Returns:
+        fingerprint (string): hex sha256 of the inputs
+    """
+    payload = json.dumps({"version": version, "etags": etags}, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def get_transform_cache_index(s3_client, processed_data_bucket):
+    """
+    Reads the cache index from the processed data bucket.
+
+    Returns:
+        index (dict): fingerprint -> {"prefix", "keys"}, empty if there is no index
+    """
+    try:
+        res = s3_client.get_object(
+            Bucket=processed_data_bucket, Key=TRANSFORM_CACHE_INDEX_KEY
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+            return {}
+        logging.error(e)
+        raise Exception("Failed to get transform cache index")
+    return json.loads(res["Body"].read())
+
+
+def put_transform_cache_entry(
+    s3_client, processed_data_bucket, index, fingerprint, prefix, keys
+):
+    """
+    Records the outputs of a run in the cache index. Only the most recent
+    TRANSFORM_CACHE_MAX_ENTRIES runs are kept.
+
+    Args:
+        s3_client (boto3 client): S3 client used to write the index
+        processed_data_bucket (string): name of the processed data bucket
+        index (dict): cache index read at the start of the run
+        fingerprint (string): fingerprint of the run's inputs
+        prefix (string): time prefix of the run
+        keys (list): S3 keys of every output written by the run
+    """
+    index.pop(fingerprint, None)
+    index[fingerprint] = {"prefix": prefix, "keys": sorted(keys)}
+    for stale in list(index)[:-TRANSFORM_CACHE_MAX_ENTRIES]:
+        del index[stale]
+    s3_client.put_object(
+        Body=json.dumps(index),
+        Bucket=processed_data_bucket,
+        Key=TRANSFORM_CACHE_INDEX_KEY,
+    )
+
+
+def copy_cached_outputs(s3_client, processed_data_bucket, entry, prefix):
+    """
+    Copies the outputs of a cached run to the current time prefix with server
+    side copies. Nothing is copied when the cached run has the same prefix
+    (a retry), as its outputs are already in place.
+
+    Args:
+        s3_client (boto3 client): S3 client used to copy the objects
+        processed_data_bucket (string): name of the processed data bucket
+        entry (dict): cache index entry of the previous run
+        prefix (string): time prefix of the current run
+
+    Returns:
+        keys (list): S3 keys of the outputs for the current prefix
+    """
+    old_root = f"/history/{entry['prefix']}/"
+    new_root = f"/history/{prefix}/"
+    if old_root == new_root:
+        return entry["keys"]
+
+    keys = []
+    for old_key in entry["keys"]:
+        new_key = new_root + old_key[len(old_root):]
+        s3_client.copy_object(
+            Bucket=processed_data_bucket,
+            Key=new_key,
+            CopySource={"Bucket": processed_data_bucket, "Key": old_key},
+        )
+        keys.append(new_key)
+    return keys
@@ -0,0 +1,193 @@
+"""
+Declarative table-spec engine used by the transform lambda.
+
+Each output table is described by a spec (a dict):
+
+name       - name of the table produced
+inputs     - source tables or other specs' outputs; the first one is the base frame
+transform  - optional callable(frames) -> DataFrame that builds the base frame
+             from a dict of its inputs instead of taking inputs[0]
+joins      - list of {"right", "left_on", "right_on", "how"} joined onto the base
+derived    - list of polars expressions added with with_columns
+drops      - columns removed after the derived columns are added
+renames    - {old: new} column renames
+select     - final column order
+sort       - columns to sort by
+output     - False for intermediate tables that are not published (default True)
+
+run_table_specs builds the dependency DAG from the inputs and runs independent
+specs concurrently on a thread pool (polars releases the GIL while it works).
+Outputs are handed to on_ready as soon as they are built. With a metrics
+object (see transform_metrics) every build is recorded as a "build:{name}" stage.
+"""
+
+import logging
+import os
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+TRANSFORM_MAX_WORKERS = int(os.getenv("TRANSFORM_MAX_WORKERS", "4"))
+
+
+def build_table(spec, frames):
+    """
+    Builds one table from its spec.
+
+    Args:
+        spec (dict): table spec
+        frames (dict): every input named in the spec, name -> DataFrame
+
+    Returns:
+        df (DataFrame): the built table
+    """
+    if "transform" in spec:
+        df = spec["transform"](frames)
+    else:
+        df = frames[spec["inputs"][0]]
+
+    for join in spec.get("joins", []):
+        df = df.join(
+            frames[join["right"]],
+            left_on=join["left_on"],
+            right_on=join["right_on"],
+            how=join.get("how", "inner"),
+        )
+    if spec.get("derived"):
+        df = df.with_columns(spec["derived"])
+    if spec.get("drops"):
+        df = df.drop(spec["drops"])
+    if spec.get("renames"):
+        df = df.rename(spec["renames"])
+    if spec.get("select"):
+        df = df.select(spec["select"])
+    if spec.get("sort"):
+        df = df.sort(spec["sort"])
+    return df
+
+
+def table_spec_dependencies(specs, sources):
+    """
+    Works out which specs each spec depends on and checks the DAG is valid.
+
+    Args:
+        specs (list): table specs
+        sources (iterable): names of the source tables
+
+    Returns:
+        dependencies (dict): spec name -> set of spec names it depends on
+    """
+    spec_names = {spec["name"] for spec in specs}
+    sources = set(sources)
+    dependencies = {}
+    for spec in specs:
+        inputs = set(spec["inputs"]) | {j["right"] for j in spec.get("joins", [])}
+        unknown = inputs - spec_names - sources
+        if unknown:
+            raise Exception(f"Unknown inputs {sorted(unknown)} for {spec['name']}")
+        dependencies[spec["name"]] = inputs & spec_names
+
+    remaining = {name: set(deps) for name, deps in dependencies.items()}
+    while remaining:
+        ready = [name for name, deps in remaining.items() if not deps]
+        if not ready:
+            raise Exception(f"Cycle in table specs: {sorted(remaining)}")
+        for name in ready:
+            del remaining[name]
+        for deps in remaining.values():
+            deps.difference_update(ready)
+    return dependencies
+
+
+def specs_for_tables(specs, targets):
+    """
+    Returns the specs needed to build the target tables: the targets and every
+    spec they depend on, in their original order.
+
+    Args:
+        specs (list): table specs
+        targets (iterable): names of the tables to build
+
+    Returns:
+        specs (list): subset of specs
+    """
+    specs_by_name = {spec["name"]: spec for spec in specs}
+    needed = set()
+    pending = list(targets)
+    while pending:
+        name = pending.pop()
+        if name in needed or name not in specs_by_name:
+            continue
+        needed.add(name)
+        spec = specs_by_name[name]
+        pending.extend(spec["inputs"])
+        pending.extend(join["right"] for join in spec.get("joins", []))
+    return [spec for spec in specs if spec["name"] in needed]
+
+
+def _build_and_publish(spec, frames, on_ready, metrics=None):
+    stage = metrics.stage(f"build:{spec['name']}") if metrics else nullcontext({})
+    with stage as record:
+        df = build_table(spec, frames)
+        record["rows_in"] = sum(getattr(frame, "height", 0) for frame in frames.values())
+        record["rows_out"] = df.height
+    if on_ready is not None and spec.get("output", True):
+        on_ready(spec["name"], df)
+    return df
+
+
+def run_table_specs(
+    specs, sources, on_ready=None, max_workers=TRANSFORM_MAX_WORKERS, metrics=None
+):
+    """
+    Runs every spec once its inputs are available, with independent specs
+    running concurrently.
+
+    Args:
+        specs (list): table specs
+        sources (dict): source table name -> DataFrame
+        on_ready (callable): called as on_ready(name, df) in the worker thread as
+            soon as an output table is built, e.g. to write and upload it
+        max_workers (int): maximum number of specs built at the same time
+        metrics (TransformMetrics): records the build time and rows of every spec
+
+    Returns:
+        frames (dict): sources and every built table, name -> DataFrame
+    """
+    specs_by_name = {spec["name"]: spec for spec in specs}
+    pending = table_spec_dependencies(specs, sources)
+    frames = dict(sources)
+    running = {}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+
+        def submit_ready():
+            for name in [n for n, deps in pending.items() if deps <= frames.keys()]:
+                spec = specs_by_name.pop(name)
+                del pending[name]
+                inputs = set(spec["inputs"]) | {j["right"] for j in spec.get("joins", [])}
+                future = executor.submit(
+                    _build_and_publish,
+                    spec,
+                    {i: frames[i] for i in inputs},
+                    on_ready,
+                    metrics,
+                )
+                running[future] = name
+
+        submit_ready()
+        while running:
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    frames[name] = future.result()
+                except Exception as e:
+                    logging.error(f"Failed to build {name}: {e}")
+                    for other in running:
+                        other.cancel()
+                    raise
+            submit_ready()
+
+    return frames
+
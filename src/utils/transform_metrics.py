@@ -0,0 +1,128 @@
+"""
+Per-stage instrumentation for the transform lambda.
+
+Every stage records its wall time, rows in and out, bytes read and written and
+the peak RSS of the process when the stage finished (getrusage only exposes
+the peak so far, so a jump between stages points at the stage responsible).
+
+Metrics are emitted as CloudWatch Embedded Metric Format log lines (one per
+stage, with the stage name as dimension), returned in the handler result and
+can be printed as a table for local runs.
+"""
+
+import json
+import resource
+import threading
+import time
+from contextlib import contextmanager
+
+
+TRANSFORM_METRICS_NAMESPACE = "totesys/transform"
+METRIC_UNITS = {
+    "duration_ms": "Milliseconds",
+    "rows_in": "Count",
+    "rows_out": "Count",
+    "bytes_read": "Bytes",
+    "bytes_written": "Bytes",
+    "peak_rss_mb": "Megabytes",
+}
+
+
+def peak_rss_mb():
+    """
+    Returns the peak resident set size of the process in megabytes.
+    """
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class TransformMetrics:
+    """
+    Collects the metrics of every stage of a transform run. Stages can be
+    recorded from several threads at once.
+    """
+
+    def __init__(self):
+        self.stages = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Times a stage. The yielded dict can be given rows_in, rows_out,
+        bytes_read and bytes_written while the stage runs.
+        """
+        record = {
+            "stage": name,
+            "rows_in": 0,
+            "rows_out": 0,
+            "bytes_read": 0,
+            "bytes_written": 0,
+        }
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["duration_ms"] = round((time.perf_counter() - start) * 1000, 3)
+            record["peak_rss_mb"] = round(peak_rss_mb(), 1)
+            with self._lock:
+                self.stages.append(record)
+
+    def as_list(self):
+        """
+        Returns the recorded stages in the order they finished.
+        """
+        with self._lock:
+            return [dict(record) for record in self.stages]
+
+    def emf_documents(self, namespace=TRANSFORM_METRICS_NAMESPACE):
+        """
+        Returns one CloudWatch Embedded Metric Format document per stage.
+        """
+        timestamp = int(time.time() * 1000)
+        return [
+            {
+                "_aws": {
+                    "Timestamp": timestamp,
+                    "CloudWatchMetrics": [
+                        {
+                            "Namespace": namespace,
+                            "Dimensions": [["Stage"]],
+                            "Metrics": [
+                                {"Name": name, "Unit": unit}
+                                for name, unit in METRIC_UNITS.items()
+                            ],
+                        }
+                    ],
+                },
+                "Stage": record["stage"],
+                **{name: record[name] for name in METRIC_UNITS},
+            }
+            for record in self.as_list()
+        ]
+
+    def emit_emf(self, namespace=TRANSFORM_METRICS_NAMESPACE):
+        """
+        Prints the EMF documents to stdout, where the lambda runtime forwards
+        them to CloudWatch Logs unchanged (the logging module would prefix them).
+        """
+        for document in self.emf_documents(namespace):
+            print(json.dumps(document))
+
+    def format_table(self):
+        """
+        Returns the stages as a text table, slowest first.
+        """
+        header = (
+            f"{'stage':<32}{'ms':>10}{'rows in':>10}{'rows out':>10}"
+            f"{'bytes read':>12}{'bytes written':>15}{'peak rss mb':>13}"
+        )
+        lines = [header, "-" * len(header)]
+        for record in sorted(self.as_list(), key=lambda r: -r["duration_ms"]):
+            lines.append(
+                f"{record['stage']:<32}{record['duration_ms']:>10.1f}"
+                f"{record['rows_in']:>10}{record['rows_out']:>10}"
+                f"{record['bytes_read']:>12}{record['bytes_written']:>15}"
+                f"{record['peak_rss_mb']:>13.1f}"
+            )
+        return "\n".join(lines)
@@ -2,7 +2,55 @@ import boto3
 import logging
 import polars as pl
 import os
+import datetime as dt
+from io import BytesIO
 from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+from src.utils.parquet_config import write_table_parquet, get_parquet_writer_settings
+from src.utils.transform_engine import (
+    build_table,
+    run_table_specs,
+    TRANSFORM_MAX_WORKERS,
+)
+from src.utils.key_maps import (
+    get_key_map,
+    put_key_map,
+    extend_key_map,
+    lookup_surrogate_keys,
+)
+from src.utils.transform_metrics import TransformMetrics
+from src.utils.transform_cache import (
+    get_object_etag,
+    fingerprint_inputs,
+    get_transform_cache_index,
+    put_transform_cache_entry,
+    copy_cached_outputs,
+)
+
+DIM_DATE_CACHE_KEY = "/calendar/dim_date.parquet"
+DIM_DATE_SNAPSHOT_PATH = "/calendar/snapshots/"
+LOCATION_STATE_KEY = "/locations/dim_location.parquet"
+LOCATION_SNAPSHOT_PATH = "/locations/snapshots/"
+DIM_DATE_START = os.getenv("DIM_DATE_START", "2020-01-01")
+DIM_DATE_END = os.getenv("DIM_DATE_END", "2030-12-31")
+FACT_SALES_ORDER_LAYOUT = os.getenv("FACT_SALES_ORDER_LAYOUT", "single")
+# also write an uncompressed Arrow IPC copy of every table for load to memory map
+TRANSFORM_IPC_OUTPUT = os.getenv("TRANSFORM_IPC_OUTPUT", "false").lower() == "true"
+# sales_order csv files larger than this are streamed instead of read into memory
+TRANSFORM_STREAMING_THRESHOLD_BYTES = int(
+    os.getenv("TRANSFORM_STREAMING_THRESHOLD_BYTES", str(256 * 1024 * 1024))
+)
+# approximate memory the streamed fact_sales_order may hold at once
+TRANSFORM_MEMORY_BUDGET_BYTES = int(
+    os.getenv("TRANSFORM_MEMORY_BUDGET_BYTES", str(512 * 1024 * 1024))
+)
+# bump whenever STAR_SCHEMA_SPECS or the parquet writer settings change the
+# outputs, so cached results from older code are not reused
+STAR_SCHEMA_SPEC_VERSION = "1"
+DIM_DATE_COLUMNS = [
+    "date_id", "year", "month", "day", "day_of_week",
+    "day_name", "month_name", "quarter"
+]
 
 
 def finds_data_buckets():
@@ -46,147 +94,274 @@ def finds_data_buckets():
     return raw_data_bucket, processed_data_bucket
 
 
-def create_star_schema_from_sales_order_csv_file(prefix):
+def _datetime_split(column, prefix):
     """
-    This function looks for csv files in our raw data bucket, downloads the ones needed
-    to create the star schema for our minimal viable product, reads them in as polars
-    dataframes, reformats the dataframes into our star schema, saves the dataframes as
-    parquet files, and uploads the parquet files to our processed data bucket
-
-    Args:
-        prefix - used to retrieve csv files from specific folder and save parquet to specific folder
+    Splits a timestamp column into {prefix}_date and {prefix}_time columns.
     """
-    s3_client = boto3.client("s3")
-    raw_data_bucket, processed_data_bucket = finds_data_buckets()
+    return [
+        pl.col(column).str.to_datetime().cast(pl.Date).alias(f"{prefix}_date"),
+        pl.col(column).str.to_datetime().cast(pl.Time).alias(f"{prefix}_time"),
+    ]
 
-    try:
-        s3_client.download_file(
-            Bucket=raw_data_bucket,
-            Filename="/tmp/sales_order_new.csv",
-            Key=f"/history/{prefix}sales_order_differences.csv",
-        )
-        s3_client.download_file(
-            Bucket=raw_data_bucket,
-            Filename="/tmp/staff_new.csv",
-            Key=f"/history/{prefix}staff_differences.csv",
-        )
-        s3_client.download_file(
-            Bucket=raw_data_bucket,
-            Filename="/tmp/counterparty_new.csv",
-            Key=f"/history/{prefix}counterparty_differences.csv",
-        )
-        s3_client.download_file(
-            Bucket=raw_data_bucket,
-            Filename="/tmp/currency_new.csv",
-            Key=f"/history/{prefix}currency_differences.csv",
-        )
-        s3_client.download_file(
-            Bucket=raw_data_bucket,
-            Filename="/tmp/address_new.csv",
-            Key=f"/history/{prefix}address_differences.csv",
-        )
-        s3_client.download_file(
-            Bucket=raw_data_bucket,
-            Filename="/tmp/design_new.csv",
-            Key=f"/history/{prefix}design_differences.csv",
-        )
-        s3_client.download_file(
-            Bucket=raw_data_bucket,
-            Filename="/tmp/department_new.csv",
-            Key=f"/history/{prefix}department_differences.csv",
-        )
-    except ClientError as e:
-        logging.error(e)
-        raise Exception("Failed to download file")
-    
-    fact_sales_order = pl.read_csv("/tmp/sales_order_new.csv")
-    dim_staff = pl.read_csv("/tmp/staff_new.csv")
-    dim_counterparty = pl.read_csv("/tmp/counterparty_new.csv")
-    dim_currency = pl.read_csv("/tmp/currency_new.csv")
-    dim_location = pl.read_csv("/tmp/address_new.csv")
-    dim_design = pl.read_csv("/tmp/design_new.csv")
-    department = pl.read_csv("/tmp/department_new.csv")
-
-    fact_sales_order = fact_sales_order.with_columns(
-        pl.col("created_at").str.to_datetime().cast(pl.Date).alias("created_date"),
-        pl.col("created_at").str.to_datetime().cast(pl.Time).alias("created_time"),
+
+def _as_date(column):
+    return pl.col(column).str.to_datetime().cast(pl.Date)
+
+
+def _build_calendar(frames):
+    """
+    Extends the cached calendar so it covers every date referenced by the facts.
+    """
+    referenced_dates = [
+        frames[fact][column]
+        for fact, columns in DIM_DATE_REFERENCES.items()
+        if fact in frames
+        for column in columns
+    ]
+    if "sales_order_dates" in frames:
+        # streaming mode: fact_sales_order is not in memory, only its dates are
+        referenced_dates.append(frames["sales_order_dates"]["date"])
+    calendar, _ = extend_calendar_dim_date(
+        frames["cached_dim_date"], pl.concat(referenced_dates)
     )
-    fact_sales_order = fact_sales_order.drop("created_at")
-    fact_sales_order = fact_sales_order.with_columns(
-        pl.col("last_updated")
-        .str.to_datetime()
-        .cast(pl.Date)
-        .alias("last_updated_date"),
-        pl.col("last_updated")
-        .str.to_datetime()
-        .cast(pl.Time)
-        .alias("last_updated_time"),
+    return calendar
+
+
+def _build_dim_date(frames):
+    """
+    Emits the calendar dates that are not in the cached calendar yet.
+    """
+    return calendar_dates_not_cached(frames["calendar"], frames["cached_dim_date"])
+
+
+def _build_location_keys(frames):
+    """
+    Extends the dim_location key map with every address id seen in this run.
+    """
+    natural_keys = pl.concat(
+        [
+            frames["address"]["address_id"].cast(pl.Int64),
+            frames["counterparty"]["legal_address_id"].cast(pl.Int64),
+            frames["sales_order"]["agreed_delivery_location_id"].cast(pl.Int64),
+            frames["purchase_order"]["agreed_delivery_location_id"].cast(pl.Int64),
+        ]
     )
-    fact_sales_order = fact_sales_order.drop("last_updated")
-    fact_sales_order = fact_sales_order.with_columns(
-        pl.col("agreed_delivery_date").str.to_datetime().cast(pl.Date)
+    return extend_key_map(frames["location_key_map"], natural_keys)
+
+
+def _build_locations(frames):
+    """
+    Upserts this run's dim_location rows into every location seen so far, so
+    counterparties can be joined to addresses that did not change in this run.
+    """
+    if frames["location_state"] is None:
+        return frames["dim_location"]
+    return pl.concat(
+        [
+            frames["location_state"].join(
+                frames["dim_location"], on="location_id", how="anti"
+            ),
+            frames["dim_location"],
+        ],
+        how="vertical_relaxed",
+    ).sort("location_id")
+
+
+def _with_location_key(source, column, alias):
+    """
+    Returns a spec transform that looks up the dim_location surrogate key of an
+    address id column of a source table.
+    """
+    def transform(frames):
+        location_ids = lookup_surrogate_keys(
+            frames["location_keys"], frames[source][column]
+        )
+        return frames[source].with_columns(location_ids.alias(alias))
+    return transform
+
+
+def _with_fact_location_key(source):
+    transform = _with_location_key(
+        source, "agreed_delivery_location_id", "agreed_delivery_location_id"
     )
-    fact_sales_order = fact_sales_order.with_columns(
-        pl.col("agreed_payment_date").str.to_datetime().cast(pl.Date)
+    return lambda frames: transform(frames).with_columns(
+        pl.col("agreed_delivery_location_id").cast(pl.Int64)
     )
 
-    dim_date = pl.DataFrame(
-        pl.concat(
-            [
-                fact_sales_order["created_date"],
-                fact_sales_order["last_updated_date"],
-                fact_sales_order["agreed_delivery_date"],
-                fact_sales_order["last_updated_date"],
-                fact_sales_order["agreed_payment_date"],
-            ]
+
+def _with_lazy_fact_location_key(source):
+    """
+    Same as _with_fact_location_key for a LazyFrame source: the key map is
+    applied as an expression so the streaming engine can run it per chunk.
+    """
+    def transform(frames):
+        location_keys = frames["location_keys"]
+        return frames[source].with_columns(
+            pl.col("agreed_delivery_location_id")
+            .cast(pl.Int64)
+            .replace_strict(
+                location_keys["natural_key"],
+                location_keys["surrogate_key"].cast(pl.Int64),
+                default=None,
+                return_dtype=pl.Int64,
+            )
         )
-    ).unique()
-    dim_date = dim_date.with_row_index("date_id", offset=1)
-    dim_date = dim_date.with_columns(
-        pl.col("created_date").alias("date_id"),
-        pl.col("created_date").dt.year().alias("year"),
-        pl.col("created_date").dt.month().alias("month"),
-        pl.col("created_date").dt.day().alias("day"),
-        pl.col("created_date").dt.quarter().alias("quarter"),
-        pl.col("created_date").dt.weekday().alias("day_of_week"),
-        pl.col("created_date").dt.to_string("%A").alias("day_name"),
-        pl.col("created_date").dt.to_string("%B").alias("month_name"),
-    )
+    return transform
 
-    dim_staff = dim_staff.join(
-        department, left_on="department_id", right_on="department_id"
-    ).sort("staff_id")
-    dim_staff = dim_staff.drop(
-        [
+
+SOURCE_TABLES = [
+    "sales_order",
+    "staff",
+    "counterparty",
+    "currency",
+    "address",
+    "design",
+    "department",
+    "purchase_order",
+    "payment",
+    "transaction",
+]
+
+CURRENCY_NAMES = {
+    "GBP": "Great British Pound",
+    "USD": "US Dollars",
+    "EUR": "Euros",
+}
+
+DIM_DATE_REFERENCES = {
+    "fact_sales_order": [
+        "created_date", "last_updated_date",
+        "agreed_delivery_date", "agreed_payment_date",
+    ],
+    "fact_purchase_order": [
+        "created_date", "last_updated_date",
+        "agreed_delivery_date", "agreed_payment_date",
+    ],
+    "fact_payment": ["created_date", "last_updated_date", "payment_date"],
+}
+
+STAR_SCHEMA_SPECS = [
+    {
+        "name": "location_keys",
+        "inputs": [
+            "location_key_map", "address", "counterparty",
+            "sales_order", "purchase_order",
+        ],
+        "transform": _build_location_keys,
+        "output": False,
+    },
+    {
+        "name": "fact_sales_order",
+        "inputs": ["sales_order", "location_keys"],
+        "transform": _with_fact_location_key("sales_order"),
+        "derived": [
+            *_datetime_split("created_at", "created"),
+            *_datetime_split("last_updated", "last_updated"),
+            _as_date("agreed_delivery_date"),
+            _as_date("agreed_payment_date"),
+        ],
+        "drops": ["created_at", "last_updated"],
+    },
+    {
+        "name": "fact_purchase_order",
+        "inputs": ["purchase_order", "location_keys"],
+        "transform": _with_fact_location_key("purchase_order"),
+        "derived": [
+            *_datetime_split("created_at", "created"),
+            *_datetime_split("last_updated", "last_updated"),
+            _as_date("agreed_delivery_date"),
+            _as_date("agreed_payment_date"),
+        ],
+        "drops": ["created_at", "last_updated"],
+    },
+    {
+        "name": "fact_payment",
+        "inputs": ["payment"],
+        "derived": [
+            *_datetime_split("created_at", "created"),
+            *_datetime_split("last_updated", "last_updated"),
+            _as_date("payment_date"),
+        ],
+        "drops": [
+            "created_at", "last_updated",
+            "company_ac_number", "counterparty_ac_number",
+        ],
+    },
+    {
+        "name": "dim_transaction",
+        "inputs": ["transaction"],
+        "drops": ["created_at", "last_updated"],
+        "sort": ["transaction_id"],
+    },
+    {
+        "name": "calendar",
+        "inputs": [*DIM_DATE_REFERENCES, "cached_dim_date"],
+        "transform": _build_calendar,
+        "output": False,
+    },
+    {
+        "name": "dim_date",
+        "inputs": ["calendar", "cached_dim_date"],
+        "transform": _build_dim_date,
+    },
+    {
+        "name": "dim_staff",
+        "inputs": ["staff"],
+        "joins": [
+            {
+                "right": "department",
+                "left_on": "department_id",
+                "right_on": "department_id",
+            }
+        ],
+        "drops": [
             "department_id",
             "manager",
             "created_at_right",
             "last_updated_right",
             "created_at",
             "last_updated",
-        ]
-    )
-
-    dim_location = dim_location.with_row_index("location_id", offset=1)
-    dim_location = dim_location.drop(["created_at", "last_updated", "address_id"])
-
-    dim_counterparty = dim_counterparty.join(
-        dim_location,
-        right_on=pl.col("location_id").cast(pl.Int64),
-        left_on=pl.col("legal_address_id").cast(pl.Int64),
-    )
-    dim_counterparty = dim_counterparty.drop(
-        [
+        ],
+        "sort": ["staff_id"],
+    },
+    {
+        "name": "dim_location",
+        "inputs": ["address", "location_keys"],
+        "transform": _with_location_key("address", "address_id", "location_id"),
+        "drops": ["created_at", "last_updated", "address_id"],
+        "select": [
+            "location_id", "address_line_1", "address_line_2", "district",
+            "city", "postal_code", "country", "phone",
+        ],
+    },
+    {
+        "name": "locations",
+        "inputs": ["location_state", "dim_location"],
+        "transform": _build_locations,
+        "output": False,
+    },
+    {
+        "name": "dim_counterparty",
+        "inputs": ["counterparty", "location_keys"],
+        "transform": _with_location_key(
+            "counterparty", "legal_address_id", "legal_location_id"
+        ),
+        "joins": [
+            {
+                "right": "locations",
+                "left_on": "legal_location_id",
+                "right_on": "location_id",
+            }
+        ],
+        "drops": [
             "created_at",
             "last_updated",
             "legal_address_id",
+            "legal_location_id",
             "commercial_contact",
-            "location_id",
             "delivery_contact",
-        ]
-    )
-    dim_counterparty = dim_counterparty.rename(
-        {
+        ],
+        "renames": {
             "address_line_1": "counterparty_legal_address_line_1",
             "address_line_2": "counterparty_legal_address_line_2",
             "district": "counterparty_legal_district",
@@ -194,66 +369,859 @@ def create_star_schema_from_sales_order_csv_file(prefix):
             "postal_code": "counterparty_legal_postal_code",
             "country": "counterparty_legal_country",
             "phone": "counterparty_legal_phone_number",
-        }
+        },
+    },
+    {
+        "name": "dim_currency",
+        "inputs": ["currency"],
+        "derived": [
+            pl.col("currency_code")
+            .replace_strict(CURRENCY_NAMES, default=None, return_dtype=pl.String)
+            .alias("currency_name")
+        ],
+        "drops": ["last_updated", "created_at"],
+    },
+    {
+        "name": "dim_design",
+        "inputs": ["design"],
+        "drops": ["created_at", "last_updated"],
+        "sort": ["design_id"],
+    },
+]
+
+
+def download_source_tables(
+    s3_client, raw_data_bucket, prefix, metrics=None, work_dir="/tmp"
+):
+    """
+    This function downloads the differences csv of every source table used by
+    the star schema specs and reads them in as polars dataframes. Downloads run
+    concurrently.
+
+    A sales_order file larger than TRANSFORM_STREAMING_THRESHOLD_BYTES is only
+    downloaded, and its entry is None, so it can be streamed from work_dir.
+
+    Args:
+        s3_client (boto3 client): S3 client used to download the files
+        raw_data_bucket (string): name of the raw data bucket
+        prefix (string): time prefix of the current run
+        metrics (TransformMetrics): records a download and parse stage per table
+        work_dir (string): local directory the csv files are downloaded to
+
+    Returns:
+        sources (dict): source table name -> DataFrame
+    """
+    metrics = metrics or TransformMetrics()
+
+    def download(table):
+        path = os.path.join(work_dir, f"{table}_new.csv")
+        with metrics.stage(f"download:{table}") as record:
+            s3_client.download_file(
+                Bucket=raw_data_bucket,
+                Filename=path,
+                Key=f"/history/{prefix}{table}_differences.csv",
+            )
+            record["bytes_read"] = os.path.getsize(path)
+        if table == "sales_order" and record["bytes_read"] > TRANSFORM_STREAMING_THRESHOLD_BYTES:
+            return None
+        with metrics.stage(f"parse:{table}") as record:
+            df = pl.read_csv(path)
+            record["bytes_read"] = os.path.getsize(path)
+            record["rows_out"] = df.height
+        return df
+
+    try:
+        with ThreadPoolExecutor(max_workers=TRANSFORM_MAX_WORKERS) as executor:
+            frames = list(executor.map(download, SOURCE_TABLES))
+    except ClientError as e:
+        logging.error(e)
+        raise Exception("Failed to download file")
+    return dict(zip(SOURCE_TABLES, frames))
+
+
+def fingerprint_transform_inputs(
+    s3_client, raw_data_bucket, processed_data_bucket, prefix, calendar_key,
+    location_key,
+):
+    """
+    This function fingerprints every input of a transform run: the ETags of the
+    differences csv files, of the calendar and location state snapshots the
+    prefix starts from, plus the spec version and output settings.
+
+    The location key map is left out: it only ever gains keys, so the same
+    differences files always get the same surrogate keys. The current calendar
+    and location state are left out too, as they change once a run has saved
+    them; a retry of the prefix reads the same snapshots and so gets the same
+    fingerprint.
+
+    Args:
+        s3_client (boto3 client): S3 client used to head the objects
+        raw_data_bucket (string): name of the raw data bucket
+        processed_data_bucket (string): name of the processed data bucket
+        prefix (string): time prefix of the current run
+        calendar_key (string): S3 key of the prefix's calendar snapshot
+        location_key (string): S3 key of the prefix's location state snapshot
+
+    Returns:
+        fingerprint (string): fingerprint of the run's inputs
+    """
+    inputs = {
+        table: (raw_data_bucket, f"/history/{prefix}{table}_differences.csv")
+        for table in SOURCE_TABLES
+    }
+    inputs["cached_dim_date"] = (processed_data_bucket, calendar_key)
+    inputs["location_state"] = (processed_data_bucket, location_key)
+
+    try:
+        with ThreadPoolExecutor(max_workers=TRANSFORM_MAX_WORKERS) as executor:
+            etags = dict(
+                zip(
+                    inputs,
+                    executor.map(
+                        lambda location: get_object_etag(s3_client, *location),
+                        inputs.values(),
+                    ),
+                )
+            )
+    except ClientError as e:
+        logging.error(e)
+        raise Exception("Failed to download file")
+    missing = [table for table in SOURCE_TABLES if etags[table] is None]
+    if missing:
+        logging.error(f"Missing differences files for {missing}")
+        raise Exception("Failed to download file")
+
+    return fingerprint_inputs(
+        etags,
+        f"{STAR_SCHEMA_SPEC_VERSION}:{FACT_SALES_ORDER_LAYOUT}:{TRANSFORM_IPC_OUTPUT}",
     )
 
-    if dim_currency.height == 3:
-        dim_currency = dim_currency.with_columns(
-            currency_name=pl.Series(["Great British Pound", "US Dollars", "Euros"])
+
+def build_and_upload_star_schema(
+    sources, s3_client, processed_data_bucket, prefix, metrics=None, work_dir="/tmp",
+    skip_outputs=(),
+):
+    """
+    This function builds every star schema table from the source tables and the
+    calendar, key map and location state, and uploads each output to
+    /history/{prefix}/ as soon as it is built. It does not save the state for
+    the next run.
+
+    Args:
+        sources (dict): source tables from download_source_tables (sales_order
+            None for streaming mode), plus cached_dim_date, location_key_map
+            and location_state
+        s3_client (boto3 client): S3 client used to upload the files
+        processed_data_bucket (string): name of the processed data bucket
+        prefix (string): time prefix of the run
+        metrics (TransformMetrics): collects the timings of every stage
+        work_dir (string): local directory for the csv and output files
+        skip_outputs (tuple): tables that are built but not uploaded
+
+    Returns:
+        tables (dict): every source and built table, name -> DataFrame
+        output_keys (list): S3 keys of every uploaded output
+    """
+    metrics = metrics or TransformMetrics()
+    sales_order_csv = os.path.join(work_dir, "sales_order_new.csv")
+    specs = STAR_SCHEMA_SPECS
+    streaming = sources["sales_order"] is None
+    if streaming:
+        with metrics.stage("summarise:sales_order") as record:
+            sources = dict(sources, **summarise_sales_order_csv(sales_order_csv))
+            record["bytes_read"] = os.path.getsize(sales_order_csv)
+        specs = streaming_star_schema_specs()
+
+    output_keys = []
+
+    def upload_file(name, path, key):
+        with metrics.stage(f"upload:{name}") as record:
+            record["bytes_written"] = os.path.getsize(path)
+            s3_client.upload_file(Bucket=processed_data_bucket, Filename=path, Key=key)
+        output_keys.append(key)
+
+    def upload_table(name, df):
+        if name in skip_outputs:
+            return
+        if TRANSFORM_IPC_OUTPUT:
+            with metrics.stage(f"upload_ipc:{name}") as record:
+                output_keys.append(
+                    upload_table_ipc(
+                        df, name, s3_client, processed_data_bucket, prefix, work_dir
+                    )
+                )
+                record["rows_in"] = df.height
+                record["bytes_written"] = os.path.getsize(
+                    os.path.join(work_dir, f"{name}.arrow")
+                )
+        if name == "fact_sales_order" and FACT_SALES_ORDER_LAYOUT == "partitioned":
+            with metrics.stage(f"upload_partitioned:{name}") as record:
+                output_keys.extend(
+                    upload_partitioned_fact_sales_order(
+                        df, s3_client, processed_data_bucket, prefix
+                    )
+                )
+                record["rows_in"] = df.height
+            return
+        path = os.path.join(work_dir, f"{name}.parquet")
+        with metrics.stage(f"write:{name}") as record:
+            write_table_parquet(df, name, path)
+            record["rows_in"] = df.height
+            record["bytes_written"] = os.path.getsize(path)
+        upload_file(name, path, f"/history/{prefix}/{name}.parquet")
+
+    tables = run_table_specs(specs, sources, on_ready=upload_table, metrics=metrics)
+    if streaming:
+        with metrics.stage("stream:fact_sales_order") as record:
+            output_keys.extend(
+                upload_streamed_fact_sales_order(
+                    sales_order_csv,
+                    tables["location_keys"],
+                    s3_client,
+                    processed_data_bucket,
+                    prefix,
+                    work_dir=work_dir,
+                )
+            )
+            record["bytes_read"] = os.path.getsize(sales_order_csv)
+    return tables, output_keys
+
+
+def create_star_schema_from_sales_order_csv_file(prefix, metrics=None):
+    """
+    This function looks for csv files in our raw data bucket, downloads the ones needed
+    to create the star schema, reads them in as polars dataframes and builds every
+    table in STAR_SCHEMA_SPECS with the transform engine. Each table is saved as
+    parquet and uploaded to our processed data bucket as soon as it is built.
+
+    A sales_order file too large to read into memory is streamed: the other
+    tables are built from its distinct dates and delivery locations, then
+    fact_sales_order is written chunk by chunk within TRANSFORM_MEMORY_BUDGET_BYTES.
+
+    With TRANSFORM_IPC_OUTPUT set to true, every table is also uploaded as an
+    uncompressed Arrow IPC file for load to memory map.
+
+    If a previous run had exactly the same inputs (see fingerprint_transform_inputs),
+    its outputs are copied to this run's prefix instead of being rebuilt.
+
+    Args:
+        prefix - used to retrieve csv files from specific folder and save parquet to specific folder
+        metrics (TransformMetrics): collects the timings of every stage, a new
+            one is created if not given
+
+    Returns:
+        metrics (TransformMetrics): wall time, rows, bytes and peak RSS per stage
+    """
+    metrics = metrics or TransformMetrics()
+    s3_client = boto3.client("s3")
+    raw_data_bucket, processed_data_bucket = finds_data_buckets()
+
+    with metrics.stage("fingerprint"):
+        calendar_key = snapshot_cached_dim_date(s3_client, processed_data_bucket, prefix)
+        location_key = snapshot_location_state(s3_client, processed_data_bucket, prefix)
+        fingerprint = fingerprint_transform_inputs(
+            s3_client, raw_data_bucket, processed_data_bucket, prefix, calendar_key,
+            location_key,
+        )
+        cache_index = get_transform_cache_index(s3_client, processed_data_bucket)
+    if fingerprint in cache_index:
+        entry = cache_index[fingerprint]
+        logging.info(f"Inputs unchanged, reusing outputs of {entry['prefix']}")
+        with metrics.stage("cache_copy"):
+            keys = copy_cached_outputs(s3_client, processed_data_bucket, entry, prefix)
+            put_transform_cache_entry(
+                s3_client, processed_data_bucket, cache_index, fingerprint, prefix, keys
+            )
+        return metrics
+
+    sources = download_source_tables(s3_client, raw_data_bucket, prefix, metrics)
+    with metrics.stage("read_state"):
+        sources["cached_dim_date"] = get_cached_dim_date(
+            s3_client, processed_data_bucket, calendar_key
         )
-    else:
-        dim_currency = dim_currency.with_columns(
-            currency_name=None
+        sources["location_key_map"] = get_key_map(
+            s3_client, processed_data_bucket, "dim_location"
+        )
+        sources["location_state"] = get_location_state(
+            s3_client, processed_data_bucket, location_key
         )
-    dim_currency = dim_currency.drop(["last_updated", "created_at"])
 
-    dim_design = dim_design.sort("design_id")
-    dim_design = dim_design.drop(["created_at", "last_updated"])
+    tables, output_keys = build_and_upload_star_schema(
+        sources, s3_client, processed_data_bucket, prefix, metrics
+    )
 
-    fact_sales_order.write_parquet("/tmp/fact_sales_order.parquet")
-    dim_staff.write_parquet("/tmp/dim_staff.parquet")
-    dim_design.write_parquet("/tmp/dim_design.parquet")
-    dim_currency.write_parquet("/tmp/dim_currency.parquet")
-    dim_counterparty.write_parquet("/tmp/dim_counterparty.parquet")
-    dim_location.write_parquet("/tmp/dim_location.parquet")
-    dim_date.write_parquet("/tmp/dim_date.parquet")
+    with metrics.stage("save_state"):
+        # only cache the extended calendar once its new dates have been uploaded,
+        # and never replace it with the smaller calendar of a retried older prefix
+        if tables["dim_date"].height and extends_calendar(
+            get_cached_dim_date(s3_client, processed_data_bucket), tables["calendar"]
+        ):
+            put_cached_dim_date(s3_client, processed_data_bucket, tables["calendar"])
+        if tables["location_keys"].height != sources["location_key_map"].height:
+            put_key_map(
+                s3_client, processed_data_bucket, "dim_location", tables["location_keys"]
+            )
+        # upsert into the current state, which may be newer than the snapshot
+        if tables["dim_location"].height:
+            put_location_state(
+                s3_client,
+                processed_data_bucket,
+                _build_locations(
+                    {
+                        "location_state": get_location_state(
+                            s3_client, processed_data_bucket
+                        ),
+                        "dim_location": tables["dim_location"],
+                    }
+                ),
+            )
+        put_transform_cache_entry(
+            s3_client, processed_data_bucket, cache_index, fingerprint, prefix, output_keys
+        )
 
-    s3_client.upload_file(
-        Bucket=processed_data_bucket,
-        Filename="/tmp/fact_sales_order.parquet",
-        Key=f"/history/{prefix}/fact_sales_order.parquet",
+    for file in os.listdir("/tmp/"):
+        if "csv" in file or "parquet" in file or file.endswith(".arrow"):
+            os.remove(f"/tmp/{file}")
+    return metrics
+
+
+def create_calendar_dim_date(start_date, end_date):
+    """
+    This function builds the dim_date calendar for every day between two dates
+    (inclusive) using vectorized date-range arithmetic.
+
+    Args:
+        start_date (date): first day of the calendar
+        end_date (date): last day of the calendar
+
+    Returns:
+        dim_date (DataFrame): one row per day with the dim_date warehouse columns
+    """
+    dates = pl.date_range(start_date, end_date, interval="1d", eager=True)
+    dim_date = pl.DataFrame({"date_id": dates})
+    dim_date = dim_date.with_columns(
+        pl.col("date_id").dt.year().alias("year"),
+        pl.col("date_id").dt.month().alias("month"),
+        pl.col("date_id").dt.day().alias("day"),
+        pl.col("date_id").dt.weekday().alias("day_of_week"),
+        pl.col("date_id").dt.to_string("%A").alias("day_name"),
+        pl.col("date_id").dt.to_string("%B").alias("month_name"),
+        pl.col("date_id").dt.quarter().alias("quarter"),
     )
-    s3_client.upload_file(
-        Bucket=processed_data_bucket,
-        Filename="/tmp/dim_design.parquet",
-        Key=f"/history/{prefix}/dim_design.parquet",
+    return dim_date.select(DIM_DATE_COLUMNS)
+
+
+def get_cached_dim_date(s3_client, processed_data_bucket, key=DIM_DATE_CACHE_KEY):
+    """
+    This function reads the precomputed calendar from the processed data bucket.
+
+    Args:
+        s3_client (boto3 client): S3 client used to get the calendar
+        processed_data_bucket (string): name of the processed data bucket
+        key (string): S3 key of the calendar, the current one by default or
+            the snapshot of a time prefix
+
+    Returns:
+        calendar (DataFrame): cached calendar, or None if it has not been generated yet
+    """
+    try:
+        res = s3_client.get_object(
+            Bucket=processed_data_bucket, Key=key
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+            return None
+        logging.error(e)
+        raise Exception("Failed to get cached calendar")
+    return pl.read_parquet(BytesIO(res["Body"].read()))
+
+
+def put_cached_dim_date(s3_client, processed_data_bucket, calendar):
+    """
+    This function saves the calendar to the processed data bucket so the next
+    run only emits dates outside of it.
+
+    Args:
+        s3_client (boto3 client): S3 client used to put the calendar
+        processed_data_bucket (string): name of the processed data bucket
+        calendar (DataFrame): full calendar covering every date emitted so far
+    """
+    buffer = BytesIO()
+    write_table_parquet(calendar, "dim_date", buffer)
+    s3_client.put_object(
+        Body=buffer.getvalue(), Bucket=processed_data_bucket, Key=DIM_DATE_CACHE_KEY
     )
-    s3_client.upload_file(
-        Bucket=processed_data_bucket,
-        Filename="/tmp/dim_staff.parquet",
-        Key=f"/history/{prefix}/dim_staff.parquet",
+
+
+def get_location_state(s3_client, processed_data_bucket, key=LOCATION_STATE_KEY):
+    """
+    This function reads every dim_location row emitted so far from the
+    processed data bucket.
+
+    Args:
+        s3_client (boto3 client): S3 client used to get the locations
+        processed_data_bucket (string): name of the processed data bucket
+        key (string): S3 key of the locations, the current ones by default or
+            the snapshot of a time prefix
+
+    Returns:
+        locations (DataFrame): latest row of every location, or None if no
+            location has been emitted yet
+    """
+    try:
+        res = s3_client.get_object(
+            Bucket=processed_data_bucket, Key=key
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+            return None
+        logging.error(e)
+        raise Exception("Failed to get location state")
+    locations = pl.read_parquet(BytesIO(res["Body"].read()))
+    # an empty snapshot records that the prefix started without any locations
+    return locations if locations.height else None
+
+
+def put_location_state(s3_client, processed_data_bucket, locations):
+    """
+    This function saves every dim_location row emitted so far to the processed
+    data bucket, so the next run can join counterparties to them.
+
+    Args:
+        s3_client (boto3 client): S3 client used to put the locations
+        processed_data_bucket (string): name of the processed data bucket
+        locations (DataFrame): latest row of every location
+    """
+    buffer = BytesIO()
+    write_table_parquet(locations, "dim_location", buffer)
+    s3_client.put_object(
+        Body=buffer.getvalue(), Bucket=processed_data_bucket, Key=LOCATION_STATE_KEY
     )
-    s3_client.upload_file(
-        Bucket=processed_data_bucket,
-        Filename="/tmp/dim_location.parquet",
-        Key=f"/history/{prefix}/dim_location.parquet",
+
+
+def snapshot_cached_dim_date(s3_client, processed_data_bucket, prefix):
+    """
+    This function pins the calendar a time prefix is transformed against. The
+    first run of a prefix copies the current calendar to a snapshot kept for
+    that prefix (an empty calendar if there is none yet). Later runs of the
+    prefix read the snapshot, so a retry after the calendar has been saved
+    emits the same dim_date instead of an empty one.
+
+    Args:
+        s3_client (boto3 client): S3 client used to copy the calendar
+        processed_data_bucket (string): name of the processed data bucket
+        prefix (string): time prefix of the current run
+
+    Returns:
+        key (string): S3 key of the prefix's calendar snapshot
+    """
+    key = f"{DIM_DATE_SNAPSHOT_PATH}{prefix}/dim_date.parquet"
+    try:
+        if get_object_etag(s3_client, processed_data_bucket, key) is not None:
+            return key
+        if get_object_etag(s3_client, processed_data_bucket, DIM_DATE_CACHE_KEY) is None:
+            buffer = BytesIO()
+            start_date = dt.date.fromisoformat(DIM_DATE_START)
+            empty = create_calendar_dim_date(start_date, start_date).clear()
+            write_table_parquet(empty, "dim_date", buffer)
+            s3_client.put_object(
+                Body=buffer.getvalue(), Bucket=processed_data_bucket, Key=key
+            )
+        else:
+            s3_client.copy_object(
+                Bucket=processed_data_bucket,
+                Key=key,
+                CopySource={"Bucket": processed_data_bucket, "Key": DIM_DATE_CACHE_KEY},
+            )
+    except ClientError as e:
+        logging.error(e)
+        raise Exception("Failed to snapshot cached calendar")
+    return key
+
+
+def snapshot_location_state(s3_client, processed_data_bucket, prefix):
+    """
+    This function pins the location state a time prefix is transformed against,
+    as snapshot_cached_dim_date pins the calendar. The first run of a prefix
+    copies the current locations to a snapshot kept for that prefix (an empty
+    one if there are none yet), later runs of the prefix read the snapshot.
+
+    Args:
+        s3_client (boto3 client): S3 client used to copy the locations
+        processed_data_bucket (string): name of the processed data bucket
+        prefix (string): time prefix of the current run
+
+    Returns:
+        key (string): S3 key of the prefix's location state snapshot
+    """
+    key = f"{LOCATION_SNAPSHOT_PATH}{prefix}/dim_location.parquet"
+    try:
+        if get_object_etag(s3_client, processed_data_bucket, key) is not None:
+            return key
+        if get_object_etag(s3_client, processed_data_bucket, LOCATION_STATE_KEY) is None:
+            buffer = BytesIO()
+            pl.DataFrame(schema={"location_id": pl.Int64}).write_parquet(buffer)
+            s3_client.put_object(
+                Body=buffer.getvalue(), Bucket=processed_data_bucket, Key=key
+            )
+        else:
+            s3_client.copy_object(
+                Bucket=processed_data_bucket,
+                Key=key,
+                CopySource={"Bucket": processed_data_bucket, "Key": LOCATION_STATE_KEY},
+            )
+    except ClientError as e:
+        logging.error(e)
+        raise Exception("Failed to snapshot location state")
+    return key
+
+
+def extends_calendar(cached_dim_date, calendar):
+    """
+    This function checks whether a calendar covers dates outside of the
+    cached one.
+
+    Args:
+        cached_dim_date (DataFrame): current calendar, or None
+        calendar (DataFrame): calendar built by a run
+
+    Returns:
+        extends (bool): True if the calendar should replace the cached one
+    """
+    if cached_dim_date is None or cached_dim_date.is_empty():
+        return True
+    return (
+        calendar["date_id"].min() < cached_dim_date["date_id"].min()
+        or calendar["date_id"].max() > cached_dim_date["date_id"].max()
     )
-    s3_client.upload_file(
-        Bucket=processed_data_bucket,
-        Filename="/tmp/dim_counterparty.parquet",
-        Key=f"/history/{prefix}/dim_counterparty.parquet",
+
+
+def extend_calendar_dim_date(cached_dim_date, referenced_dates):
+    """
+    This function makes sure the calendar covers every referenced date and works
+    out which dates still need to be emitted to the warehouse.
+
+    On the first run (no cached calendar) the calendar spans DIM_DATE_START to
+    DIM_DATE_END, widened to cover the referenced dates, and is emitted in full.
+    On later runs only the days added when extending the cached range are emitted.
+
+    Args:
+        cached_dim_date (DataFrame): calendar from get_cached_dim_date, or None
+        referenced_dates (Series): every date referenced by the fact table
+
+    Returns:
+        calendar (DataFrame): full calendar to cache for the next run
+        dim_date (DataFrame): dates outside the cached range
+    """
+    referenced_dates = referenced_dates.drop_nulls()
+
+    if cached_dim_date is None or cached_dim_date.is_empty():
+        start_date = dt.date.fromisoformat(DIM_DATE_START)
+        end_date = dt.date.fromisoformat(DIM_DATE_END)
+        if referenced_dates.len():
+            start_date = min(start_date, referenced_dates.min())
+            end_date = max(end_date, referenced_dates.max())
+        calendar = create_calendar_dim_date(start_date, end_date)
+        return calendar, calendar
+
+    cached_start = cached_dim_date["date_id"].min()
+    cached_end = cached_dim_date["date_id"].max()
+    start_date, end_date = cached_start, cached_end
+    if referenced_dates.len():
+        start_date = min(start_date, referenced_dates.min())
+        end_date = max(end_date, referenced_dates.max())
+
+    if start_date == cached_start and end_date == cached_end:
+        return cached_dim_date, cached_dim_date.clear()
+
+    calendar = create_calendar_dim_date(start_date, end_date)
+    return calendar, calendar_dates_not_cached(calendar, cached_dim_date)
+
+
+def calendar_dates_not_cached(calendar, cached_dim_date):
+    """
+    This function returns the calendar rows outside the cached calendar's range.
+
+    Args:
+        calendar (DataFrame): calendar covering every referenced date
+        cached_dim_date (DataFrame): calendar from get_cached_dim_date, or None
+
+    Returns:
+        dim_date (DataFrame): rows of calendar that have not been emitted yet
+    """
+    if cached_dim_date is None or cached_dim_date.is_empty():
+        return calendar
+    return calendar.filter(
+        (pl.col("date_id") < cached_dim_date["date_id"].min())
+        | (pl.col("date_id") > cached_dim_date["date_id"].max())
     )
+
+
+def upload_partitioned_fact_sales_order(
+    fact_sales_order,
+    s3_client,
+    processed_data_bucket,
+    prefix,
+    row_group_size=None,
+):
+    """
+    This function writes fact_sales_order as a hive-partitioned dataset, one
+    parquet file per created_date year/month, so readers can prune files by
+    partition and row groups by their min/max statistics.
+
+    Rows are sorted by created_date and sales_order_id before writing so the row
+    group statistics are tight. Writer settings come from the fact_sales_order
+    entry in parquet_config, with full statistics. Files are uploaded to:
+    /history/{prefix}/fact_sales_order/year=YYYY/month=MM/part-0.parquet
+
+    Args:
+        fact_sales_order (DataFrame): transformed fact table
+        s3_client (boto3 client): S3 client used to upload the files
+        processed_data_bucket (string): name of the processed data bucket
+        prefix (string): time prefix of the current run
+        row_group_size (int): maximum rows per row group, overrides the configured size
+
+    Returns:
+        keys (list): S3 keys of the uploaded partition files
+    """
+    settings = get_parquet_writer_settings("fact_sales_order")
+    settings["statistics"] = "full"
+    if row_group_size is not None:
+        settings["row_group_size"] = row_group_size
+
+    fact_sales_order = fact_sales_order.sort(["created_date", "sales_order_id"])
+    partitions = fact_sales_order.with_columns(
+        pl.col("created_date").dt.year().alias("year"),
+        pl.col("created_date").dt.month().alias("month"),
+    ).partition_by(["year", "month"], as_dict=True, maintain_order=True)
+
+    keys = []
+    for (year, month), partition in partitions.items():
+        buffer = BytesIO()
+        write_table_parquet(
+            partition.drop(["year", "month"]),
+            "fact_sales_order",
+            buffer,
+            settings=settings,
+        )
+        key = (
+            f"/history/{prefix}/fact_sales_order/"
+            f"year={year}/month={month:02d}/part-0.parquet"
+        )
+        s3_client.put_object(
+            Body=buffer.getvalue(), Bucket=processed_data_bucket, Key=key
+        )
+        keys.append(key)
+    return keys
+
+
+def upload_table_ipc(
+    df, table_name, s3_client, processed_data_bucket, prefix, work_dir="/tmp"
+):
+    """
+    This function writes a table as an uncompressed Arrow IPC file and uploads
+    it next to its parquet file, to /history/{prefix}/{table_name}.arrow.
+    Load can memory map these files instead of decoding parquet.
+
+    Args:
+        df (DataFrame): table to write
+        table_name (string): name of the table
+        s3_client (boto3 client): S3 client used to upload the file
+        processed_data_bucket (string): name of the processed data bucket
+        prefix (string): time prefix of the current run
+        work_dir (string): local directory the file is written to
+
+    Returns:
+        key (string): S3 key of the uploaded file
+    """
+    path = os.path.join(work_dir, f"{table_name}.arrow")
+    df.write_ipc(path, compression="uncompressed")
+    key = f"/history/{prefix}/{table_name}.arrow"
     s3_client.upload_file(
         Bucket=processed_data_bucket,
-        Filename="/tmp/dim_date.parquet",
-        Key=f"/history/{prefix}/dim_date.parquet",
+        Filename=path,
+        Key=key,
     )
-    s3_client.upload_file(
-        Bucket=processed_data_bucket,
-        Filename="/tmp/dim_currency.parquet",
-        Key=f"/history/{prefix}/dim_currency.parquet",
+    return key
+
+
+def summarise_sales_order_csv(csv_path):
+    """
+    This function scans a sales_order csv with the streaming engine and keeps
+    only what the other star schema tables need from it: the distinct dates
+    referenced by fact_sales_order and the distinct delivery locations.
+
+    Args:
+        csv_path (string): path of the downloaded sales_order csv
+
+    Returns:
+        sources (dict): "sales_order" (agreed_delivery_location_id) and
+            "sales_order_dates" (date) DataFrames
+    """
+    sales_order = pl.scan_csv(csv_path)
+    dates = pl.concat(
+        [
+            sales_order.select(_as_date(column).alias("date"))
+            for column in [
+                "created_at", "last_updated",
+                "agreed_delivery_date", "agreed_payment_date",
+            ]
+        ]
+    ).unique()
+    locations = sales_order.select(
+        pl.col("agreed_delivery_location_id").cast(pl.Int64)
+    ).unique()
+    dates, locations = pl.collect_all([dates, locations], streaming=True)
+    return {"sales_order": locations, "sales_order_dates": dates}
+
+
+def streaming_star_schema_specs():
+    """
+    Returns STAR_SCHEMA_SPECS for streaming mode: fact_sales_order is left out
+    (it is written by upload_streamed_fact_sales_order) and the calendar uses
+    the summarised sales_order dates instead.
+    """
+    specs = []
+    for spec in STAR_SCHEMA_SPECS:
+        if spec["name"] == "fact_sales_order":
+            continue
+        if spec["name"] == "calendar":
+            spec = dict(
+                spec,
+                inputs=[
+                    "sales_order_dates" if name == "fact_sales_order" else name
+                    for name in spec["inputs"]
+                ],
+            )
+        specs.append(spec)
+    return specs
+
+
+def streaming_chunk_rows(csv_path, memory_budget):
+    """
+    Works out how many rows the streaming engine may process per chunk so that
+    every polars thread holding a chunk, plus the row group being written, fit
+    in the memory budget. Row size is estimated from the first rows of the csv.
+    """
+    sample = pl.read_csv(csv_path, n_rows=1000)
+    bytes_per_row = max(sample.estimated_size() // max(sample.height, 1), 1)
+    in_flight = 2 * (pl.thread_pool_size() + 1)
+    return max(memory_budget // (bytes_per_row * in_flight), 1000)
+
+
+def upload_streamed_fact_sales_order(
+    csv_path,
+    location_keys,
+    s3_client,
+    processed_data_bucket,
+    prefix,
+    memory_budget=TRANSFORM_MEMORY_BUDGET_BYTES,
+    work_dir="/tmp",
+):
+    """
+    This function builds fact_sales_order from a sales_order csv with the
+    polars streaming engine and sinks it to parquet, so peak memory depends on
+    the memory budget rather than the size of the csv. Row groups are capped
+    at the chunk size. With the partitioned layout the csv is read once into a
+    local parquet file sorted by created_date and sales_order_id, then every
+    month is sunk to its own file from the row groups of that month, sorted as
+    upload_partitioned_fact_sales_order sorts them.
+    With TRANSFORM_IPC_OUTPUT the Arrow IPC copy is read back from the local
+    parquet file, so the csv is read once in either layout.
+
+    Args:
+        csv_path (string): path of the downloaded sales_order csv
+        location_keys (DataFrame): dim_location key map of this run
+        s3_client (boto3 client): S3 client used to upload the files
+        processed_data_bucket (string): name of the processed data bucket
+        prefix (string): time prefix of the current run
+        memory_budget (int): approximate bytes the fact may hold at once
+        work_dir (string): local directory the files are written to
+
+    Returns:
+        keys (list): S3 keys of the uploaded files
+    """
+    fact_spec = next(
+        spec for spec in STAR_SCHEMA_SPECS if spec["name"] == "fact_sales_order"
+    )
+    fact_sales_order = build_table(
+        dict(fact_spec, transform=_with_lazy_fact_location_key("sales_order")),
+        {"sales_order": pl.scan_csv(csv_path), "location_keys": location_keys},
     )
 
-    for file in os.listdir("/tmp/"):
-        if "csv" in file or "parquet" in file:
-            os.remove(f"/tmp/{file}")
+    chunk_rows = streaming_chunk_rows(csv_path, memory_budget)
+    settings = get_parquet_writer_settings("fact_sales_order")
+    row_group_size = min(settings["row_group_size"] or chunk_rows, chunk_rows)
+
+    parquet_path = os.path.join(work_dir, "fact_sales_order.parquet")
+    sorted_path = os.path.join(work_dir, "fact_sales_order_sorted.parquet")
+    ipc_path = os.path.join(work_dir, "fact_sales_order.arrow")
+
+    def sink(lazy_frame, key):
+        lazy_frame.sink_parquet(
+            parquet_path,
+            compression=settings["compression"],
+            compression_level=settings["compression_level"],
+            statistics=settings["statistics"],
+            row_group_size=row_group_size,
+        )
+        s3_client.upload_file(
+            Bucket=processed_data_bucket,
+            Filename=parquet_path,
+            Key=key,
+        )
+        return key
+
+    keys = []
+    with pl.Config(streaming_chunk_size=chunk_rows):
+        if FACT_SALES_ORDER_LAYOUT == "partitioned":
+            # the only pass over the csv, months are then read back by their
+            # row group statistics
+            fact_sales_order.sort(["created_date", "sales_order_id"]).sink_parquet(
+                sorted_path,
+                compression="uncompressed",
+                statistics=True,
+                row_group_size=row_group_size,
+            )
+            fact_sales_order = pl.scan_parquet(sorted_path)
+            months = (
+                fact_sales_order.select(
+                    pl.col("created_date").dt.year().alias("year"),
+                    pl.col("created_date").dt.month().alias("month"),
+                )
+                .unique()
+                .sort(["year", "month"])
+                .collect(streaming=True)
+            )
+            for year, month in months.iter_rows():
+                first_day = dt.date(year, month, 1)
+                next_month = dt.date(year + month // 12, month % 12 + 1, 1)
+                keys.append(
+                    sink(
+                        fact_sales_order.filter(
+                            (pl.col("created_date") >= first_day)
+                            & (pl.col("created_date") < next_month)
+                        ),
+                        f"/history/{prefix}/fact_sales_order/"
+                        f"year={year}/month={month:02d}/part-0.parquet",
+                    )
+                )
+        else:
+            keys.append(
+                sink(fact_sales_order, f"/history/{prefix}/fact_sales_order.parquet")
+            )
+            fact_sales_order = pl.scan_parquet(parquet_path)
+
+        if TRANSFORM_IPC_OUTPUT:
+            # read back from the local parquet file, the csv is only read once
+            fact_sales_order.sink_ipc(ipc_path, compression=None)
+            key = f"/history/{prefix}/fact_sales_order.arrow"
+            s3_client.upload_file(
+                Bucket=processed_data_bucket,
+                Filename=ipc_path,
+                Key=key,
+            )
+            keys.append(key)
+    if os.path.exists(sorted_path):
+        os.remove(sorted_path)
+    return keys
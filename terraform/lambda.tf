@@ -41,6 +41,31 @@ data "archive_file" "transform_lambda" {
     filename = "src/utils/transform_utils.py"
   }
 
+  source {
+    content  = file("${path.module}/../src/utils/parquet_config.py")
+    filename = "src/utils/parquet_config.py"
+  }
+
+  source {
+    content  = file("${path.module}/../src/utils/transform_engine.py")
+    filename = "src/utils/transform_engine.py"
+  }
+
+  source {
+    content  = file("${path.module}/../src/utils/key_maps.py")
+    filename = "src/utils/key_maps.py"
+  }
+
+  source {
+    content  = file("${path.module}/../src/utils/transform_cache.py")
+    filename = "src/utils/transform_cache.py"
+  }
+
+  source {
+    content  = file("${path.module}/../src/utils/transform_metrics.py")
+    filename = "src/utils/transform_metrics.py"
+  }
+
   output_path = "${path.module}/../zip_code/transform.zip"
 }
 
@@ -86,6 +111,9 @@ resource "aws_lambda_function" "extract_lambda" { #Provision the lambda
   timeout          = 120
 }
 
+# the load downloads each time prefix's fact table whole to /tmp before
+# copying it in batches, so ephemeral storage must hold the largest fact
+# table, uncompressed if transform writes Arrow IPC copies
 resource "aws_lambda_function" "load_lambda" { #Provision the lambda
   s3_bucket        = aws_s3_bucket.lambda_bucket.id
   s3_key           = aws_s3_object.load_lambda_zip.key
@@ -96,6 +124,9 @@ resource "aws_lambda_function" "load_lambda" { #Provision the lambda
   runtime          = var.python_runtime
   handler          = "load.lambda_handler"
   timeout          = 120
+  ephemeral_storage {
+    size = var.load_ephemeral_storage_mb
+  }
 }
 
 resource "aws_lambda_function" "transform_lambda" { #Provision the lambda
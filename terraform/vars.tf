@@ -85,4 +85,9 @@ variable "DW_HT" {
   description = "Data warehouse host"
   type        = string
   sensitive   = true
-}
\ No newline at end of file
+}
+variable "load_ephemeral_storage_mb" {
+  description = "Size of the load lambda's /tmp, must hold the largest fact table of a time prefix"
+  type        = number
+  default     = 4096
+}
@@ -0,0 +1,188 @@
+import pytest
+import boto3
+import os
+import polars as pl
+import datetime as dt
+from io import BytesIO
+from moto import mock_aws
+from unittest.mock import patch
+from src.backfill import (
+    run_backfill,
+    list_history_prefixes,
+    parse_time_prefix,
+    fetch_input,
+)
+from src.utils.transform_utils import (
+    create_star_schema_from_sales_order_csv_file,
+    DIM_DATE_CACHE_KEY,
+)
+
+RAW = "totesys-raw-data-000000"
+PROCESSED = "totesys-processed-data-000000"
+FIRST = "2024/11/01/09:00:00/"
+SECOND = "2024/11/01/09:30:00/"
+TABLES = ["fact_sales_order", "dim_date", "dim_location", "dim_counterparty", "dim_staff"]
+
+SOURCES = {
+    "department": """department_id,department_name,location,manager,created_at,last_updated
+2,Purchasing,Manchester,Naomi Lapaglia,2022-11-03 14:20:49.962000,2022-11-03 14:20:49.962000""",
+    "staff": """staff_id,first_name,last_name,department_id,email_address,created_at,last_updated
+1,Jeremie,Franey,2,jeremie.franey@terrifictotes.com,2022-11-03 14:20:51.563000,2022-11-03 14:20:51.563000""",
+    "counterparty": """counterparty_id,counterparty_legal_name,legal_address_id,commercial_contact,delivery_contact,created_at,last_updated
+1,Fahey and Sons,2,Micheal Toy,Mrs. Lucy Runolfsdottir,2022-11-03 14:20:51.563000,2022-11-03 14:20:51.563000""",
+    "currency": """currency_id,currency_code,created_at,last_updated
+1,GBP,2022-11-03 14:20:49.962000,2022-11-03 14:20:49.962000""",
+    "address": """address_id,address_line_1,address_line_2,district,city,postal_code,country,phone,created_at,last_updated
+2,179 Alexie Cliffs,,,Aliso Viejo,99305-7380,San Marino,9621 880720,2022-11-03 14:20:49.962000,2022-11-03 14:20:49.962000""",
+    "design": """design_id,created_at,design_name,file_location,file_name,last_updated
+8,2022-11-03 14:20:49.962000,Wooden,/usr,wooden-20220717-npgz.json,2022-11-03 14:20:49.962000""",
+    "purchase_order": """purchase_order_id,created_at,last_updated,staff_id,counterparty_id,item_code,item_quantity,item_unit_price,currency_id,agreed_delivery_date,agreed_payment_date,agreed_delivery_location_id
+1,2022-11-03 14:20:52.187000,2022-11-03 14:20:52.187000,1,1,ZDOI5EA,371,361.39,1,2022-11-09,2022-11-07,2""",
+    "payment": """payment_id,created_at,last_updated,transaction_id,counterparty_id,payment_amount,currency_id,payment_type_id,paid,payment_date,company_ac_number,counterparty_ac_number
+2,2022-11-03 14:20:52.186000,2022-11-03 14:20:52.186000,2,1,552548.62,1,3,False,2022-11-04,67305075,31622269""",
+    "transaction": """transaction_id,transaction_type,sales_order_id,purchase_order_id,created_at,last_updated
+2,PURCHASE,,1,2022-11-03 14:20:52.187000,2022-11-03 14:20:52.187000""",
+}
+SALES_ORDER_HEADER = "sales_order_id,created_at,last_updated,design_id,staff_id,counterparty_id,units_sold,unit_price,currency_id,agreed_delivery_date,agreed_payment_date,agreed_delivery_location_id"
+SALES_ORDERS = {
+    FIRST: "2,2022-11-03 14:20:52.186000,2022-11-03 14:20:52.186000,8,1,1,42972,3.94,1,2022-11-07,2022-11-08,2",
+    # a delivery location and dates that are new in the second prefix
+    SECOND: "3,2031-01-02 10:00:00.000000,2031-01-02 10:00:00.000000,8,1,1,65839,2.91,1,2031-01-06,2031-01-07,40",
+}
+
+
+@pytest.fixture(scope="function")
+def aws_credentials():
+    """Mocked AWS Credentials for S3 bucket."""
+    os.environ["AWS_ACCESS_KEY_ID"] = "test"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "test"
+    os.environ["AWS_SECURITY_TOKEN"] = "test"
+    os.environ["AWS_SESSION_TOKEN"] = "test"
+    os.environ["AWS_DEFAULT_REGION"] = "eu-west-2"
+
+
+@pytest.fixture(scope="function")
+def s3(aws_credentials):
+    """Mocked S3 client with two history prefixes in the raw data bucket."""
+    with mock_aws():
+        s3 = boto3.client("s3")
+        for bucket in [RAW, PROCESSED]:
+            s3.create_bucket(
+                Bucket=bucket,
+                CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+            )
+        for prefix, sales_order in SALES_ORDERS.items():
+            for table, body in SOURCES.items():
+                s3.put_object(
+                    Body=body, Bucket=RAW, Key=f"/history/{prefix}{table}_differences.csv"
+                )
+            s3.put_object(
+                Body=f"{SALES_ORDER_HEADER}\n{sales_order}",
+                Bucket=RAW,
+                Key=f"/history/{prefix}sales_order_differences.csv",
+            )
+        yield s3
+
+
+def read_outputs(s3):
+    outputs = {}
+    for prefix in SALES_ORDERS:
+        for table in TABLES:
+            res = s3.get_object(Bucket=PROCESSED, Key=f"/history/{prefix}/{table}.parquet")
+            outputs[(prefix, table)] = pl.read_parquet(BytesIO(res["Body"].read()))
+    return outputs
+
+
+def empty_processed_bucket(s3):
+    for obj in s3.list_objects(Bucket=PROCESSED).get("Contents", []):
+        s3.delete_object(Bucket=PROCESSED, Key=obj["Key"])
+
+
+class TestListHistoryPrefixes:
+    @pytest.mark.it("Parses time prefixes")
+    def test_parse_time_prefix(self):
+        assert parse_time_prefix(FIRST) == dt.datetime(2024, 11, 1, 9)
+        assert parse_time_prefix("source/") is None
+
+    @pytest.mark.it("Lists the prefixes in the time range in order")
+    def test_list_prefixes(self, s3):
+        prefixes = list_history_prefixes(
+            s3, RAW, dt.datetime(2024, 11, 1), dt.datetime(2024, 11, 2)
+        )
+        assert list(prefixes) == [FIRST, SECOND]
+        assert prefixes[FIRST]["staff"][0] == f"/history/{FIRST}staff_differences.csv"
+        prefixes = list_history_prefixes(
+            s3, RAW, dt.datetime(2024, 11, 1, 9, 15), dt.datetime(2024, 11, 2)
+        )
+        assert list(prefixes) == [SECOND]
+
+    @pytest.mark.it("Raises an exception when a prefix is missing a differences file")
+    def test_incomplete_prefix(self, s3):
+        s3.delete_object(Bucket=RAW, Key=f"/history/{FIRST}staff_differences.csv")
+        with pytest.raises(Exception):
+            list_history_prefixes(
+                s3, RAW, dt.datetime(2024, 11, 1), dt.datetime(2024, 11, 2)
+            )
+
+
+class TestRunBackfill:
+    @pytest.mark.it("Produces the same outputs as transforming the prefixes one by one")
+    def test_matches_sequential_runs(self, s3, tmp_path):
+        for prefix in SALES_ORDERS:
+            create_star_schema_from_sales_order_csv_file(prefix)
+        expected = read_outputs(s3)
+        empty_processed_bucket(s3)
+
+        result = run_backfill(
+            dt.datetime(2024, 11, 1), dt.datetime(2024, 11, 2),
+            processes=1, work_dir=str(tmp_path),
+        )
+
+        assert result == [FIRST, SECOND]
+        outputs = read_outputs(s3)
+        for key, df in expected.items():
+            assert outputs[key].equals(df), key
+        assert outputs[(SECOND, "dim_date")]["date_id"].min() == dt.date(2031, 1, 1)
+        s3.head_object(Bucket=PROCESSED, Key=DIM_DATE_CACHE_KEY)
+        s3.head_object(Bucket=PROCESSED, Key="/key_maps/dim_location.parquet")
+
+    @pytest.mark.it("Downloads files shared by several prefixes only once")
+    def test_shared_inputs_downloaded_once(self, s3, tmp_path):
+        with patch("src.backfill.fetch_input", wraps=fetch_input) as fetch:
+            run_backfill(
+                dt.datetime(2024, 11, 1), dt.datetime(2024, 11, 2),
+                processes=1, work_dir=str(tmp_path),
+            )
+        # nine identical dimension files and two different sales_order files
+        assert fetch.call_count == 11
+        assert not os.path.exists(tmp_path / "inputs")
+
+    @pytest.mark.it("Keeps the dim_date output of prefixes that are reprocessed")
+    def test_keeps_dim_date_of_processed_prefixes(self, s3, tmp_path):
+        for prefix in SALES_ORDERS:
+            create_star_schema_from_sales_order_csv_file(prefix)
+        expected = read_outputs(s3)
+        assert expected[(FIRST, "dim_date")].height > 0
+
+        run_backfill(
+            dt.datetime(2024, 11, 1), dt.datetime(2024, 11, 2),
+            processes=1, work_dir=str(tmp_path),
+        )
+
+        outputs = read_outputs(s3)
+        for key, df in expected.items():
+            assert outputs[key].equals(df), key
+
+    @pytest.mark.it("Stops at the first prefix that fails to load")
+    def test_stops_at_first_failed_load(self, s3, tmp_path):
+        with patch(
+            "src.utils.load_utils.load_time_prefix", side_effect=Exception("load failed")
+        ) as load:
+            with pytest.raises(Exception, match="load failed"):
+                run_backfill(
+                    dt.datetime(2024, 11, 1), dt.datetime(2024, 11, 2),
+                    load=True, processes=1, work_dir=str(tmp_path),
+                )
+        load.assert_called_once_with(FIRST)
+        with pytest.raises(Exception):
+            s3.head_object(Bucket=PROCESSED, Key=DIM_DATE_CACHE_KEY)
@@ -0,0 +1,85 @@
+import pytest
+import boto3
+import os
+import polars as pl
+from moto import mock_aws
+from src.utils.key_maps import (
+    get_key_map,
+    put_key_map,
+    extend_key_map,
+    lookup_surrogate_keys,
+    KEY_MAP_SCHEMA,
+)
+
+
+@pytest.fixture(scope="function")
+def aws_credentials():
+    """Mocked AWS Credentials for S3 bucket."""
+    os.environ["AWS_ACCESS_KEY_ID"] = "test"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "test"
+    os.environ["AWS_SECURITY_TOKEN"] = "test"
+    os.environ["AWS_SESSION_TOKEN"] = "test"
+    os.environ["AWS_DEFAULT_REGION"] = "eu-west-2"
+
+
+@pytest.fixture(scope="function")
+def s3(aws_credentials):
+    """Mocked S3 client with processed data bucket."""
+    with mock_aws():
+        s3 = boto3.client("s3")
+        s3.create_bucket(
+            Bucket="totesys-processed-data-000000",
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        yield s3
+
+
+@pytest.fixture(scope="function")
+def key_map():
+    return extend_key_map(
+        pl.DataFrame(schema=KEY_MAP_SCHEMA), pl.Series([30, 10, 20])
+    )
+
+
+class TestExtendKeyMap:
+    @pytest.mark.it("Numbers new natural keys in order starting from 1")
+    def test_new_key_map(self, key_map):
+        assert key_map.rows() == [(10, 1), (20, 2), (30, 3)]
+
+    @pytest.mark.it("Appends only unseen natural keys after the highest surrogate key")
+    def test_extend(self, key_map):
+        extended = extend_key_map(key_map, pl.Series([20, 5, None, 40, 5]))
+        assert extended.rows() == [(5, 4), (10, 1), (20, 2), (30, 3), (40, 5)]
+
+    @pytest.mark.it("Returns the same key map when there are no new keys")
+    def test_no_new_keys(self, key_map):
+        assert extend_key_map(key_map, pl.Series([10, 30])) is key_map
+
+
+class TestLookupSurrogateKeys:
+    @pytest.mark.it("Looks up surrogate keys and returns null for unknown keys")
+    def test_lookup(self, key_map):
+        result = lookup_surrogate_keys(key_map, pl.Series("id", [30, 15, None, 10, 99]))
+        assert result.name == "id"
+        assert result.to_list() == [3, None, None, 1, None]
+
+    @pytest.mark.it("Returns nulls when the key map is empty")
+    def test_empty_key_map(self):
+        result = lookup_surrogate_keys(
+            pl.DataFrame(schema=KEY_MAP_SCHEMA), pl.Series([1, 2])
+        )
+        assert result.to_list() == [None, None]
+
+
+class TestKeyMapStorage:
+    @pytest.mark.it("Returns an empty key map when none is stored")
+    def test_missing_key_map(self, s3):
+        key_map = get_key_map(s3, "totesys-processed-data-000000", "dim_location")
+        assert key_map.is_empty()
+        assert key_map.schema == KEY_MAP_SCHEMA
+
+    @pytest.mark.it("Round trips a key map through the processed data bucket")
+    def test_round_trip(self, s3, key_map):
+        put_key_map(s3, "totesys-processed-data-000000", "dim_location", key_map)
+        result = get_key_map(s3, "totesys-processed-data-000000", "dim_location")
+        assert result.equals(key_map)
@@ -6,6 +6,29 @@ from src.utils.load_utils import (
     find_processed_data_bucket,
     get_secret,
     connect_to_db,
+    read_fact_sales_order,
+    read_processed_table,
+    ipc_cache_dir,
+    copy_dataframe,
+    upsert_dataframe,
+    LoadSession,
+    load_time_prefix,
+    TablePrefetcher,
+    iter_batches,
+    scan_processed_table,
+    get_processed_table_etag,
+    copy_fact_partitions,
+    use_bulk_mode,
+    bulk_load_mode,
+    split_fact_references,
+    check_fact_references,
+    merge_scd2_dimension,
+    add_row_hash,
+    time_prefix_datetime,
+    merge_aggregates,
+    aggregate_daily_sales,
+    combine_daily_sales,
+    FACT_REFERENCES,
     populate_fact_sales,
     populate_dim_counterparty,
     populate_dim_currency,
@@ -19,9 +42,12 @@ from dotenv import load_dotenv, find_dotenv
 import json
 import polars as pl
 from io import BytesIO
-from unittest.mock import patch
+from unittest.mock import patch, MagicMock
+from botocore.exceptions import ClientError
+from time import sleep
 import numpy as np
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, time
+from decimal import Decimal
 
 env_file = find_dotenv(f'.env.{os.getenv("ENV")}')
 load_dotenv(env_file)
@@ -89,15 +115,15 @@ def s3_with_parquet(aws_credentials):
             "created_time": [(datetime(2023, 12, 1) - timedelta(hours=i)).time() for i in range(5)],  # Mock timestamps
             "last_updated_date": [(datetime(2024, 1, 1) - timedelta(days=i)).date() for i in range(5)],
             "last_updated_time":  [(datetime(2024, 1, 1) - timedelta(hours=i)).time() for i in range(5)],  # Mock timestamps
-            "design_id": np.random.randint(1, 10, 5),  # Random design IDs
-            "staff_id": np.random.randint(1, 10, 5),  # Random staff IDs
-            "counterparty_id": [10 - i for i in range(5)],  # NOT Random counterparty IDs
+            "design_id": np.random.randint(1, 6, 5),  # Random design IDs
+            "staff_id": np.random.randint(1, 6, 5),  # Random staff IDs
+            "counterparty_id": [5 - i for i in range(5)],  # NOT Random counterparty IDs
             "units_sold": [1000, 2000, 3000, 4000, 5000],  # Random units sold
             "unit_price": np.random.uniform(2.0, 4.0, 5).round(2),  # Random unit price
             "currency_id": np.random.choice([1, 2, 3], 5),  # Random currency IDs (e.g., 1=USD, 2=EUR, 3=GBP)
             "agreed_delivery_date": [(datetime.now() + timedelta(days=i)).strftime('%Y-%m-%d') for i in range(5)],  # Future dates
             "agreed_payment_date": [(datetime.now() + timedelta(days=i+10)).strftime('%Y-%m-%d') for i in range(5)],  # Future dates
-            "agreed_delivery_location_id": np.random.randint(1, 10, 5),  # Random delivery location IDs
+            "agreed_delivery_location_id": np.random.randint(1, 6, 5),  # Random delivery location IDs
         }
         df = pl.DataFrame(data)
         data_buffer_parquet = BytesIO()
@@ -286,6 +312,9 @@ def run_seed(db):
     db.run("TRUNCATE dim_currency RESTART IDENTITY CASCADE")
     db.run("TRUNCATE dim_design RESTART IDENTITY CASCADE;")
     db.run("TRUNCATE dim_counterparty RESTART IDENTITY CASCADE;")
+    db.run("TRUNCATE load_ledger;")
+    for summary in ["currency", "design", "counterparty", "location"]:
+        db.run(f"TRUNCATE agg_daily_sales_by_{summary};")
     yield
     db.close()
 
@@ -300,6 +329,961 @@ class TestFindBucket:
         assert find_processed_data_bucket() == "No processed data bucket found"
 
 
+class TestReadFactSalesOrder:
+
+    def test_reads_single_file_layout(self, s3_with_parquet):
+        df = read_fact_sales_order(
+            s3_with_parquet, "totesys-processed-data-000000", MOCK_TIME_PATH
+        )
+        assert df["units_sold"].to_list() == [1000, 2000, 3000, 4000, 5000]
+
+    def test_reads_partitioned_layout(self, s3):
+        for month, units in [(11, [10, 20]), (12, [30])]:
+            buffer = BytesIO()
+            pl.DataFrame({"units_sold": units}).write_parquet(buffer)
+            s3.put_object(
+                Body=buffer.getvalue(),
+                Bucket="totesys-processed-data-000000",
+                Key=f'/history/{MOCK_TIME_PATH}/fact_sales_order/year=2022/month={month}/part-0.parquet'
+            )
+        df = read_fact_sales_order(
+            s3, "totesys-processed-data-000000", MOCK_TIME_PATH
+        )
+        assert sorted(df["units_sold"].to_list()) == [10, 20, 30]
+
+
+class TestReadProcessedTable:
+
+    def test_reads_parquet_when_there_is_no_ipc_file(self, s3_with_parquet, tmp_path):
+        with patch("src.utils.load_utils.LOAD_CACHE_DIR", str(tmp_path)):
+            df = read_processed_table(
+                s3_with_parquet, "totesys-processed-data-000000",
+                MOCK_TIME_PATH, "fact_sales_order"
+            )
+        assert df["units_sold"].to_list() == [1000, 2000, 3000, 4000, 5000]
+
+    def test_reads_ipc_file_and_caches_it_by_etag(self, s3, tmp_path):
+        def upload(values):
+            pl.DataFrame({"currency_id": values}).write_ipc(
+                tmp_path / "upload.arrow", compression="uncompressed"
+            )
+            s3.upload_file(
+                Filename=str(tmp_path / "upload.arrow"),
+                Bucket="totesys-processed-data-000000",
+                Key=f'/history/{MOCK_TIME_PATH}/dim_currency.arrow'
+            )
+
+        upload([1, 2])
+        cache_dir = tmp_path / "cache"
+        with patch("src.utils.load_utils.LOAD_CACHE_DIR", str(cache_dir)), \
+                patch.object(s3, "download_file", wraps=s3.download_file) as download:
+            for _ in range(2):
+                df = read_processed_table(
+                    s3, "totesys-processed-data-000000", MOCK_TIME_PATH, "dim_currency"
+                )
+                assert df["currency_id"].to_list() == [1, 2]
+            assert download.call_count == 1
+
+            # a table rewritten under the same prefix is not served from the cache
+            upload([3])
+            df = read_processed_table(
+                s3, "totesys-processed-data-000000", MOCK_TIME_PATH, "dim_currency"
+            )
+            assert df["currency_id"].to_list() == [3]
+            assert download.call_count == 2
+            assert len(os.listdir(ipc_cache_dir(MOCK_TIME_PATH))) == 2
+
+    @patch('src.utils.load_utils.connect_to_db')
+    @patch('src.utils.load_utils.get_secret')
+    def test_load_removes_the_cached_ipc_files(
+        self, mock_get_secret, mock_connect, s3_with_parquet, tmp_path
+    ):
+        read_processed_table(
+            s3_with_parquet, "totesys-processed-data-000000", MOCK_TIME_PATH, "dim_currency"
+        ).write_ipc(tmp_path / "upload.arrow", compression="uncompressed")
+        s3_with_parquet.upload_file(
+            Filename=str(tmp_path / "upload.arrow"),
+            Bucket="totesys-processed-data-000000",
+            Key=f'/history/{MOCK_TIME_PATH}/dim_currency.arrow'
+        )
+        mock_connect.return_value.run.side_effect = recording_run([])
+        cache_dir = tmp_path / "cache"
+        with patch("src.utils.load_utils.LOAD_CACHE_DIR", str(cache_dir)), \
+                patch("src.utils.load_utils.pl.read_ipc", wraps=pl.read_ipc) as read_ipc:
+            load_time_prefix(MOCK_TIME_PATH)
+            assert read_ipc.called
+            assert not os.path.exists(ipc_cache_dir(MOCK_TIME_PATH))
+
+
+class TestCopyDataframe:
+
+    def test_copies_dataframe_as_csv_in_one_transaction(self):
+        db = MagicMock()
+        copied = []
+        db.run.side_effect = lambda sql, stream=None: copied.append(
+            (sql, stream.read() if stream else None)
+        )
+        df = pl.DataFrame({
+            "id": [1, 2],
+            "name": ["O'Hara, Christy", None],
+            "district": ['say "hi"', ""],
+            "created_time": [time(14, 20, 52, 186000), time(9, 0)],
+        })
+        copy_dataframe(db, "dim_test", df, ["id", "name", "district", "created_time"])
+
+        assert [sql for sql, _ in copied] == [
+            "START TRANSACTION",
+            'COPY "dim_test" ("id", "name", "district", "created_time") '
+            'FROM STDIN WITH (FORMAT csv)',
+            "COMMIT",
+        ]
+        assert copied[1][1] == (
+            b'1,"O\'Hara, Christy","say ""hi""",14:20:52.186000\n'
+            b'2,,"",09:00:00.000000\n'
+        )
+
+    def test_rolls_back_when_copy_fails(self):
+        db = MagicMock()
+        db.run.side_effect = [None, Exception("copy failed"), None]
+        with pytest.raises(Exception):
+            copy_dataframe(db, "dim_test", pl.DataFrame({"id": [1]}), ["id"])
+        assert db.run.call_args_list[-1].args == ("ROLLBACK",)
+
+
+class TestUpsertDataframe:
+
+    def test_stages_rows_and_upserts_changed_rows(self):
+        db = MagicMock()
+        statements = []
+        db.run.side_effect = lambda sql, stream=None: statements.append(
+            (sql, stream.read() if stream else None)
+        )
+        df = pl.DataFrame({
+            "currency_id": [1, 2, 1],
+            "currency_code": ["GBP", "USD", "EUR"],
+        })
+        upsert_dataframe(
+            db, "dim_currency", df, ["currency_id", "currency_code"], ["currency_id"]
+        )
+
+        assert [sql for sql, _ in statements] == [
+            "START TRANSACTION",
+            'CREATE TEMPORARY TABLE "staging_dim_currency" '
+            '(LIKE "dim_currency" INCLUDING DEFAULTS) ON COMMIT DROP',
+            'COPY "staging_dim_currency" ("currency_id", "currency_code") '
+            'FROM STDIN WITH (FORMAT csv)',
+            'INSERT INTO "dim_currency" ("currency_id", "currency_code") '
+            'SELECT "currency_id", "currency_code" FROM "staging_dim_currency" '
+            'ON CONFLICT ("currency_id") DO UPDATE SET '
+            '"currency_code" = EXCLUDED."currency_code" '
+            'WHERE ROW("dim_currency"."currency_code") '
+            'IS DISTINCT FROM ROW(EXCLUDED."currency_code")',
+            "COMMIT",
+        ]
+        # the last row of a duplicated key wins
+        assert statements[2][1] == b"2,USD\n1,EUR\n"
+
+    def test_rolls_back_when_upsert_fails(self):
+        db = MagicMock()
+        db.run.side_effect = [None, None, None, Exception("upsert failed"), None]
+        with pytest.raises(Exception):
+            upsert_dataframe(
+                db, "dim_test", pl.DataFrame({"id": [1], "name": ["a"]}),
+                ["id", "name"], ["id"]
+            )
+        assert db.run.call_args_list[-1].args == ("ROLLBACK",)
+
+    def test_inserts_only_new_keys_without_update(self):
+        db = MagicMock()
+        upsert_dataframe(
+            db, "dim_date", pl.DataFrame({"date_id": [1], "year": [2024]}),
+            ["date_id", "year"], ["date_id"], update=False
+        )
+        assert db.run.call_args_list[3].args == (
+            'INSERT INTO "dim_date" ("date_id", "year") '
+            'SELECT "date_id", "year" FROM "staging_dim_date" '
+            'ON CONFLICT ("date_id") DO NOTHING',
+        )
+
+
+def recording_run(statements, fail_on=None):
+    '''
+    Returns a mock Connection.run recording every statement. Nothing is in
+    the load ledger, the catalog or the current versions of type 2
+    dimensions, dimension key queries return the keys 1 to 10 and statements
+    starting with fail_on raise.
+    '''
+    def run(sql, stream=None, **params):
+        statements.append(sql)
+        if fail_on and sql.startswith(fail_on):
+            raise Exception(f"{fail_on} failed")
+        if sql.startswith('SELECT "etag"') or "pg_class" in sql or '"row_hash"' in sql:
+            return []
+        if sql.startswith("SELECT"):
+            return [[key] for key in range(1, 11)]
+    return run
+
+
+class TestLoadSession:
+
+    @patch('src.utils.load_utils.connect_to_db')
+    @patch('src.utils.load_utils.get_secret')
+    def test_loads_every_table_in_one_transaction(
+        self, mock_get_secret, mock_connect, s3_with_parquet
+    ):
+        statements = []
+        db = MagicMock()
+        db.run.side_effect = recording_run(statements)
+        mock_connect.return_value = db
+        with LoadSession() as session:
+            populate_dim_staff(MOCK_TIME_PATH, session)
+            populate_dim_date(MOCK_TIME_PATH, session)
+            populate_fact_sales(MOCK_TIME_PATH, session)
+
+        mock_get_secret.assert_called_once()
+        mock_connect.assert_called_once()
+        assert statements.count("START TRANSACTION") == 1
+        assert statements.count("COMMIT") == 1
+        assert statements[0] == "START TRANSACTION"
+        assert statements[-1] == "COMMIT"
+        assert 'DROP TABLE "staging_dim_staff"' in statements
+        db.close.assert_called_once()
+
+    @patch('src.utils.load_utils.connect_to_db')
+    @patch('src.utils.load_utils.get_secret')
+    def test_rolls_back_the_whole_run_when_a_load_fails(
+        self, mock_get_secret, mock_connect, s3_with_parquet
+    ):
+        statements = []
+        db = MagicMock()
+        db.run.side_effect = recording_run(statements, 'COPY "fact_sales_order_y')
+        mock_connect.return_value = db
+        with pytest.raises(Exception):
+            with LoadSession() as session:
+                populate_dim_staff(MOCK_TIME_PATH, session)
+                populate_fact_sales(MOCK_TIME_PATH, session)
+
+        assert "COMMIT" not in statements
+        assert statements[-1] == "ROLLBACK"
+        db.close.assert_called_once()
+
+    @patch('src.utils.load_utils.connect_to_db')
+    @patch('src.utils.load_utils.get_secret')
+    def test_populate_without_session_opens_its_own(
+        self, mock_get_secret, mock_connect, s3_with_parquet
+    ):
+        statements = []
+        db = MagicMock()
+        db.run.side_effect = recording_run(statements)
+        mock_connect.return_value = db
+        ret = populate_dim_staff(MOCK_TIME_PATH)
+
+        assert ret == 'SQL table dim_staff successfully populated'
+        assert statements[0] == "START TRANSACTION"
+        assert statements[-1] == "COMMIT"
+        db.close.assert_called_once()
+
+    @patch('src.utils.load_utils.connect_to_db')
+    @patch('src.utils.load_utils.get_secret')
+    def test_missing_table_rolls_back_the_run(
+        self, mock_get_secret, mock_connect, s3_with_parquet
+    ):
+        s3_with_parquet.delete_object(
+            Bucket="totesys-processed-data-000000",
+            Key=f"/history/{MOCK_TIME_PATH}/dim_design.parquet"
+        )
+        statements = []
+        db = MagicMock()
+        db.run.side_effect = recording_run(statements)
+        mock_connect.return_value = db
+        with pytest.raises(Exception, match="Failed to get parquet file"):
+            load_time_prefix(MOCK_TIME_PATH)
+
+        assert "COMMIT" not in statements
+        assert statements[-1] == "ROLLBACK"
+
+
+class TestLoadTimePrefix:
+
+    @patch('src.utils.load_utils.connect_to_db')
+    @patch('src.utils.load_utils.get_secret')
+    def test_sequential_load_runs_in_one_transaction(
+        self, mock_get_secret, mock_connect, s3_with_parquet
+    ):
+        statements = []
+        db = MagicMock()
+        db.run.side_effect = recording_run(statements)
+        mock_connect.return_value = db
+        results = load_time_prefix(MOCK_TIME_PATH, parallelism=1)
+
+        assert results[-1] == 'SQL table fact_sales_order successfully populated'
+        assert len(results) == 7
+        mock_connect.assert_called_once()
+        assert statements.count("START TRANSACTION") == 1
+        assert statements.count("COMMIT") == 1
+
+    @patch('src.utils.load_utils.connect_to_db')
+    @patch('src.utils.load_utils.get_secret')
+    def test_loads_dimensions_on_a_pool_before_the_fact_table(
+        self, mock_get_secret, mock_connect, s3_with_parquet
+    ):
+        statements = []
+        connections = []
+
+        def connect(credentials):
+            db = MagicMock()
+            db.run.side_effect = recording_run(statements)
+            connections.append(db)
+            return db
+
+        mock_connect.side_effect = connect
+        results = load_time_prefix(MOCK_TIME_PATH, parallelism=2)
+
+        assert len(results) == 7
+        assert len(connections) == 2
+        fact_copy = next(
+            i for i, sql in enumerate(statements)
+            if sql.startswith('COPY "fact_sales_order_y')
+        )
+        dimension_inserts = [
+            i for i, sql in enumerate(statements)
+            if sql.startswith('INSERT INTO "dim_')
+            or sql.startswith('WITH "expired"') and 'INSERT INTO "dim_' in sql
+        ]
+        assert len(dimension_inserts) == 6
+        assert max(dimension_inserts) < fact_copy
+        assert statements.count("COMMIT") == 7
+        for db in connections:
+            db.close.assert_called_once()
+
+    @patch('src.utils.load_utils.connect_to_db')
+    @patch('src.utils.load_utils.get_secret')
+    def test_fact_table_is_not_loaded_when_a_dimension_fails(
+        self, mock_get_secret, mock_connect, s3_with_parquet
+    ):
+        statements = []
+
+        def connect(credentials):
+            db = MagicMock()
+            db.run.side_effect = recording_run(
+                statements, 'INSERT INTO "dim_currency"'
+            )
+            return db
+
+        mock_connect.side_effect = connect
+        with pytest.raises(Exception):
+            load_time_prefix(MOCK_TIME_PATH, parallelism=2)
+
+        assert "ROLLBACK" in statements
+        assert not any(sql.startswith('COPY "fact_sales_order_y') for sql in statements)
+
+
+def wait_for(condition, timeout=5):
+    deadline = datetime.now() + timedelta(seconds=timeout)
+    while not condition():
+        assert datetime.now() < deadline
+        sleep(0.01)
+
+
+class TestTablePrefetcher:
+
+    @patch('src.utils.load_utils.read_processed_table')
+    def test_fetches_at_most_depth_tables_ahead(self, mock_read):
+        fetched = []
+        mock_read.side_effect = lambda s3, bucket, prefix, table: fetched.append(table) or table
+        prefetcher = TablePrefetcher(
+            None, "bucket", MOCK_TIME_PATH, ["dim_a", "dim_b", "dim_c"], depth=1
+        )
+        try:
+            wait_for(lambda: fetched == ["dim_a"])
+            sleep(0.2)
+            assert fetched == ["dim_a"]
+
+            assert prefetcher.take("dim_a") == "dim_a"
+            wait_for(lambda: fetched == ["dim_a", "dim_b"])
+        finally:
+            prefetcher.stop()
+
+    @patch('src.utils.load_utils.read_processed_table')
+    def test_discarded_tables_free_their_slot(self, mock_read):
+        fetched = []
+        mock_read.side_effect = lambda s3, bucket, prefix, table: fetched.append(table) or table
+        prefetcher = TablePrefetcher(
+            None, "bucket", MOCK_TIME_PATH, ["dim_a", "dim_b", "dim_c"], depth=1
+        )
+        try:
+            prefetcher.discard("dim_b")
+            prefetcher.discard("dim_a")
+            assert prefetcher.take("dim_c") == "dim_c"
+            assert "dim_b" not in fetched
+        finally:
+            prefetcher.stop()
+
+    @patch('src.utils.load_utils.read_processed_table')
+    def test_fetch_errors_are_raised_by_take(self, mock_read):
+        mock_read.side_effect = ClientError(
+            {"Error": {"Code": "NoSuchKey", "Message": "missing"}}, "GetObject"
+        )
+        prefetcher = TablePrefetcher(None, "bucket", MOCK_TIME_PATH, ["dim_a"])
+        try:
+            with pytest.raises(ClientError):
+                prefetcher.take("dim_a")
+        finally:
+            prefetcher.stop()
+
+    @patch('src.utils.load_utils.get_processed_table_etag', return_value="etag")
+    @patch('src.utils.load_utils.connect_to_db')
+    @patch('src.utils.load_utils.get_secret')
+    def test_load_finishes_when_every_table_is_skipped(
+        self, mock_get_secret, mock_connect, mock_etag, s3_with_parquet
+    ):
+        db = MagicMock()
+        db.run.side_effect = lambda sql, stream=None, **params: (
+            [["etag"]] if sql.startswith('SELECT "etag"') else None
+        )
+        mock_connect.return_value = db
+        results = load_time_prefix(MOCK_TIME_PATH, parallelism=1)
+
+        assert all(result.endswith("already populated") for result in results)
+
+
+class TestFactReferences:
+
+    def test_splits_rows_with_missing_references(self):
+        df = pl.DataFrame({
+            "sales_order_id": [1, 2, 3],
+            "design_id": [1, 7, 7],
+            "currency_id": [1, 1, 9],
+        })
+        loadable, quarantined = split_fact_references(df, {
+            "design_id": pl.Series([1, 2]),
+            "currency_id": pl.Series([1]),
+        })
+
+        assert loadable.to_dicts() == [
+            {"sales_order_id": 1, "design_id": 1, "currency_id": 1}
+        ]
+        assert quarantined["sales_order_id"].to_list() == [2, 3]
+        assert quarantined["missing_references"].to_list() == [
+            ["design_id"], ["design_id", "currency_id"]
+        ]
+
+    def test_fetches_every_key_set_once(self):
+        statements = []
+        db = MagicMock()
+        db.run.side_effect = recording_run(statements)
+        df = pl.DataFrame({
+            column: [1, 11] for column in FACT_REFERENCES
+        })
+        loadable, quarantined = check_fact_references(db, df)
+
+        assert len(statements) == len(FACT_REFERENCES)
+        assert 'SELECT "location_id" FROM "dim_location"' in statements
+        assert loadable.height == 1
+        assert quarantined.height == 1
+
+    @patch('src.utils.load_utils.connect_to_db')
+    @patch('src.utils.load_utils.get_secret')
+    def test_quarantines_orphan_fact_rows_to_s3(
+        self, mock_get_secret, mock_connect, s3_with_parquet
+    ):
+        def run(sql, stream=None, **params):
+            # the fixture counterparty ids are 1 to 5, the other ids too
+            if sql.startswith('SELECT "counterparty_id"'):
+                return [[key] for key in range(1, 3)]
+            if sql.startswith('SELECT "etag"') or "pg_class" in sql:
+                return []
+            if sql.startswith("SELECT"):
+                return [[key] for key in range(1, 6)]
+
+        db = MagicMock()
+        db.run.side_effect = run
+        mock_connect.return_value = db
+        populate_fact_sales(MOCK_TIME_PATH)
+
+        res = s3_with_parquet.get_object(
+            Bucket="totesys-processed-data-000000",
+            Key=f"/quarantine/{MOCK_TIME_PATH}/fact_sales_order.parquet"
+        )
+        quarantined = pl.read_parquet(BytesIO(res["Body"].read()))
+        assert sorted(quarantined["counterparty_id"].to_list()) == [3, 4, 5]
+
+
+class TestFactPartitions:
+
+    def test_routes_rows_to_monthly_partitions(self):
+        db = MagicMock()
+        copied = []
+
+        def run(sql, stream=None, **params):
+            if sql.startswith("SELECT"):
+                # every partition is new, so empty and without indexes
+                return []
+            copied.append((sql, stream.read() if stream else None))
+
+        db.run.side_effect = run
+        df = pl.DataFrame({
+            "sales_order_id": [1, 2, 3],
+            "created_date": [
+                datetime(2024, 1, 31).date(),
+                datetime(2023, 12, 1).date(),
+                datetime(2024, 1, 1).date(),
+            ],
+        })
+        copy_fact_partitions(db, df, ["sales_order_id", "created_date"])
+
+        assert [sql for sql, _ in copied if sql.startswith("CREATE INDEX")] == [
+            f'CREATE INDEX IF NOT EXISTS "fact_sales_order_y{month}_{column}" '
+            f'ON "fact_sales_order_y{month}" ("{column}")'
+            for month in ["2023m12", "2024m01"]
+            for column in ["load_time_prefix", "sales_staff_id", "counterparty_id"]
+        ]
+        assert [entry for entry in copied if not entry[0].startswith("CREATE INDEX")] == [
+            ('CREATE TABLE IF NOT EXISTS "fact_sales_order_y2023m12" '
+             'PARTITION OF "fact_sales_order" '
+             "FOR VALUES FROM ('2023-12-01') TO ('2024-01-01')", None),
+            ('CREATE TABLE IF NOT EXISTS "fact_sales_order_y2024m01" '
+             'PARTITION OF "fact_sales_order" '
+             "FOR VALUES FROM ('2024-01-01') TO ('2024-02-01')", None),
+            ('COPY "fact_sales_order_y2023m12" ("sales_order_id", "created_date") '
+             'FROM STDIN WITH (FORMAT csv)', b"2,2023-12-01\n"),
+            ('COPY "fact_sales_order_y2024m01" ("sales_order_id", "created_date") '
+             'FROM STDIN WITH (FORMAT csv)', b"1,2024-01-31\n3,2024-01-01\n"),
+            ('ANALYZE "fact_sales_order_y2024m01"', None),
+            ('ANALYZE "fact_sales_order_y2023m12"', None),
+        ]
+
+
+    def test_bulk_load_rebuilds_the_partition_indexes(self):
+        statements = []
+
+        def run(sql, stream=None, **params):
+            statements.append(sql)
+            if "reltuples" in sql:
+                return [[10.0]]
+            if "pg_index" in sql:
+                return [
+                    ["fact_sales_order_y2024m01_load_time_prefix",
+                     'CREATE INDEX fact_sales_order_y2024m01_load_time_prefix '
+                     'ON public.fact_sales_order_y2024m01 USING btree (load_time_prefix)'],
+                ]
+
+        db = MagicMock()
+        db.run.side_effect = run
+        df = pl.DataFrame({
+            "sales_order_id": range(100),
+            "created_date": [datetime(2024, 1, 2).date()] * 100,
+        })
+        copy_fact_partitions(db, df, ["sales_order_id", "created_date"])
+
+        copy = next(i for i, s in enumerate(statements) if s.startswith("COPY"))
+        assert statements[copy - 1] == 'DROP INDEX "fact_sales_order_y2024m01_load_time_prefix"'
+        assert statements[copy + 1:] == [
+            'CREATE INDEX fact_sales_order_y2024m01_load_time_prefix '
+            'ON public.fact_sales_order_y2024m01 USING btree (load_time_prefix)',
+            'ANALYZE "fact_sales_order_y2024m01"',
+        ]
+
+
+class TestStreamedFactLoad:
+
+    def test_iter_batches_slices_a_scan(self, tmp_path):
+        path = tmp_path / "fact.parquet"
+        pl.DataFrame({"sales_order_id": range(10)}).write_parquet(path, row_group_size=3)
+        batches = list(iter_batches(pl.scan_parquet(path), batch_rows=4))
+
+        assert [batch.height for batch in batches] == [4, 4, 2]
+        assert pl.concat(batches)["sales_order_id"].to_list() == list(range(10))
+
+    def test_scans_partitioned_fact_table(self, s3, tmp_path):
+        with patch('src.utils.load_utils.LOAD_CACHE_DIR', str(tmp_path)):
+            for month in (1, 2):
+                buffer = BytesIO()
+                pl.DataFrame({"sales_order_id": [month]}).write_parquet(buffer)
+                s3.put_object(
+                    Bucket="totesys-processed-data-000000",
+                    Key=f"/history/{MOCK_TIME_PATH}/fact_sales_order/year=2024/month={month}/0.parquet",
+                    Body=buffer.getvalue()
+                )
+            source = scan_processed_table(
+                s3, "totesys-processed-data-000000", MOCK_TIME_PATH, "fact_sales_order"
+            )
+            assert source.collect().to_dicts() == [
+                {"sales_order_id": 1}, {"sales_order_id": 2}
+            ]
+
+    def test_fails_before_downloading_a_table_too_large_for_disk(self, s3, tmp_path):
+        buffer = BytesIO()
+        pl.DataFrame({"sales_order_id": range(100)}).write_parquet(buffer)
+        s3.put_object(
+            Bucket="totesys-processed-data-000000",
+            Key=f"/history/{MOCK_TIME_PATH}/fact_sales_order.parquet",
+            Body=buffer.getvalue()
+        )
+        with patch('src.utils.load_utils.LOAD_CACHE_DIR', str(tmp_path)), \
+                patch('src.utils.load_utils.shutil.disk_usage') as mock_usage:
+            mock_usage.return_value.free = 10
+            with pytest.raises(Exception, match="Not enough local disk"):
+                scan_processed_table(
+                    s3, "totesys-processed-data-000000", MOCK_TIME_PATH,
+                    "fact_sales_order"
+                )
+        assert not any(path.is_file() for path in tmp_path.rglob("*"))
+
+    @patch('src.utils.load_utils.connect_to_db')
+    @patch('src.utils.load_utils.get_secret')
+    def test_copies_fact_table_in_batches(
+        self, mock_get_secret, mock_connect, s3_with_parquet
+    ):
+        statements = []
+        db = MagicMock()
+        db.run.side_effect = recording_run(statements)
+        mock_connect.return_value = db
+        with patch('src.utils.load_utils.iter_batches') as mock_batches:
+            mock_batches.side_effect = lambda source: iter_batches(source, batch_rows=2)
+            ret = populate_fact_sales(MOCK_TIME_PATH)
+
+        assert ret == 'SQL table fact_sales_order successfully populated'
+        copied = [c.kwargs["stream"].getvalue() for c in db.run.call_args_list
+                  if c.args[0].startswith('COPY "fact_sales_order_y')]
+        assert sum(chunk.count(b"\n") for chunk in copied) == 5
+        assert len(copied) >= 3
+        ledger = next(c for c in db.run.call_args_list
+                      if c.args[0].startswith('INSERT INTO "load_ledger"'))
+        assert ledger.kwargs["row_count"] == 5
+
+
+class TestSalesSummaries:
+
+    def test_partial_aggregates_combine_to_the_whole(self):
+        df = pl.DataFrame({
+            "created_date": [datetime(2024, 1, 1), datetime(2024, 1, 1), datetime(2024, 1, 2)],
+            "currency_id": [1, 1, 1],
+            "units_sold": [2, 3, 4],
+            "unit_price": [1.5, 2.0, 0.25],
+        })
+        partials = [
+            aggregate_daily_sales(batch, "currency_id", "currency_id")
+            for batch in df.iter_slices(2)
+        ]
+        combined = combine_daily_sales(partials, "currency_id")
+
+        assert combined.to_dicts() == [
+            {"sales_date": datetime(2024, 1, 1).date(), "currency_id": 1,
+             "order_count": 2, "units_sold": 5, "sales_value": Decimal("9.00")},
+            {"sales_date": datetime(2024, 1, 2).date(), "currency_id": 1,
+             "order_count": 1, "units_sold": 4, "sales_value": Decimal("1.00")},
+        ]
+
+    def test_sales_value_sums_exactly(self):
+        df = pl.DataFrame({
+            "created_date": [datetime(2024, 1, 1)] * 3,
+            "currency_id": [1, 1, 1],
+            "units_sold": [1, 1, 1],
+            "unit_price": [0.1, 0.2, 0.1],
+        })
+        partials = [
+            aggregate_daily_sales(batch, "currency_id", "currency_id")
+            for batch in df.iter_slices(1)
+        ]
+        combined = combine_daily_sales(partials, "currency_id")
+
+        assert combined["sales_value"].to_list() == [Decimal("0.40")]
+
+    def test_merge_adds_to_existing_rows(self):
+        db = MagicMock()
+        df = pl.DataFrame({
+            "sales_date": [datetime(2024, 1, 1).date()], "design_id": [3],
+            "order_count": [1], "units_sold": [2], "sales_value": [3.0],
+        })
+        merge_aggregates(
+            db, "agg_daily_sales_by_design", df, ["sales_date", "design_id"],
+            ["order_count", "units_sold", "sales_value"]
+        )
+
+        statements = [c.args[0] for c in db.run.call_args_list]
+        assert statements[0] == "START TRANSACTION"
+        assert statements[-1] == "COMMIT"
+        merge = next(s for s in statements if s.startswith('INSERT INTO "agg_daily_sales_by_design"'))
+        assert 'ON CONFLICT ("sales_date", "design_id") DO UPDATE SET' in merge
+        assert '"units_sold" = "agg_daily_sales_by_design"."units_sold" + EXCLUDED."units_sold"' in merge
+
+    @patch('src.utils.load_utils.connect_to_db')
+    @patch('src.utils.load_utils.get_secret')
+    def test_fact_load_merges_summaries_before_the_ledger(
+        self, mock_get_secret, mock_connect, s3_with_parquet
+    ):
+        statements = []
+        db = MagicMock()
+        db.run.side_effect = recording_run(statements)
+        mock_connect.return_value = db
+        populate_fact_sales(MOCK_TIME_PATH)
+
+        sql = [c.args[0] for c in db.run.call_args_list]
+        merges = [i for i, s in enumerate(sql) if s.startswith('INSERT INTO "agg_daily_sales_by_')]
+        ledger = next(i for i, s in enumerate(sql) if s.startswith('INSERT INTO "load_ledger"'))
+        assert len(merges) == 4
+        assert max(merges) < ledger
+        assert sql.count("COMMIT") == 1 and sql[-1] == "COMMIT"
+        staged = next(c.kwargs["stream"] for c in db.run.call_args_list
+                      if c.args[0].startswith('COPY "staging_agg_daily_sales_by_currency"'))
+        counts = pl.read_csv(staged, has_header=False)[:, 2]
+        assert counts.sum() == 5
+
+    @patch('src.utils.load_utils.connect_to_db')
+    @patch('src.utils.load_utils.get_secret')
+    def test_changed_fact_file_replaces_the_earlier_load(
+        self, mock_get_secret, mock_connect, s3_with_parquet
+    ):
+        statements = []
+        run = recording_run(statements)
+
+        def run_with_old_etag(sql, stream=None, **params):
+            if sql.startswith('SELECT "etag"'):
+                statements.append(sql)
+                return [['"old"']]
+            return run(sql, stream, **params)
+
+        db = MagicMock()
+        db.run.side_effect = run_with_old_etag
+        mock_connect.return_value = db
+        assert populate_fact_sales(MOCK_TIME_PATH) == \
+            "SQL table fact_sales_order successfully populated"
+
+        sql = [c.args[0] for c in db.run.call_args_list]
+        subtracts = [i for i, s in enumerate(sql) if "-count(*)" in s]
+        delete = sql.index(
+            'DELETE FROM "fact_sales_order" WHERE "load_time_prefix" = :time_prefix'
+        )
+        first_copy = next(i for i, s in enumerate(sql) if s.startswith('COPY "fact_sales_order_y'))
+        assert len(subtracts) == 4
+        assert max(subtracts) < delete < first_copy
+        assert all(db.run.call_args_list[i].kwargs["time_prefix"] == MOCK_TIME_PATH
+                   for i in subtracts + [delete])
+        assert sql.count("START TRANSACTION") == 1 and sql.count("COMMIT") == 1
+
+
+class TestScd2Dimensions:
+
+    def test_time_prefix_datetime(self):
+        assert time_prefix_datetime("2024/11/05/12:30:00/") == datetime(2024, 11, 5, 12, 30)
+        assert time_prefix_datetime(MOCK_TIME_PATH) == datetime(2024, 1, 1)
+
+    def test_row_hash_ignores_the_key_and_tells_null_from_empty(self):
+        df = pl.DataFrame({
+            "staff_id": [1, 2, 3, 4],
+            "first_name": ["a", "a", "", None],
+        })
+        hashes = add_row_hash(df, "staff_id")["row_hash"].to_list()
+
+        assert hashes[0] == hashes[1]
+        assert len({hashes[1], hashes[2], hashes[3]}) == 3
+        assert add_row_hash(df, "staff_id")["row_hash"].to_list() == hashes
+
+    def test_categorical_rows_hash_by_value(self):
+        # the same rows, with the categories met in a different order
+        df = pl.DataFrame({"staff_id": [1, 2], "location": ["Leeds", "Manchester"]})
+        first = df.with_columns(pl.col("location").cast(pl.Categorical))
+        second = pl.DataFrame(
+            {"staff_id": [0, 1, 2], "location": ["Manchester", "Leeds", "Manchester"]}
+        ).with_columns(pl.col("location").cast(pl.Categorical))[1:]
+
+        assert add_row_hash(first, "staff_id")["row_hash"].to_list() == \
+            add_row_hash(df, "staff_id")["row_hash"].to_list()
+        assert add_row_hash(second, "staff_id")["row_hash"].to_list() == \
+            add_row_hash(df, "staff_id")["row_hash"].to_list()
+
+    def test_merging_the_same_categorical_rows_twice_stages_nothing(self):
+        first = pl.DataFrame(
+            {"staff_id": [1, 2], "location": ["Leeds", "Manchester"]}
+        ).with_columns(pl.col("location").cast(pl.Categorical))
+        second = pl.DataFrame(
+            {"staff_id": [0, 1, 2], "location": ["Manchester", "Leeds", "Manchester"]}
+        ).with_columns(pl.col("location").cast(pl.Categorical))[1:]
+        warehouse = {}
+
+        def run(sql, stream=None, **params):
+            if sql.startswith('SELECT "staff_id", "row_hash"'):
+                return [list(row) for row in warehouse.items()]
+            if sql.startswith('COPY "staging_dim_staff"'):
+                staged = pl.read_csv(stream, has_header=False)
+                warehouse.update(zip(staged[:, 0], staged[:, 2]))
+
+        db = MagicMock()
+        db.run.side_effect = run
+        columns = ["staff_id", "location"]
+        assert merge_scd2_dimension(db, "dim_staff", first, columns, "staff_id", datetime(2024, 1, 1)) == 2
+        db.run.reset_mock()
+        assert merge_scd2_dimension(db, "dim_staff", second, columns, "staff_id", datetime(2024, 1, 2)) == 0
+        assert db.run.call_count == 1
+
+    def test_first_versions_are_valid_from_minus_infinity(self):
+        db = MagicMock()
+        db.run.return_value = []
+        merge_scd2_dimension(
+            db, "dim_staff", pl.DataFrame({"staff_id": [1], "first_name": ["a"]}),
+            ["staff_id", "first_name"], "staff_id", datetime(2024, 1, 2)
+        )
+        merge = next(c.args[0] for c in db.run.call_args_list if c.args[0].startswith('WITH "expired"'))
+        assert "ELSE '-infinity' END" in merge
+
+    def test_unchanged_rows_cause_no_writes(self):
+        df = pl.DataFrame({"staff_id": [1, 2], "first_name": ["a", "b"]})
+        current = add_row_hash(df, "staff_id")
+        db = MagicMock()
+        db.run.return_value = current.select("staff_id", "row_hash").rows()
+
+        staged = merge_scd2_dimension(
+            db, "dim_staff", df, ["staff_id", "first_name"], "staff_id",
+            datetime(2024, 1, 2)
+        )
+
+        assert staged == 0
+        assert db.run.call_count == 1
+
+    def test_stages_new_and_changed_rows_in_one_statement(self):
+        current = add_row_hash(
+            pl.DataFrame({"staff_id": [1, 2], "first_name": ["a", "b"]}), "staff_id"
+        )
+        df = pl.DataFrame({"staff_id": [1, 2, 3], "first_name": ["a", "changed", "c"]})
+        db = MagicMock()
+        db.run.side_effect = lambda sql, stream=None, **params: (
+            current.select("staff_id", "row_hash").rows() if sql.startswith("SELECT") else None
+        )
+
+        staged = merge_scd2_dimension(
+            db, "dim_staff", df, ["staff_id", "first_name"], "staff_id",
+            datetime(2024, 1, 2)
+        )
+
+        assert staged == 2
+        copied = next(c.kwargs["stream"] for c in db.run.call_args_list
+                      if c.args[0].startswith('COPY "staging_dim_staff"'))
+        assert pl.read_csv(copied, has_header=False)[:, 0].to_list() == [2, 3]
+        merges = [c for c in db.run.call_args_list if c.args[0].startswith('WITH "expired"')]
+        assert len(merges) == 1
+        assert merges[0].kwargs == {"valid_from": datetime(2024, 1, 2)}
+        assert 'INSERT INTO "dim_staff"' in merges[0].args[0]
+        assert [c.args[0] for c in db.run.call_args_list][-1] == "COMMIT"
+
+
+class TestBulkLoadMode:
+
+    def test_switches_on_incoming_rows_relative_to_table_size(self):
+        assert use_bulk_mode(100, 0)
+        assert use_bulk_mode(200, 1000, ratio=0.2)
+        assert not use_bulk_mode(199, 1000, ratio=0.2)
+        assert not use_bulk_mode(0, 0)
+
+    def test_bulk_mode_rebuilds_secondary_indexes_and_analyzes(self):
+        statements = []
+
+        def run(sql, stream=None, **params):
+            statements.append(sql)
+            if "reltuples" in sql:
+                return [[1000.0]]
+            if "pg_index" in sql:
+                return [["ix_design", 'CREATE INDEX ix_design ON "t" (design_id)']]
+
+        db = MagicMock()
+        db.run.side_effect = run
+        with bulk_load_mode(db, "t", 500) as bulk:
+            db.run("COPY")
+
+        assert bulk
+        assert statements[2:] == [
+            'DROP INDEX "ix_design"',
+            "COPY",
+            'CREATE INDEX ix_design ON "t" (design_id)',
+            'ANALYZE "t"',
+        ]
+
+    def test_incremental_mode_keeps_indexes(self):
+        db = MagicMock()
+        db.run.return_value = [[1000000.0]]
+        with bulk_load_mode(db, "t", 500) as bulk:
+            pass
+
+        assert not bulk
+        assert db.run.call_count == 1
+
+
+class TestLoadLedger:
+
+    def test_etag_of_single_file_table(self, s3_with_parquet):
+        etag = get_processed_table_etag(
+            s3_with_parquet, "totesys-processed-data-000000",
+            MOCK_TIME_PATH, "dim_staff"
+        )
+        assert etag == s3_with_parquet.head_object(
+            Bucket="totesys-processed-data-000000",
+            Key=f"/history/{MOCK_TIME_PATH}/dim_staff.parquet"
+        )["ETag"]
+
+    def test_etag_of_partitioned_table_changes_with_a_partition(self, s3):
+        def put_partition(month, body):
+            s3.put_object(
+                Bucket="totesys-processed-data-000000",
+                Key=f"/history/{MOCK_TIME_PATH}/fact_sales_order/year=2024/month={month}/0.parquet",
+                Body=body
+            )
+
+        put_partition(1, b"a")
+        put_partition(2, b"b")
+        first = get_processed_table_etag(
+            s3, "totesys-processed-data-000000", MOCK_TIME_PATH, "fact_sales_order"
+        )
+        put_partition(2, b"c")
+        second = get_processed_table_etag(
+            s3, "totesys-processed-data-000000", MOCK_TIME_PATH, "fact_sales_order"
+        )
+        assert first != second
+
+    @patch('src.utils.load_utils.connect_to_db')
+    @patch('src.utils.load_utils.get_secret')
+    def test_records_load_in_the_same_transaction(
+        self, mock_get_secret, mock_connect, s3_with_parquet
+    ):
+        statements = []
+        db = MagicMock()
+        db.run.side_effect = recording_run(statements)
+        mock_connect.return_value = db
+        populate_fact_sales(MOCK_TIME_PATH)
+
+        ledger = next(
+            i for i, sql in enumerate(statements)
+            if sql.startswith('INSERT INTO "load_ledger"')
+        )
+        copy = next(
+            i for i, sql in enumerate(statements)
+            if sql.startswith('COPY "fact_sales_order_y')
+        )
+        assert copy < ledger < statements.index("COMMIT")
+        params = db.run.call_args_list[ledger].kwargs
+        assert params["table_name"] == "fact_sales_order"
+        assert params["row_count"] == 5
+
+    @patch('src.utils.load_utils.connect_to_db')
+    @patch('src.utils.load_utils.get_secret')
+    def test_skips_table_already_loaded_from_the_same_file(
+        self, mock_get_secret, mock_connect, s3_with_parquet
+    ):
+        etag = s3_with_parquet.head_object(
+            Bucket="totesys-processed-data-000000",
+            Key=f"/history/{MOCK_TIME_PATH}/fact_sales_order.parquet"
+        )["ETag"]
+        db = MagicMock()
+        db.run.side_effect = lambda sql, stream=None, **params: (
+            [[etag]] if sql.startswith('SELECT "etag"') else None
+        )
+        mock_connect.return_value = db
+        ret = populate_fact_sales(MOCK_TIME_PATH)
+
+        assert ret == 'SQL table fact_sales_order already populated'
+        statements = [c.args[0] for c in db.run.call_args_list]
+        assert not any(sql.startswith("COPY") for sql in statements)
+
+
 class TestGetSecret:
 
     def test_get_secret_returns_exception(self, secretsmanager):
@@ -346,9 +1330,15 @@ class TestTransformFactTable:
             "sales_staff_id", "counterparty_id", "units_sold",
             "unit_price", "currency_id", "design_id",
             "agreed_payment_date", "agreed_delivery_date",
-            "agreed_delivery_location_id"
+            "agreed_delivery_location_id", "load_time_prefix"
             ]
 
+        # fact rows are only loaded once the dimensions they reference are
+        populate_dim_staff(MOCK_TIME_PATH)
+        populate_dim_counterparty(MOCK_TIME_PATH)
+        populate_dim_currency(MOCK_TIME_PATH)
+        populate_dim_design(MOCK_TIME_PATH)
+        populate_dim_location(MOCK_TIME_PATH)
         ret = populate_fact_sales(MOCK_TIME_PATH)
 
         query = "SELECT column_name FROM information_schema.columns WHERE table_name = 'fact_sales_order';"
@@ -362,6 +1352,15 @@ class TestTransformFactTable:
         result = [row[0] for row in result]
         assert result == [1000, 2000, 3000, 4000, 5000]
 
+        # the partitions were bulk loaded, their indexes were rebuilt after the copy
+        query = (
+            "SELECT tablename, count(*) FROM pg_indexes "
+            "WHERE tablename LIKE 'fact_sales_order_y%' "
+            "AND indexname NOT LIKE '%pkey' GROUP BY tablename;"
+        )
+        result = db.run(query)
+        assert result and all(count == 3 for _, count in result)
+
         assert ret == 'SQL table fact_sales_order successfully populated'
 
 
@@ -378,8 +1377,9 @@ class TestTransformDimStaff:
         }
 
         expected_columns = [
-            "staff_id", "first_name", "last_name",
-            "department_name", "location", "email_address"
+            "staff_record_id", "staff_id", "first_name", "last_name",
+            "department_name", "location", "email_address",
+            "row_hash", "valid_from", "valid_to", "is_current"
             ]
 
         ret = populate_dim_staff(MOCK_TIME_PATH)
@@ -397,6 +1397,47 @@ class TestTransformDimStaff:
 
         assert ret == 'SQL table dim_staff successfully populated'
 
+    @patch('src.utils.load_utils.get_secret')
+    def test_dim_staff_keeps_the_history_of_changed_staff(
+        self, mock_get_secret, run_seed, db, s3_with_parquet
+    ):
+        mock_get_secret.return_value = {
+            'user': PG_USER,
+            'password': PG_PASSWORD,
+            'host': PG_HOST,
+            'name': PG_DATAWAREHOUSE,
+            'port': PG_PORT
+        }
+        populate_dim_staff(MOCK_TIME_PATH)
+
+        # staff 1 moves department in a later run, the others are unchanged
+        next_time_path = "2024/01/02/00:00:00"
+        df = pl.read_parquet(BytesIO(s3_with_parquet.get_object(
+            Bucket="totesys-processed-data-000000",
+            Key=f"/history/{MOCK_TIME_PATH}/dim_staff.parquet"
+        )["Body"].read()))
+        buffer = BytesIO()
+        df.with_columns(
+            pl.when(pl.col("staff_id") == 1).then(pl.lit("department_moved"))
+            .otherwise(pl.col("department_name")).alias("department_name")
+        ).write_parquet(buffer)
+        s3_with_parquet.put_object(
+            Body=buffer.getvalue(),
+            Bucket="totesys-processed-data-000000",
+            Key=f"/history/{next_time_path}/dim_staff.parquet"
+        )
+        populate_dim_staff(next_time_path)
+
+        result = db.run(
+            "SELECT department_name, valid_from, valid_to, is_current FROM dim_staff "
+            "WHERE staff_id = 1 ORDER BY valid_from;"
+        )
+        assert result == [
+            ["department_0", "-infinity", datetime(2024, 1, 2), False],
+            ["department_moved", datetime(2024, 1, 2), None, True],
+        ]
+        assert db.run("SELECT count(*) FROM dim_staff;") == [[6]]
+
 
 class TestTransformDimDate:
 
@@ -542,11 +1583,12 @@ class TestTransformDimCounterparty:
         }
 
         expected_columns = [
-            "counterparty_id", "counterparty_legal_name",
+            "counterparty_record_id", "counterparty_id", "counterparty_legal_name",
             "counterparty_legal_address_line_1", "counterparty_legal_address_line_2",
             "counterparty_legal_district", "counterparty_legal_city",
             "counterparty_legal_postal_code", "counterparty_legal_country",
-            "counterparty_legal_phone_number"
+            "counterparty_legal_phone_number",
+            "row_hash", "valid_from", "valid_to", "is_current"
         ]
 
         ret = populate_dim_counterparty(MOCK_TIME_PATH)
@@ -0,0 +1,45 @@
+import pytest
+import polars as pl
+from io import BytesIO
+from src.utils.parquet_config import (
+    get_parquet_writer_settings,
+    write_table_parquet,
+    DEFAULT_PARQUET_WRITER_SETTINGS,
+)
+
+
+class TestGetParquetWriterSettings:
+    @pytest.mark.it("Returns the default settings for tables that are not configured")
+    def test_unknown_table_uses_defaults(self):
+        assert get_parquet_writer_settings("dim_unknown") == DEFAULT_PARQUET_WRITER_SETTINGS
+
+    @pytest.mark.it("Returns the configured settings for a table")
+    def test_configured_table(self):
+        settings = get_parquet_writer_settings("dim_currency")
+        assert settings["compression"] == "uncompressed"
+        assert settings["statistics"] is False
+
+
+class TestWriteTableParquet:
+    @pytest.mark.it("Round trips a table written with its configured settings, string columns as strings")
+    def test_round_trip(self):
+        df = pl.DataFrame(
+            {
+                "staff_id": [1, 2, 3],
+                "department_name": ["Sales", "Sales", "HR"],
+                "location": ["Leeds", "Leeds", "Manchester"],
+            }
+        )
+        buffer = BytesIO()
+        write_table_parquet(df, "dim_staff", buffer)
+        result = pl.read_parquet(BytesIO(buffer.getvalue()))
+        assert result["department_name"].dtype == pl.String
+        assert result.rows() == df.rows()
+
+    @pytest.mark.it("Uses the settings passed in instead of the configured ones")
+    def test_settings_override(self):
+        df = pl.DataFrame({"design_id": list(range(100))})
+        settings = dict(DEFAULT_PARQUET_WRITER_SETTINGS, compression="gzip", row_group_size=10)
+        buffer = BytesIO()
+        write_table_parquet(df, "dim_design", buffer, settings=settings)
+        assert pl.read_parquet(BytesIO(buffer.getvalue())).height == 100
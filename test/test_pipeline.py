@@ -0,0 +1,263 @@
+import os
+import boto3
+import pytest
+import polars as pl
+import datetime as dt
+from decimal import Decimal
+from io import StringIO
+from unittest.mock import patch, MagicMock
+from moto import mock_aws
+from src.pipeline import source_frame, extract_tables, run_pipeline, read_state, save_state
+from src.utils.transform_utils import (
+    SOURCE_TABLES,
+    create_calendar_dim_date,
+    get_cached_dim_date,
+    put_cached_dim_date,
+)
+
+TIME_PREFIX = "2024/11/01/09:00:00/"
+SOURCES = {
+    "department": """department_id,department_name,location,manager,created_at,last_updated
+2,Purchasing,Manchester,Naomi Lapaglia,2022-11-03 14:20:49.962000,2022-11-03 14:20:49.962000""",
+    "staff": """staff_id,first_name,last_name,department_id,email_address,created_at,last_updated
+1,Jeremie,Franey,2,jeremie.franey@terrifictotes.com,2022-11-03 14:20:51.563000,2022-11-03 14:20:51.563000""",
+    "counterparty": """counterparty_id,counterparty_legal_name,legal_address_id,commercial_contact,delivery_contact,created_at,last_updated
+1,Fahey and Sons,2,Micheal Toy,Mrs. Lucy Runolfsdottir,2022-11-03 14:20:51.563000,2022-11-03 14:20:51.563000""",
+    "currency": """currency_id,currency_code,created_at,last_updated
+1,GBP,2022-11-03 14:20:49.962000,2022-11-03 14:20:49.962000""",
+    "address": """address_id,address_line_1,address_line_2,district,city,postal_code,country,phone,created_at,last_updated
+2,179 Alexie Cliffs,,,Aliso Viejo,99305-7380,San Marino,9621 880720,2022-11-03 14:20:49.962000,2022-11-03 14:20:49.962000""",
+    "design": """design_id,created_at,design_name,file_location,file_name,last_updated
+8,2022-11-03 14:20:49.962000,Wooden,/usr,wooden-20220717-npgz.json,2022-11-03 14:20:49.962000""",
+    "purchase_order": """purchase_order_id,created_at,last_updated,staff_id,counterparty_id,item_code,item_quantity,item_unit_price,currency_id,agreed_delivery_date,agreed_payment_date,agreed_delivery_location_id
+1,2022-11-03 14:20:52.187000,2022-11-03 14:20:52.187000,1,1,ZDOI5EA,371,361.39,1,2022-11-09,2022-11-07,2""",
+    "payment": """payment_id,created_at,last_updated,transaction_id,counterparty_id,payment_amount,currency_id,payment_type_id,paid,payment_date,company_ac_number,counterparty_ac_number
+2,2022-11-03 14:20:52.186000,2022-11-03 14:20:52.186000,2,1,552548.62,1,3,False,2022-11-04,67305075,31622269""",
+    "transaction": """transaction_id,transaction_type,sales_order_id,purchase_order_id,created_at,last_updated
+2,PURCHASE,,1,2022-11-03 14:20:52.187000,2022-11-03 14:20:52.187000""",
+    "sales_order": """sales_order_id,created_at,last_updated,design_id,staff_id,counterparty_id,units_sold,unit_price,currency_id,agreed_delivery_date,agreed_payment_date,agreed_delivery_location_id
+2,2022-11-03 14:20:52.186000,2022-11-03 14:20:52.186000,8,1,1,42972,3.94,1,2022-11-07,2022-11-08,2""",
+}
+
+
+def query_rows(sources):
+    """
+    Returns a fake query_db answering with the header and rows of the sources.
+    """
+    def query_db(table, conn):
+        df = pl.read_csv(StringIO(sources[table]))
+        return [df.columns] + [list(row) for row in df.iter_rows()]
+    return query_db
+
+
+def warehouse_run(statements):
+    """
+    Returns a fake warehouse Connection.run: nothing is loaded yet and every
+    dimension key query returns the keys 1 to 10.
+    """
+    def run(sql, stream=None, **params):
+        statements.append(sql)
+        if sql.startswith('SELECT "etag"') or "pg_class" in sql or '"row_hash"' in sql:
+            return []
+        if sql.startswith("SELECT"):
+            return [[key] for key in range(1, 11)]
+    return run
+
+
+class TestSourceFrame:
+    @pytest.mark.it("Types query results as transform reads the extract csv files")
+    def test_source_frame_types(self):
+        df = source_frame([
+            ["sales_order_id", "created_at", "unit_price", "agreed_delivery_date"],
+            [2, dt.datetime(2022, 11, 3, 14, 20, 52, 186000), Decimal("3.94"), "2022-11-07"],
+        ])
+        assert df.schema == {
+            "sales_order_id": pl.Int64,
+            "created_at": pl.String,
+            "unit_price": pl.Float64,
+            "agreed_delivery_date": pl.String,
+        }
+        assert df["created_at"].str.to_datetime()[0] == dt.datetime(2022, 11, 3, 14, 20, 52, 186000)
+
+    @pytest.mark.it("Types the columns of an empty table as strings")
+    def test_source_frame_empty(self):
+        df = source_frame([["staff_id", "first_name"]])
+        assert df.is_empty()
+        assert df.schema == {"staff_id": pl.String, "first_name": pl.String}
+
+
+class TestExtractTables:
+    @pytest.mark.it("Extracts every row of every source table on a first run")
+    def test_first_run(self):
+        with patch("src.pipeline.query_db", side_effect=query_rows(SOURCES)):
+            snapshot, differences = extract_tables(MagicMock())
+        assert list(snapshot) == SOURCE_TABLES
+        assert all(df.height == 1 for df in differences.values())
+
+    @pytest.mark.it("Only hands on new and changed rows after a first run")
+    def test_differences(self):
+        with patch("src.pipeline.query_db", side_effect=query_rows(SOURCES)):
+            previous, _ = extract_tables(MagicMock())
+        changed = dict(
+            SOURCES,
+            staff=SOURCES["staff"] + "\n2,Deron,Beier,2,deron.beier@terrifictotes.com,"
+            "2022-11-03 14:20:51.563000,2022-11-03 14:20:51.563000",
+            currency=SOURCES["currency"].replace("GBP", "USD"),
+        )
+        with patch("src.pipeline.query_db", side_effect=query_rows(changed)):
+            snapshot, differences = extract_tables(MagicMock(), previous)
+
+        assert snapshot["staff"].height == 2
+        assert differences["staff"]["staff_id"].to_list() == [2]
+        assert differences["currency"]["currency_code"].to_list() == ["USD"]
+        assert differences["design"].is_empty()
+
+
+class TestRunPipeline:
+    @pytest.mark.it("Runs extract, transform and load in memory without S3")
+    @patch("src.utils.load_utils.connect_to_db")
+    @patch("src.pipeline.connect_to_source")
+    def test_run_pipeline(self, mock_connect_to_source, mock_connect):
+        statements = []
+        db = MagicMock()
+        db.run.side_effect = warehouse_run(statements)
+        mock_connect.return_value = db
+        with patch("src.pipeline.query_db", side_effect=query_rows(SOURCES)), \
+                patch("boto3.client") as mock_boto3:
+            results, state = run_pipeline(
+                {"database": "totesys"}, {"name": "warehouse"},
+                time_prefix=TIME_PREFIX, parallelism=1
+            )
+
+        mock_boto3.assert_not_called()
+        mock_connect_to_source.return_value.close.assert_called_once()
+        assert results == [
+            f"SQL table {table} successfully populated"
+            for table in [
+                "dim_location", "dim_staff", "dim_counterparty", "dim_currency",
+                "dim_date", "dim_design", "fact_sales_order",
+            ]
+        ]
+        fact_copy = next(c for c in db.run.call_args_list
+                         if c.args[0].startswith('COPY "fact_sales_order_y2022m11"'))
+        assert fact_copy.kwargs["stream"].getvalue().startswith(b"2,2022-11-03,14:20:52.186")
+        assert statements[0] == "START TRANSACTION" and statements[-1] == "COMMIT"
+
+        assert state["location_key_map"].height == 1
+        assert state["cached_dim_date"].height > 0
+        assert state["snapshot"]["sales_order"].height == 1
+
+    @pytest.mark.it("Carries the state into the next run")
+    @patch("src.utils.load_utils.connect_to_db")
+    @patch("src.pipeline.connect_to_source")
+    def test_run_pipeline_with_state(self, mock_connect_to_source, mock_connect):
+        mock_connect.return_value.run.side_effect = warehouse_run([])
+        with patch("src.pipeline.query_db", side_effect=query_rows(SOURCES)):
+            _, state = run_pipeline({}, {}, time_prefix=TIME_PREFIX, parallelism=1)
+
+        statements = []
+        db = MagicMock()
+        db.run.side_effect = warehouse_run(statements)
+        mock_connect.return_value = db
+        with patch("src.pipeline.query_db", side_effect=query_rows(SOURCES)):
+            results, _ = run_pipeline(
+                {}, {}, state=state, time_prefix="2024/11/01/09:30:00/", parallelism=1
+            )
+
+        assert len(results) == 7
+        # nothing changed, so no rows are copied and the calendar is not emitted again
+        assert not any(
+            c.kwargs.get("stream") and c.kwargs["stream"].getvalue()
+            for c in db.run.call_args_list
+        )
+
+    @pytest.mark.it("Joins a changed counterparty to an address loaded by an earlier run")
+    @patch("src.utils.load_utils.connect_to_db")
+    @patch("src.pipeline.connect_to_source")
+    def test_counterparty_joins_earlier_address(self, mock_connect_to_source, mock_connect):
+        mock_connect.return_value.run.side_effect = warehouse_run([])
+        with patch("src.pipeline.query_db", side_effect=query_rows(SOURCES)):
+            _, state = run_pipeline({}, {}, time_prefix=TIME_PREFIX, parallelism=1)
+
+        db = MagicMock()
+        db.run.side_effect = warehouse_run([])
+        mock_connect.return_value = db
+        renamed = dict(
+            SOURCES, counterparty=SOURCES["counterparty"].replace("Fahey and Sons", "Fahey Ltd")
+        )
+        with patch("src.pipeline.query_db", side_effect=query_rows(renamed)):
+            _, next_state = run_pipeline(
+                {}, {}, state=state, time_prefix="2024/11/01/09:30:00/", parallelism=1
+            )
+
+        staged = next(c.kwargs["stream"].getvalue() for c in db.run.call_args_list
+                      if c.args[0].startswith('COPY "staging_dim_counterparty"'))
+        assert b"Fahey Ltd" in staged and b"179 Alexie Cliffs" in staged
+        assert next_state["location_state"]["address_line_1"].to_list() == ["179 Alexie Cliffs"]
+
+    @pytest.mark.it("Does not replace a calendar in the bucket that covers more dates")
+    @patch("src.utils.load_utils.connect_to_db")
+    @patch("src.pipeline.connect_to_source")
+    def test_keeps_longer_calendar(self, mock_connect_to_source, mock_connect):
+        os.environ["AWS_DEFAULT_REGION"] = "eu-west-2"
+        os.environ.setdefault("AWS_ACCESS_KEY_ID", "test")
+        os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "test")
+        mock_connect.return_value.run.side_effect = warehouse_run([])
+        bucket = "totesys-processed-data-000000"
+        with mock_aws():
+            s3 = boto3.client("s3")
+            s3.create_bucket(
+                Bucket=bucket, CreateBucketConfiguration={"LocationConstraint": "eu-west-2"}
+            )
+            longer = create_calendar_dim_date(dt.date(2019, 1, 1), dt.date(2035, 12, 31))
+            put_cached_dim_date(s3, bucket, longer)
+            state = {
+                "snapshot": None, "cached_dim_date": None,
+                "location_key_map": None, "location_state": None,
+            }
+            with patch("src.pipeline.query_db", side_effect=query_rows(SOURCES)):
+                run_pipeline(
+                    {}, {}, state=state, time_prefix=TIME_PREFIX, parallelism=1,
+                    s3_client=s3, processed_data_bucket=bucket,
+                )
+            assert get_cached_dim_date(s3, bucket).height == longer.height
+
+
+class TestState:
+    @pytest.mark.it("Reads no state from an empty state directory")
+    def test_read_state_missing(self, tmp_path):
+        assert read_state(str(tmp_path / "state")) is None
+
+    @pytest.mark.it("Saves the state so the next run only loads what changed")
+    @patch("src.utils.load_utils.connect_to_db")
+    @patch("src.pipeline.connect_to_source")
+    def test_saved_state_carries_into_the_next_run(
+        self, mock_connect_to_source, mock_connect, tmp_path
+    ):
+        state_dir = str(tmp_path / "state")
+        mock_connect.return_value.run.side_effect = warehouse_run([])
+        with patch("src.pipeline.query_db", side_effect=query_rows(SOURCES)):
+            _, state = run_pipeline({}, {}, time_prefix=TIME_PREFIX, parallelism=1)
+        save_state(state_dir, state)
+
+        saved = read_state(state_dir)
+        assert saved["snapshot"]["sales_order"].equals(state["snapshot"]["sales_order"])
+        assert saved["location_key_map"].equals(state["location_key_map"])
+        assert saved["cached_dim_date"].height == state["cached_dim_date"].height
+
+        db = MagicMock()
+        db.run.side_effect = warehouse_run([])
+        mock_connect.return_value = db
+        with patch("src.pipeline.query_db", side_effect=query_rows(SOURCES)):
+            _, next_state = run_pipeline(
+                {}, {}, state=saved, time_prefix="2024/11/01/09:30:00/", parallelism=1
+            )
+        assert not any(
+            c.kwargs.get("stream") and c.kwargs["stream"].getvalue()
+            for c in db.run.call_args_list
+        )
+        assert next_state["location_key_map"].equals(state["location_key_map"])
+
+        # saving again replaces the previous state
+        save_state(state_dir, next_state)
+        assert read_state(state_dir)["snapshot"]["staff"].height == 1
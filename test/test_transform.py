@@ -136,6 +136,33 @@ def s3(aws_credentials):
             Key=f"/history/{prefix}address_differences.csv",
         )
 
+        s3.put_object(
+            Body="""purchase_order_id,created_at,last_updated,staff_id,counterparty_id,item_code,item_quantity,item_unit_price,currency_id,agreed_delivery_date,agreed_payment_date,agreed_delivery_location_id
+1,2022-11-03 14:20:52.187000,2022-11-03 14:20:52.187000,12,11,ZDOI5EA,371,361.39,2,2022-11-09,2022-11-07,6
+2,2022-11-03 14:20:52.186000,2022-11-03 14:20:52.186000,20,17,QLZLEXR,286,199.04,2,2022-11-04,2022-11-07,8
+3,2022-11-03 14:20:52.187000,2022-11-03 14:20:52.187000,12,15,AN3D85L,839,658.58,2,2022-11-05,2022-11-04,16""",
+            Bucket="totesys-raw-data-000000",
+            Key=f"/history/{prefix}purchase_order_differences.csv",
+        )
+
+        s3.put_object(
+            Body="""payment_id,created_at,last_updated,transaction_id,counterparty_id,payment_amount,currency_id,payment_type_id,paid,payment_date,company_ac_number,counterparty_ac_number
+2,2022-11-03 14:20:52.186000,2022-11-03 14:20:52.186000,2,15,552548.62,2,3,False,2022-11-04,67305075,31622269
+3,2022-11-03 14:20:52.186000,2022-11-03 14:20:52.186000,3,18,205952.22,3,1,False,2022-11-03,81718079,47839086
+5,2022-11-03 14:20:52.187000,2022-11-03 14:20:52.187000,5,17,57067.20,2,3,False,2022-11-06,66213052,91659548""",
+            Bucket="totesys-raw-data-000000",
+            Key=f"/history/{prefix}payment_differences.csv",
+        )
+
+        s3.put_object(
+            Body="""transaction_id,transaction_type,sales_order_id,purchase_order_id,created_at,last_updated
+1,PURCHASE,,2,2022-11-03 14:20:52.186000,2022-11-03 14:20:52.186000
+2,PURCHASE,,3,2022-11-03 14:20:52.187000,2022-11-03 14:20:52.187000
+3,SALE,2,,2022-11-03 14:20:52.186000,2022-11-03 14:20:52.186000""",
+            Bucket="totesys-raw-data-000000",
+            Key=f"/history/{prefix}transaction_differences.csv",
+        )
+
         yield s3
 
 
@@ -146,4 +173,7 @@ class TestTransform:
 
         res = transform(event, context)
 
-        assert res == {"time_prefix": "YYYY/MM/DD/HH:MM:SS/"}
+        assert res["time_prefix"] == "YYYY/MM/DD/HH:MM:SS/"
+        stages = {record["stage"] for record in res["metrics"]}
+        assert {"download:sales_order", "build:fact_sales_order",
+                "upload:fact_sales_order"} <= stages
@@ -0,0 +1,99 @@
+import pytest
+import boto3
+import os
+import json
+from moto import mock_aws
+from src.utils.transform_cache import (
+    get_object_etag,
+    fingerprint_inputs,
+    get_transform_cache_index,
+    put_transform_cache_entry,
+    copy_cached_outputs,
+    TRANSFORM_CACHE_INDEX_KEY,
+    TRANSFORM_CACHE_MAX_ENTRIES,
+)
+
+BUCKET = "totesys-processed-data-000000"
+
+
+@pytest.fixture(scope="function")
+def aws_credentials():
+    """Mocked AWS Credentials for S3 bucket."""
+    os.environ["AWS_ACCESS_KEY_ID"] = "test"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "test"
+    os.environ["AWS_SECURITY_TOKEN"] = "test"
+    os.environ["AWS_SESSION_TOKEN"] = "test"
+    os.environ["AWS_DEFAULT_REGION"] = "eu-west-2"
+
+
+@pytest.fixture(scope="function")
+def s3(aws_credentials):
+    """Mocked S3 client with processed data bucket."""
+    with mock_aws():
+        s3 = boto3.client("s3")
+        s3.create_bucket(
+            Bucket=BUCKET,
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        yield s3
+
+
+class TestFingerprint:
+    @pytest.mark.it("Returns the ETag of an object and None if it does not exist")
+    def test_get_object_etag(self, s3):
+        s3.put_object(Body="a", Bucket=BUCKET, Key="/a.csv")
+        assert get_object_etag(s3, BUCKET, "/a.csv").strip('"')
+        assert get_object_etag(s3, BUCKET, "/missing.csv") is None
+
+    @pytest.mark.it("Gives the same fingerprint for the same ETags and version")
+    def test_fingerprint_stable(self):
+        assert fingerprint_inputs({"a": "1", "b": "2"}, "1") == fingerprint_inputs(
+            {"b": "2", "a": "1"}, "1"
+        )
+
+    @pytest.mark.it("Changes the fingerprint when an ETag or the version changes")
+    def test_fingerprint_changes(self):
+        fingerprint = fingerprint_inputs({"a": "1"}, "1")
+        assert fingerprint != fingerprint_inputs({"a": "2"}, "1")
+        assert fingerprint != fingerprint_inputs({"a": "1"}, "2")
+        assert fingerprint != fingerprint_inputs({"a": None}, "1")
+
+
+class TestCacheIndex:
+    @pytest.mark.it("Returns an empty index when none is stored")
+    def test_missing_index(self, s3):
+        assert get_transform_cache_index(s3, BUCKET) == {}
+
+    @pytest.mark.it("Stores entries and keeps only the most recent ones")
+    def test_put_entries(self, s3):
+        index = {}
+        for i in range(TRANSFORM_CACHE_MAX_ENTRIES + 1):
+            put_transform_cache_entry(s3, BUCKET, index, f"f{i}", f"p{i}", [f"/k{i}"])
+        stored = get_transform_cache_index(s3, BUCKET)
+        assert len(stored) == TRANSFORM_CACHE_MAX_ENTRIES
+        assert "f0" not in stored
+        assert stored[f"f{TRANSFORM_CACHE_MAX_ENTRIES}"] == {
+            "prefix": f"p{TRANSFORM_CACHE_MAX_ENTRIES}",
+            "keys": [f"/k{TRANSFORM_CACHE_MAX_ENTRIES}"],
+        }
+        raw = s3.get_object(Bucket=BUCKET, Key=TRANSFORM_CACHE_INDEX_KEY)
+        assert json.loads(raw["Body"].read()) == stored
+
+
+class TestCopyCachedOutputs:
+    @pytest.mark.it("Copies every output to the new prefix")
+    def test_copy(self, s3):
+        s3.put_object(Body="x", Bucket=BUCKET, Key="/history/old/dim_staff.parquet")
+        keys = copy_cached_outputs(
+            s3, BUCKET,
+            {"prefix": "old", "keys": ["/history/old/dim_staff.parquet"]},
+            "new",
+        )
+        assert keys == ["/history/new/dim_staff.parquet"]
+        res = s3.get_object(Bucket=BUCKET, Key="/history/new/dim_staff.parquet")
+        assert res["Body"].read() == b"x"
+
+    @pytest.mark.it("Copies nothing when the cached run has the same prefix")
+    def test_same_prefix(self, s3):
+        entry = {"prefix": "old", "keys": ["/history/old/dim_staff.parquet"]}
+        assert copy_cached_outputs(s3, BUCKET, entry, "old") == entry["keys"]
@@ -0,0 +1,140 @@
+import pytest
+import threading
+import polars as pl
+from src.utils.transform_engine import (
+    build_table,
+    table_spec_dependencies,
+    run_table_specs,
+    specs_for_tables,
+)
+
+
+@pytest.fixture(scope="function")
+def sources():
+    return {
+        "staff": pl.DataFrame(
+            {
+                "staff_id": [2, 1],
+                "first_name": ["Deron", "Jeremie"],
+                "department_id": [6, 2],
+            }
+        ),
+        "department": pl.DataFrame(
+            {"department_id": [2, 6], "department_name": ["Purchasing", "Facilities"]}
+        ),
+    }
+
+
+class TestBuildTable:
+    @pytest.mark.it("Applies joins, derived columns, drops, renames and sort")
+    def test_declarative_spec(self, sources):
+        spec = {
+            "name": "dim_staff",
+            "inputs": ["staff"],
+            "joins": [
+                {
+                    "right": "department",
+                    "left_on": "department_id",
+                    "right_on": "department_id",
+                }
+            ],
+            "derived": [pl.col("first_name").str.to_uppercase().alias("upper")],
+            "drops": ["department_id"],
+            "renames": {"department_name": "department"},
+            "sort": ["staff_id"],
+        }
+        df = build_table(spec, sources)
+        assert df.columns == ["staff_id", "first_name", "department", "upper"]
+        assert df["department"].to_list() == ["Purchasing", "Facilities"]
+        assert df["upper"].to_list() == ["JEREMIE", "DERON"]
+
+    @pytest.mark.it("Uses the transform callable to build the base frame")
+    def test_transform_spec(self, sources):
+        spec = {
+            "name": "staff_count",
+            "inputs": ["staff", "department"],
+            "transform": lambda frames: pl.DataFrame(
+                {"rows": [frames["staff"].height + frames["department"].height]}
+            ),
+        }
+        assert build_table(spec, sources)["rows"].to_list() == [4]
+
+
+class TestTableSpecDependencies:
+    @pytest.mark.it("Returns the specs each spec depends on")
+    def test_dependencies(self):
+        specs = [
+            {"name": "a", "inputs": ["staff"]},
+            {"name": "b", "inputs": ["a"], "joins": [{"right": "c"}]},
+            {"name": "c", "inputs": ["department"]},
+        ]
+        assert table_spec_dependencies(specs, ["staff", "department"]) == {
+            "a": set(), "b": {"a", "c"}, "c": set()
+        }
+
+    @pytest.mark.it("Raises an exception for unknown inputs")
+    def test_unknown_input(self):
+        with pytest.raises(Exception, match="Unknown inputs"):
+            table_spec_dependencies([{"name": "a", "inputs": ["nope"]}], [])
+
+    @pytest.mark.it("Raises an exception for cycles")
+    def test_cycle(self):
+        specs = [{"name": "a", "inputs": ["b"]}, {"name": "b", "inputs": ["a"]}]
+        with pytest.raises(Exception, match="Cycle"):
+            table_spec_dependencies(specs, [])
+
+
+class TestSpecsForTables:
+    @pytest.mark.it("Returns the target specs and their dependencies in order")
+    def test_specs_for_tables(self):
+        specs = [
+            {"name": "a", "inputs": ["staff"]},
+            {"name": "b", "inputs": ["a"], "joins": [{"right": "c"}]},
+            {"name": "c", "inputs": ["department"]},
+            {"name": "d", "inputs": ["c"]},
+        ]
+        assert [spec["name"] for spec in specs_for_tables(specs, ["b"])] == [
+            "a", "b", "c"
+        ]
+
+
+class TestRunTableSpecs:
+    @pytest.mark.it("Builds dependent specs after their inputs")
+    def test_dependency_order(self, sources):
+        specs = [
+            {"name": "b", "inputs": ["a"], "derived": [pl.lit(1).alias("b")]},
+            {"name": "a", "inputs": ["staff"], "derived": [pl.lit(1).alias("a")]},
+        ]
+        frames = run_table_specs(specs, sources)
+        assert frames["b"].columns == ["staff_id", "first_name", "department_id", "a", "b"]
+
+    @pytest.mark.it("Runs independent specs concurrently")
+    def test_concurrent_branches(self, sources):
+        barrier = threading.Barrier(2, timeout=5)
+
+        def wait_for_other_branch(frames):
+            barrier.wait()
+            return next(iter(frames.values()))
+
+        specs = [
+            {"name": "a", "inputs": ["staff"], "transform": wait_for_other_branch},
+            {"name": "b", "inputs": ["department"], "transform": wait_for_other_branch},
+        ]
+        frames = run_table_specs(specs, sources, max_workers=2)
+        assert frames["a"].height == 2 and frames["b"].height == 2
+
+    @pytest.mark.it("Publishes outputs but not intermediate tables")
+    def test_on_ready(self, sources):
+        published = []
+        specs = [
+            {"name": "a", "inputs": ["staff"], "output": False},
+            {"name": "b", "inputs": ["a"]},
+        ]
+        run_table_specs(specs, sources, on_ready=lambda name, df: published.append(name))
+        assert published == ["b"]
+
+    @pytest.mark.it("Raises the exception of a failing spec")
+    def test_failure(self, sources):
+        specs = [{"name": "a", "inputs": ["staff"], "drops": ["missing"]}]
+        with pytest.raises(Exception):
+            run_table_specs(specs, sources)
@@ -0,0 +1,58 @@
+import pytest
+import json
+from src.utils.transform_metrics import (
+    TransformMetrics,
+    TRANSFORM_METRICS_NAMESPACE,
+)
+
+
+@pytest.fixture(scope="function")
+def metrics():
+    metrics = TransformMetrics()
+    with metrics.stage("parse:sales_order") as record:
+        record["rows_out"] = 10
+        record["bytes_read"] = 1000
+    with metrics.stage("upload:fact_sales_order") as record:
+        record["bytes_written"] = 500
+    return metrics
+
+
+class TestTransformMetrics:
+    @pytest.mark.it("Records wall time, rows, bytes and peak RSS for every stage")
+    def test_records_stages(self, metrics):
+        stages = metrics.as_list()
+        assert [record["stage"] for record in stages] == [
+            "parse:sales_order", "upload:fact_sales_order"
+        ]
+        assert stages[0]["rows_out"] == 10
+        assert stages[0]["bytes_read"] == 1000
+        assert stages[1]["bytes_written"] == 500
+        assert all(record["duration_ms"] >= 0 for record in stages)
+        assert all(record["peak_rss_mb"] > 0 for record in stages)
+
+    @pytest.mark.it("Records a stage even when it raises")
+    def test_records_failed_stage(self):
+        metrics = TransformMetrics()
+        with pytest.raises(ValueError):
+            with metrics.stage("build:dim_date"):
+                raise ValueError
+        assert metrics.as_list()[0]["stage"] == "build:dim_date"
+
+    @pytest.mark.it("Emits one CloudWatch EMF document per stage")
+    def test_emit_emf(self, metrics, capsys):
+        metrics.emit_emf()
+        documents = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+        assert len(documents) == 2
+        directive = documents[0]["_aws"]["CloudWatchMetrics"][0]
+        assert directive["Namespace"] == TRANSFORM_METRICS_NAMESPACE
+        assert directive["Dimensions"] == [["Stage"]]
+        for metric in directive["Metrics"]:
+            assert metric["Name"] in documents[0]
+        assert documents[0]["Stage"] == "parse:sales_order"
+        assert documents[0]["rows_out"] == 10
+
+    @pytest.mark.it("Formats the stages as a table")
+    def test_format_table(self, metrics):
+        table = metrics.format_table().splitlines()
+        assert table[0].startswith("stage")
+        assert len(table) == 4
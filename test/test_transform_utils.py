@@ -1,8 +1,22 @@
 import pytest
 import boto3
 import os
+import polars as pl
+from io import BytesIO
+from datetime import date
 from moto import mock_aws
-from src.utils.transform_utils import finds_data_buckets, create_star_schema_from_sales_order_csv_file
+from unittest.mock import patch
+from src.utils.transform_utils import (
+    finds_data_buckets,
+    create_star_schema_from_sales_order_csv_file,
+    create_calendar_dim_date,
+    extend_calendar_dim_date,
+    upload_partitioned_fact_sales_order,
+    streaming_chunk_rows,
+    DIM_DATE_CACHE_KEY,
+    LOCATION_STATE_KEY,
+)
+from src.utils.transform_cache import TRANSFORM_CACHE_INDEX_KEY
 
 
 @pytest.fixture(scope="function")
@@ -67,6 +81,18 @@ event = {"time_prefix": "YYYY/MM/DD/HH:MM:SS"}
 prefix = event["time_prefix"]
 
 
+def copy_raw_prefix(s3, new_prefix):
+    """Copies the raw data files of prefix to a new prefix and returns it."""
+    for obj in s3.list_objects(Bucket="totesys-raw-data-000000")["Contents"]:
+        if prefix in obj["Key"]:
+            s3.copy_object(
+                Bucket="totesys-raw-data-000000",
+                Key=obj["Key"].replace(prefix, new_prefix),
+                CopySource={"Bucket": "totesys-raw-data-000000", "Key": obj["Key"]},
+            )
+    return new_prefix
+
+
 @pytest.fixture(scope="function")
 def s3_star_schema(aws_credentials):
     """Mocked S3 client with objects"""
@@ -179,6 +205,33 @@ def s3_star_schema(aws_credentials):
             Key=f"/history/{prefix}address_differences.csv",
         )
 
+        s3.put_object(
+            Body="""purchase_order_id,created_at,last_updated,staff_id,counterparty_id,item_code,item_quantity,item_unit_price,currency_id,agreed_delivery_date,agreed_payment_date,agreed_delivery_location_id
+1,2022-11-03 14:20:52.187000,2022-11-03 14:20:52.187000,12,11,ZDOI5EA,371,361.39,2,2022-11-09,2022-11-07,6
+2,2022-11-03 14:20:52.186000,2022-11-03 14:20:52.186000,20,17,QLZLEXR,286,199.04,2,2022-11-04,2022-11-07,8
+3,2022-11-03 14:20:52.187000,2022-11-03 14:20:52.187000,12,15,AN3D85L,839,658.58,2,2022-11-05,2022-11-04,16""",
+            Bucket="totesys-raw-data-000000",
+            Key=f"/history/{prefix}purchase_order_differences.csv",
+        )
+
+        s3.put_object(
+            Body="""payment_id,created_at,last_updated,transaction_id,counterparty_id,payment_amount,currency_id,payment_type_id,paid,payment_date,company_ac_number,counterparty_ac_number
+2,2022-11-03 14:20:52.186000,2022-11-03 14:20:52.186000,2,15,552548.62,2,3,False,2022-11-04,67305075,31622269
+3,2022-11-03 14:20:52.186000,2022-11-03 14:20:52.186000,3,18,205952.22,3,1,False,2022-11-03,81718079,47839086
+5,2022-11-03 14:20:52.187000,2022-11-03 14:20:52.187000,5,17,57067.20,2,3,False,2022-11-06,66213052,91659548""",
+            Bucket="totesys-raw-data-000000",
+            Key=f"/history/{prefix}payment_differences.csv",
+        )
+
+        s3.put_object(
+            Body="""transaction_id,transaction_type,sales_order_id,purchase_order_id,created_at,last_updated
+1,PURCHASE,,2,2022-11-03 14:20:52.186000,2022-11-03 14:20:52.186000
+2,PURCHASE,,3,2022-11-03 14:20:52.187000,2022-11-03 14:20:52.187000
+3,SALE,2,,2022-11-03 14:20:52.186000,2022-11-03 14:20:52.186000""",
+            Bucket="totesys-raw-data-000000",
+            Key=f"/history/{prefix}transaction_differences.csv",
+        )
+
         yield s3
 
 
@@ -228,9 +281,339 @@ class TestStarSchema:
         assert "/history/YYYY/MM/DD/HH:MM:SS/dim_currency.parquet" in object_list
         assert "/history/YYYY/MM/DD/HH:MM:SS/dim_design.parquet" in object_list
         assert "/history/YYYY/MM/DD/HH:MM:SS/dim_location.parquet" in object_list
+        assert "/history/YYYY/MM/DD/HH:MM:SS/fact_purchase_order.parquet" in object_list
+        assert "/history/YYYY/MM/DD/HH:MM:SS/fact_payment.parquet" in object_list
+        assert "/history/YYYY/MM/DD/HH:MM:SS/dim_transaction.parquet" in object_list
 
     @pytest.mark.it(
         "Inserts new data into star schema database if parquet files exists"
     )
     def test_insert_data(self):
         pass
+
+
+class TestCalendarDimDate:
+    @pytest.mark.it("Creates one row per day with the dim_date columns")
+    def test_calendar_has_one_row_per_day(self):
+        calendar = create_calendar_dim_date(date(2022, 12, 30), date(2023, 1, 2))
+        assert calendar.height == 4
+        assert calendar.columns == [
+            "date_id", "year", "month", "day", "day_of_week",
+            "day_name", "month_name", "quarter"
+        ]
+        first = calendar.row(0, named=True)
+        assert first["year"] == 2022
+        assert first["quarter"] == 4
+        assert first["day_name"] == "Friday"
+        assert first["day_of_week"] == 5
+        assert calendar["year"].to_list() == [2022, 2022, 2023, 2023]
+
+    @pytest.mark.it("Emits the whole calendar when there is no cache")
+    def test_no_cache_emits_calendar(self):
+        referenced = pl.Series([date(2019, 6, 1), date(2022, 11, 3)])
+        calendar, dim_date = extend_calendar_dim_date(None, referenced)
+        assert calendar["date_id"].min() == date(2019, 6, 1)
+        assert dim_date.height == calendar.height
+
+    @pytest.mark.it("Emits nothing when all dates are inside the cached range")
+    def test_cache_hit_emits_nothing(self):
+        cached = create_calendar_dim_date(date(2022, 1, 1), date(2022, 12, 31))
+        referenced = pl.Series([date(2022, 3, 1), date(2022, 11, 3)])
+        calendar, dim_date = extend_calendar_dim_date(cached, referenced)
+        assert calendar.height == cached.height
+        assert dim_date.is_empty()
+
+    @pytest.mark.it("Emits only the dates outside the cached range")
+    def test_cache_extension_emits_new_dates(self):
+        cached = create_calendar_dim_date(date(2022, 1, 1), date(2022, 12, 31))
+        referenced = pl.Series([date(2021, 12, 30), date(2023, 1, 2)])
+        calendar, dim_date = extend_calendar_dim_date(cached, referenced)
+        assert calendar.height == cached.height + 4
+        assert dim_date["date_id"].to_list() == [
+            date(2021, 12, 30), date(2021, 12, 31),
+            date(2023, 1, 1), date(2023, 1, 2)
+        ]
+
+    @pytest.mark.it("Caches the calendar and skips dim_date work on the next run")
+    def test_calendar_cached_between_runs(self, s3_star_schema):
+        create_star_schema_from_sales_order_csv_file(prefix)
+        s3_star_schema.head_object(
+            Bucket="totesys-processed-data-000000", Key=DIM_DATE_CACHE_KEY
+        )
+
+        new_prefix = copy_raw_prefix(s3_star_schema, "YYYY/MM/DD/HH:MM:59/")
+        create_star_schema_from_sales_order_csv_file(new_prefix)
+        res = s3_star_schema.get_object(
+            Bucket="totesys-processed-data-000000",
+            Key=f"/history/{new_prefix}/dim_date.parquet",
+        )
+        dim_date = pl.read_parquet(BytesIO(res["Body"].read()))
+        assert dim_date.is_empty()
+
+    @pytest.mark.it("Emits the same dim_date when a run is retried after saving the calendar")
+    def test_retry_keeps_dim_date(self, s3_star_schema):
+        bucket = "totesys-processed-data-000000"
+        with patch(
+            "src.utils.transform_utils.put_transform_cache_entry",
+            side_effect=Exception("Failed to put cache index"),
+        ), pytest.raises(Exception):
+            create_star_schema_from_sales_order_csv_file(prefix)
+        s3_star_schema.head_object(Bucket=bucket, Key=DIM_DATE_CACHE_KEY)
+        first = s3_star_schema.get_object(
+            Bucket=bucket, Key=f"/history/{prefix}/dim_date.parquet"
+        )["Body"].read()
+
+        create_star_schema_from_sales_order_csv_file(prefix)
+        retried = s3_star_schema.get_object(
+            Bucket=bucket, Key=f"/history/{prefix}/dim_date.parquet"
+        )["Body"].read()
+        assert not pl.read_parquet(BytesIO(retried)).is_empty()
+        assert retried == first
+
+
+class TestLocationState:
+    @pytest.mark.it("Keeps every location emitted for counterparties of later runs")
+    def test_location_state_saved(self, s3_star_schema):
+        bucket = "totesys-processed-data-000000"
+        create_star_schema_from_sales_order_csv_file(prefix)
+        dim_location = pl.read_parquet(BytesIO(s3_star_schema.get_object(
+            Bucket=bucket, Key=f"/history/{prefix}/dim_location.parquet"
+        )["Body"].read()))
+        locations = pl.read_parquet(BytesIO(s3_star_schema.get_object(
+            Bucket=bucket, Key=LOCATION_STATE_KEY
+        )["Body"].read()))
+        assert locations.equals(dim_location.sort("location_id"))
+
+    @pytest.mark.it("Reuses the outputs of a retried run after the location state has changed")
+    def test_retry_after_location_state_changed(self, s3_star_schema):
+        bucket = "totesys-processed-data-000000"
+        create_star_schema_from_sales_order_csv_file(prefix)
+        # a later run saves more locations
+        locations = pl.read_parquet(BytesIO(s3_star_schema.get_object(
+            Bucket=bucket, Key=LOCATION_STATE_KEY
+        )["Body"].read()))
+        buffer = BytesIO()
+        pl.concat(
+            [locations, locations.with_columns(pl.col("location_id") + 100)]
+        ).write_parquet(buffer)
+        s3_star_schema.put_object(
+            Body=buffer.getvalue(), Bucket=bucket, Key=LOCATION_STATE_KEY
+        )
+
+        with patch(
+            "src.utils.transform_utils.build_and_upload_star_schema"
+        ) as build:
+            create_star_schema_from_sales_order_csv_file(prefix)
+        build.assert_not_called()
+
+
+class TestPartitionedFactSalesOrder:
+    @pytest.mark.it("Writes one sorted parquet file per created_date year/month")
+    def test_partitioned_upload(self, s3):
+        fact_sales_order = pl.DataFrame(
+            {
+                "sales_order_id": [3, 1, 2],
+                "created_date": [date(2022, 12, 1), date(2022, 11, 4), date(2022, 11, 3)],
+                "units_sold": [30, 10, 20],
+            }
+        )
+        keys = upload_partitioned_fact_sales_order(
+            fact_sales_order, s3, "totesys-processed-data-000000", prefix,
+            row_group_size=1,
+        )
+        assert keys == [
+            f"/history/{prefix}/fact_sales_order/year=2022/month=11/part-0.parquet",
+            f"/history/{prefix}/fact_sales_order/year=2022/month=12/part-0.parquet",
+        ]
+        res = s3.get_object(Bucket="totesys-processed-data-000000", Key=keys[0])
+        november = pl.read_parquet(BytesIO(res["Body"].read()))
+        assert november.columns == ["sales_order_id", "created_date", "units_sold"]
+        assert november["sales_order_id"].to_list() == [2, 1]
+
+
+class TestStreamingTransform:
+    @pytest.mark.it("Streams a large sales_order file to the same fact_sales_order")
+    def test_streamed_fact_matches(self, s3_star_schema):
+        bucket = "totesys-processed-data-000000"
+        create_star_schema_from_sales_order_csv_file(prefix)
+
+        new_prefix = "YYYY/MM/DD/HH:MM:59/"
+        for obj in s3_star_schema.list_objects(
+            Bucket="totesys-raw-data-000000"
+        )["Contents"]:
+            s3_star_schema.copy_object(
+                Bucket="totesys-raw-data-000000",
+                Key=obj["Key"].replace(prefix, new_prefix),
+                CopySource={"Bucket": "totesys-raw-data-000000", "Key": obj["Key"]},
+            )
+        with patch("src.utils.transform_utils.TRANSFORM_STREAMING_THRESHOLD_BYTES", 0):
+            create_star_schema_from_sales_order_csv_file(new_prefix)
+
+        for table in ["fact_sales_order", "dim_location", "dim_counterparty"]:
+            expected = s3_star_schema.get_object(
+                Bucket=bucket, Key=f"/history/{prefix}/{table}.parquet"
+            )
+            result = s3_star_schema.get_object(
+                Bucket=bucket, Key=f"/history/{new_prefix}/{table}.parquet"
+            )
+            assert pl.read_parquet(BytesIO(result["Body"].read())).equals(
+                pl.read_parquet(BytesIO(expected["Body"].read()))
+            )
+
+    @pytest.mark.it("Builds dim_date from the streamed sales_order dates")
+    def test_streamed_dim_date(self, s3_star_schema):
+        with patch("src.utils.transform_utils.TRANSFORM_STREAMING_THRESHOLD_BYTES", 0):
+            create_star_schema_from_sales_order_csv_file(prefix)
+        res = s3_star_schema.get_object(
+            Bucket="totesys-processed-data-000000",
+            Key=f"/history/{prefix}/dim_date.parquet",
+        )
+        dim_date = pl.read_parquet(BytesIO(res["Body"].read()))
+        assert date(2022, 11, 3) in dim_date["date_id"].to_list()
+
+    @pytest.mark.it("Streams one sorted file per month with the partitioned layout")
+    def test_streamed_partitioned_fact(self, s3_star_schema):
+        bucket = "totesys-processed-data-000000"
+        with patch("src.utils.transform_utils.FACT_SALES_ORDER_LAYOUT", "partitioned"):
+            create_star_schema_from_sales_order_csv_file(prefix)
+            new_prefix = copy_raw_prefix(s3_star_schema, "YYYY/MM/DD/HH:MM:59/")
+            # the same rows in reverse order
+            header, *rows = s3_star_schema.get_object(
+                Bucket="totesys-raw-data-000000",
+                Key=f"/history/{prefix}sales_order_differences.csv",
+            )["Body"].read().decode().splitlines()
+            s3_star_schema.put_object(
+                Body="\n".join([header] + rows[::-1]),
+                Bucket="totesys-raw-data-000000",
+                Key=f"/history/{new_prefix}sales_order_differences.csv",
+            )
+            with patch("src.utils.transform_utils.TRANSFORM_STREAMING_THRESHOLD_BYTES", 0):
+                create_star_schema_from_sales_order_csv_file(new_prefix)
+        keys = [
+            obj["Key"] for obj in s3_star_schema.list_objects(
+                Bucket=bucket, Prefix=f"/history/{new_prefix}/fact_sales_order/",
+            )["Contents"]
+        ]
+        assert keys
+        assert all("/year=" in key and "/month=" in key for key in keys)
+        for key in keys:
+            streamed = pl.read_parquet(BytesIO(
+                s3_star_schema.get_object(Bucket=bucket, Key=key)["Body"].read()
+            ))
+            expected = pl.read_parquet(BytesIO(
+                s3_star_schema.get_object(
+                    Bucket=bucket, Key=key.replace(new_prefix, prefix)
+                )["Body"].read()
+            ))
+            assert streamed.equals(expected)
+
+    @pytest.mark.it("Writes the streamed Arrow IPC copy from the parquet file, not the csv")
+    def test_streamed_ipc_reads_parquet(self, s3_star_schema):
+        plans = []
+        sink_ipc = pl.LazyFrame.sink_ipc
+
+        def recording_sink_ipc(lazy_frame, *args, **kwargs):
+            plans.append(lazy_frame.explain())
+            return sink_ipc(lazy_frame, *args, **kwargs)
+
+        with patch(
+            "src.utils.transform_utils.TRANSFORM_STREAMING_THRESHOLD_BYTES", 0
+        ), patch("src.utils.transform_utils.TRANSFORM_IPC_OUTPUT", True), patch.object(
+            pl.LazyFrame, "sink_ipc", recording_sink_ipc
+        ):
+            create_star_schema_from_sales_order_csv_file(prefix)
+        assert len(plans) == 1
+        assert "Parquet SCAN" in plans[0] and "CSV" not in plans[0].upper()
+        ipc = s3_star_schema.get_object(
+            Bucket="totesys-processed-data-000000",
+            Key=f"/history/{prefix}/fact_sales_order.arrow",
+        )
+        parquet = s3_star_schema.get_object(
+            Bucket="totesys-processed-data-000000",
+            Key=f"/history/{prefix}/fact_sales_order.parquet",
+        )
+        assert pl.read_ipc(BytesIO(ipc["Body"].read())).equals(
+            pl.read_parquet(BytesIO(parquet["Body"].read()))
+        )
+
+    @pytest.mark.it("Processes fewer rows per chunk with a smaller memory budget")
+    def test_chunk_rows_follow_budget(self, tmp_path):
+        csv_path = tmp_path / "sales_order.csv"
+        pl.DataFrame({"id": range(2000), "name": ["x" * 100] * 2000}).write_csv(csv_path)
+        small = streaming_chunk_rows(csv_path, 64 * 1024 * 1024)
+        large = streaming_chunk_rows(csv_path, 1024 * 1024 * 1024)
+        assert 1000 <= small < large
+
+
+class TestIpcOutput:
+    @pytest.mark.it("Uploads an uncompressed Arrow IPC copy of every table when enabled")
+    def test_ipc_output(self, s3_star_schema):
+        with patch("src.utils.transform_utils.TRANSFORM_IPC_OUTPUT", True):
+            create_star_schema_from_sales_order_csv_file(prefix)
+        for table in ["fact_sales_order", "dim_staff", "dim_date"]:
+            parquet = s3_star_schema.get_object(
+                Bucket="totesys-processed-data-000000",
+                Key=f"/history/{prefix}/{table}.parquet",
+            )
+            ipc = s3_star_schema.get_object(
+                Bucket="totesys-processed-data-000000",
+                Key=f"/history/{prefix}/{table}.arrow",
+            )
+            assert pl.read_ipc(BytesIO(ipc["Body"].read())).equals(
+                pl.read_parquet(BytesIO(parquet["Body"].read()))
+            )
+
+    @pytest.mark.it("Does not upload Arrow IPC files by default")
+    def test_no_ipc_output_by_default(self, s3_star_schema):
+        create_star_schema_from_sales_order_csv_file(prefix)
+        keys = [
+            obj["Key"] for obj in s3_star_schema.list_objects(
+                Bucket="totesys-processed-data-000000"
+            )["Contents"]
+        ]
+        assert not any(key.endswith(".arrow") for key in keys)
+
+
+class TestTransformCache:
+    @pytest.mark.it("Copies the previous outputs when the inputs are unchanged")
+    def test_unchanged_inputs_copy_outputs(self, s3_star_schema):
+        bucket = "totesys-processed-data-000000"
+        # the first run extends the calendar, so the second prefix starts from
+        # the same calendar as the third
+        create_star_schema_from_sales_order_csv_file(prefix)
+        old_prefix = copy_raw_prefix(s3_star_schema, "YYYY/MM/DD/HH:MM:58/")
+        create_star_schema_from_sales_order_csv_file(old_prefix)
+
+        new_prefix = copy_raw_prefix(s3_star_schema, "YYYY/MM/DD/HH:MM:59/")
+        with patch(
+            "src.utils.transform_utils.download_source_tables"
+        ) as download_source_tables:
+            create_star_schema_from_sales_order_csv_file(new_prefix)
+        download_source_tables.assert_not_called()
+
+        for table in ["fact_sales_order", "dim_location", "dim_date"]:
+            old = s3_star_schema.get_object(
+                Bucket=bucket, Key=f"/history/{old_prefix}/{table}.parquet"
+            )["Body"].read()
+            new = s3_star_schema.get_object(
+                Bucket=bucket, Key=f"/history/{new_prefix}/{table}.parquet"
+            )["Body"].read()
+            assert old == new
+        s3_star_schema.head_object(Bucket=bucket, Key=TRANSFORM_CACHE_INDEX_KEY)
+
+    @pytest.mark.it("Rebuilds the outputs when an input changes")
+    def test_changed_input_rebuilds(self, s3_star_schema):
+        create_star_schema_from_sales_order_csv_file(prefix)
+        create_star_schema_from_sales_order_csv_file(prefix)
+        s3_star_schema.put_object(
+            Body="""currency_id,currency_code,created_at,last_updated
+1,GBP,2022-11-03 14:20:49.962000,2022-11-03 14:20:49.962000""",
+            Bucket="totesys-raw-data-000000",
+            Key=f"/history/{prefix}currency_differences.csv",
+        )
+        create_star_schema_from_sales_order_csv_file(prefix)
+        res = s3_star_schema.get_object(
+            Bucket="totesys-processed-data-000000",
+            Key=f"/history/{prefix}/dim_currency.parquet",
+        )
+        assert pl.read_parquet(BytesIO(res["Body"].read())).height == 1